@@ -1,9 +1,10 @@
 from fastapi import APIRouter
-from app.api.routes import categories, products, sales, dashboard
+from app.api.routes import categories, products, sales, dashboard, imports
 
 api_router = APIRouter()
 
 api_router.include_router(categories.router)
 api_router.include_router(products.router)
 api_router.include_router(sales.router)
-api_router.include_router(dashboard.router)
\ No newline at end of file
+api_router.include_router(dashboard.router)
+api_router.include_router(imports.router)
\ No newline at end of file
@@ -1,41 +1,88 @@
-from fastapi import APIRouter, HTTPException, File, UploadFile
-import pandas as pd
-import io
+from fastapi import APIRouter, Depends, HTTPException, File, UploadFile, Query, Request
 from sqlmodel import select
-from sqlalchemy.exc import IntegrityError
-from sqlalchemy import text
-from typing import List
-from app.config.database import SessionDep
+from typing import Annotated
+from app.config.database import AsyncSessionDep, ReadSessionDep, read_engine
+from app.middleware.instrumentation import TimedRoute
+from app.services.cache import category_cache, product_cache, sale_cache
+from app.services.bulk_delete import delete_categories
+from app.services.table_versions import bump_table_versions, conditional_get
 from app.models.category import Category
+from app.models.page import Page
+from app.services.pagination import DEFAULT_PAGE_SIZE, decode_cursor, paginate
+from app.services.list_formats import LIST_RESPONSES, MAX_COLUMNAR_PAGE_SIZE, ListFormat, check_page_size, list_response
+from app.services.export import ExportFormat, export_response
+from app.models.import_job import ImportJob
+from app.services.bulk_load import LoadMode
+from app.services.import_jobs import submit_import
 
 # https://fastapi.tiangolo.com/tutorial/bigger-applications/#another-module-with-apirouter
 
-router = APIRouter(prefix="/categories", tags=["categories"])
+router = APIRouter(prefix="/categories", tags=["categories"], route_class=TimedRoute)
 
-# SessionDep must be passed to all routes function, it is a abreviation of the session object on database.py and it is used to comunicate with the db
+# AsyncSessionDep must be passed to the routes that write, it is a abreviation of the async session on database.py and it is
+# used to comunicate with the db (every call to the db must be awaited). the imports run on worker processes with the sync
+# engine (see app/services/import_jobs.py)
+# ReadSessionDep is for the routes that only read, it uses a read replica when there is one (see app/services/replicas.py)
 # response_model is the same as a 'schema' for the response on the db, it ensures the responses are exactly an Category object
 
-@router.get("/", response_model=List[Category])
-def read_categories(session: SessionDep):
-    return session.exec(select(Category)).all()
+def _decode_categories_cursor(cursor: str) -> int:
+    try:
+        (cursor_id,) = decode_cursor(cursor)
+        return int(cursor_id)
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid Cursor")
+
+# the list selects the columns instead of the Category entity, the rows are serialized as they come (see app/services/list_formats.py)
+@router.get("/", response_model=Page[Category], responses=LIST_RESPONSES, dependencies=[Depends(conditional_get("category"))])
+async def read_categories(session: ReadSessionDep, limit: Annotated[int, Query(ge=1, le=MAX_COLUMNAR_PAGE_SIZE)] = DEFAULT_PAGE_SIZE, cursor: str | None = None, format: ListFormat = "json"):
+    check_page_size(limit, format)
+    columns = list(Category.__table__.c)
+    query = select(*columns)
+
+    # categories are paginated by id, the cursor is the id of the last category of the previous page
+    if cursor:
+        query = query.where(Category.id > _decode_categories_cursor(cursor))
+
+    query = query.order_by(Category.id)
+
+    page = await paginate(session, query, limit, lambda category: [category.id])
+    return list_response(page, columns, format)
+
+# must be declared before '/{category_id}', otherwise 'export' would be matched as a category id
+@router.get("/export")
+async def export_categories(request: Request, format: ExportFormat = "ndjson"):
+    # streams every category, the csv output can be sent back to /categories/import_csv
+    columns = ['id', 'name']
+    query = select(*[Category.__table__.c[name] for name in columns]).order_by(Category.id)
+    return export_response(query, columns, format, "categories", read_engine(request))
 
 @router.get("/{category_id}", response_model=Category)
-def read_category(category_id: int, session: SessionDep):
-    category = session.get(Category, category_id)
+async def read_category(category_id: int, session: AsyncSessionDep):
+    # hot ids are answered from the in process cache, without a database round trip (see app/services/cache.py)
+    cached = category_cache.get(category_id)
+    if cached is not None:
+        return cached
+
+    generation = category_cache.generation
+    category = await session.get(Category, category_id)
     if not category:
         raise HTTPException(status_code=404, detail="Category Not Found")
+
+    category_cache.set(category_id, category.model_dump(), generation)
     return category
 
 @router.post("/", response_model=Category)
-async def create_category(category: Category, session: SessionDep):
+async def create_category(category: Category, session: AsyncSessionDep):
     session.add(category)
-    session.commit()
-    session.refresh(category)
+    # the new version of the table is saved with the category, the ETags of the category list change with it
+    await session.run_sync(bump_table_versions, "category")
+    await session.commit()
+    await session.refresh(category)
     return category
 
 @router.put("/{category_id}", response_model=Category)
-async def update_category(category_id: str, category_data: Category, session: SessionDep):
-    category = session.get(Category, category_id)
+async def update_category(category_id: int, category_data: Category, session: AsyncSessionDep):
+    category = await session.get(Category, category_id)
     if not category:
         raise HTTPException(status_code=404, detail="Category Not Found")
     
@@ -43,75 +90,40 @@ async def update_category(category_id: str, category_data: Category, session: Se
     category.sqlmodel_update(input_data)
 
     session.add(category)
-    session.commit()
-    session.refresh(category)
+    await session.run_sync(bump_table_versions, "category")
+    await session.commit()
+    await session.refresh(category)
+    category_cache.invalidate(category_id)
     return category
 
 @router.delete("/{category_id}")
-async def delete_category(category_id: int, session: SessionDep):
-    category = session.get(Category, category_id)
-    if not category:
+async def delete_category(category_id: int, session: AsyncSessionDep):
+    # checked first, so an unknown id does not run the cascade (and its deletes of the products and sales) at all
+    if not await session.get(Category, category_id):
         raise HTTPException(status_code=404, detail="Category Not Found")
 
-    try:
-        session.delete(category)
-        session.commit()
-    except IntegrityError:
-        session.rollback()
-        raise HTTPException(
-            status_code=400, 
-            detail="Não é possível deletar esta categoria pois ele está relacionado à produtos ou vendas."
-        )
-
-    return {"message": "Category Deleted"}
-
-@router.post("/import_csv")
-async def import_categories_csv(session: SessionDep, file: UploadFile):
-    # if it is not a .csv file, raise Error
-    if not file.filename.endswith('.csv'):
-        raise HTTPException(status_code=400, detail="File Must be a CSV")
-
-    contents = await file.read() 
-    
-    try:
-        df = pd.read_csv(io.BytesIO(contents))
-        df = df[['id', 'name']].dropna() 
-
-    except Exception as e:
-        raise HTTPException(status_code=400, detail=f"Error Reading CSV: {str(e)}")
-
-    # getting all ids on the csv and turning into array
-    csv_ids = df['id'].tolist()
-    # searching on the database all ids that already exists
-    statement = select(Category.id).where(Category.id.in_(csv_ids))
-    existing_ids = session.exec(statement).all()
-    # turning the list of ids into a set is a good practice to reduce search time
-    existing_ids_set = set(existing_ids)
-
-    count = 0
-    # store new categories to be added
-    new_categories = []
-
-    # turning into a dict
-    records = df.to_dict(orient="records") 
-
-    for row in records:
-        if row['id'] not in existing_ids_set:
-            category = Category(id=row['id'], name=row['name'])
-            new_categories.append(category)
-            count += 1
-    
-    # save all categories at once
-    if new_categories:
-        session.add_all(new_categories)
-        session.commit()
-
-        try:
-            # Resets the 'category' table sequence
-            statement = text("SELECT setval('category_id_seq', (SELECT MAX(id) FROM category));")
-            session.exec(statement)
-            session.commit()
-        except Exception as e:
-            print(f"Warning: Could not reset sequence: {e}")
-
-    return {"message": f"Successfully added {count} new categories."}
\ No newline at end of file
+    # the products of the category and their sales are deleted with it, in batches of set based deletes (nothing is loaded
+    # into the session, see app/services/bulk_delete.py). the bulk delete helpers use a sync session, run_sync runs them
+    # on the async session connection
+    result = await session.run_sync(delete_categories, Category.id == category_id)
+    if not result["deleted"]:
+        raise HTTPException(status_code=404, detail="Category Not Found")
+
+    category_cache.invalidate(category_id)
+    product_cache.clear()
+    sale_cache.clear()
+
+    return {"message": "Category Deleted", **result}
+
+# the upload is saved to disk and answered right away with a queued import job (202), a worker process parses, validates
+# and loads it in batches (see app/services/import_jobs.py). the progress is read on GET /api/imports/{job_id}.
+# mode 'insert' keeps the categories that already exist, mode 'upsert' overwrites them with the file values
+@router.post("/import_csv", status_code=202, response_model=ImportJob)
+async def import_categories_csv(session: AsyncSessionDep, file: UploadFile, mode: LoadMode = "insert"):
+    return await submit_import(session, "category", "csv", file, mode)
+
+# same as import_csv for typed columnar files (.parquet, or arrow .arrow / .feather), read one row group at a time.
+# the columns already have their types, so nothing is parsed row by row
+@router.post("/import_parquet", status_code=202, response_model=ImportJob)
+async def import_categories_parquet(session: AsyncSessionDep, file: UploadFile, mode: LoadMode = "insert"):
+    return await submit_import(session, "category", "parquet", file, mode)
\ No newline at end of file
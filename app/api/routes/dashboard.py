@@ -1,47 +1,71 @@
-from fastapi import APIRouter
+from fastapi import APIRouter, Depends, HTTPException, Query
+from datetime import date, timedelta
+from typing import Annotated, Literal
+from sqlalchemy import Float, Integer, case, null, type_coerce
 from sqlmodel import select, func
-from app.config.database import SessionDep
+from app.config.database import ReadSessionDep
+from app.middleware.instrumentation import TimedRoute
 from app.models.category import Category
 from app.models.product import Product
 from app.models.sale import Sale
+from app.models.sales_rollup import SalesDailyRollup
+from app.services.list_formats import LIST_RESPONSES, ListFormat, list_response
+from app.services.table_versions import conditional_get
 
-router = APIRouter(prefix="/dashboard", tags=["dashboard"])
+# https://www.postgresql.org/docs/current/tutorial-window.html
+# https://www.sqlite.org/windowfunctions.html
 
-@router.get("/revenue")
-async def get_dashboard_revenue(session: SessionDep):
-    total_categories = session.exec(select(func.count(Category.id))).one()
+router = APIRouter(prefix="/dashboard", tags=["dashboard"], route_class=TimedRoute)
 
-    if total_categories is None:
-        total_categories = 0
+# the key used to group the days of the rollup for each granularity, and the name of the chart on the response
+def _bucket_key(day: date, granularity: str) -> str:
+    if granularity == "day":
+        return day.isoformat()
+    if granularity == "week":
+        # weeks are identified by their monday
+        return (day - timedelta(days=day.weekday())).isoformat()
+    return day.strftime("%Y-%m")
 
-    total_products = session.exec(select(func.count(Product.id))).one()
+CHART_NAMES = {"day": "daily_revenue", "week": "weekly_revenue", "month": "monthly_revenue"}
 
-    if total_products is None:
-        total_products = 0
+# the dashboards poll this endpoint, while none of the tables it reads changed they get a 304 without running the queries
+@router.get("/revenue", dependencies=[Depends(conditional_get("category", "product", "sales_daily_rollup"))])
+async def get_dashboard_revenue(session: ReadSessionDep, start_date: date | None = None, end_date: date | None = None, granularity: Literal["day", "week", "month"] = "month"):
+    # all the totals come from the daily rollup (app/services/sales_rollup.py), so this endpoint reads O(days) rows, not O(sales)
+    rollup_filters = []
 
-    total_sales = session.exec(select(func.count(Sale.id))).one()
-    
-    if total_sales is None:
-        total_sales = 0
+    if start_date:
+        rollup_filters.append(SalesDailyRollup.date >= start_date)
+    if end_date:
+        rollup_filters.append(SalesDailyRollup.date <= end_date)
 
-    total_revenue = session.exec(select(func.sum(Sale.total_price))).one()
-    
-    if total_revenue is None:
-        total_revenue = 0
+    # the four totals are fetched in a single round trip using scalar subqueries
+    summary_query = select(
+        select(func.count(Category.id)).scalar_subquery(),
+        select(func.count(Product.id)).scalar_subquery(),
+        select(func.coalesce(func.sum(SalesDailyRollup.sales_count), 0)).where(*rollup_filters).scalar_subquery(),
+        select(func.coalesce(func.sum(SalesDailyRollup.total_revenue), 0)).where(*rollup_filters).scalar_subquery(),
+    )
+    total_categories, total_products, total_sales, total_revenue = (await session.exec(summary_query)).one()
 
-    sales = session.exec(select(Sale)).all()
-    
-    sales_by_month_dict = {}
-    
-    for sale in sales:
-        month_key = sale.date.strftime("%Y-%m")
-        current_val = sales_by_month_dict.get(month_key, 0)
-        sales_by_month_dict[month_key] = current_val + sale.total_price
+    days = (await session.exec(
+        select(SalesDailyRollup.date, SalesDailyRollup.total_revenue, SalesDailyRollup.total_quantity)
+        .where(*rollup_filters)
+        .order_by(SalesDailyRollup.date)
+    )).all()
 
-    monthly_data = []
+    # days are already sorted, so the buckets are created in order
+    buckets = {}
 
-    for key, value in sorted(sales_by_month_dict.items()):
-        monthly_data.append({"date": key, "total": value} )
+    for day, revenue, quantity in days:
+        key = _bucket_key(day, granularity)
+        current_total, current_quantity = buckets.get(key, (0, 0))
+        buckets[key] = (current_total + revenue, current_quantity + quantity)
+
+    chart_data = []
+
+    for key, (total, quantity) in buckets.items():
+        chart_data.append({"date": key, "total": total, "quantity": quantity})
 
     return {
         "summary": {
@@ -51,6 +75,105 @@ async def get_dashboard_revenue(session: SessionDep):
             "total_revenue": total_revenue
         },
         "charts": {
-            "monthly_revenue": monthly_data
+            CHART_NAMES[granularity]: chart_data
         }
-    }
\ No newline at end of file
+    }
+
+
+# groups returned by the breakdowns, at most
+MAX_BREAKDOWN_LIMIT = 1000
+
+""" revenue and units by category, brand or product, aggregated on the database: the sales of the window are joined to
+their product (and category), grouped, and ranked with window functions, so only one row per group leaves the database
+(and the response grows with the number of groups, not of sales). when both dates are given, the same query also sums the
+window right before it (with the same number of days) and returns the growth over it """
+
+def _nonzero(expression):
+    # NULL instead of a division by zero (a window with no revenue has no share, a group that sold nothing before has no growth)
+    return type_coerce(func.nullif(expression, 0), Float)
+
+
+def _breakdown_query(group_columns: list, start_date: date | None, end_date: date | None, limit: int, by_category: bool = False):
+    filters = []
+    if start_date:
+        filters.append(Sale.date >= start_date)
+    if end_date:
+        filters.append(Sale.date <= end_date)
+
+    if start_date and end_date:
+        # the previous window is read by the same scan, each sale is summed into the current or the previous totals
+        previous_start = start_date - timedelta(days=(end_date - start_date).days + 1)
+        filters[0] = Sale.date >= previous_start
+        current = Sale.date >= start_date
+        # 0.0 and not 0, on sqlite a group with no sale on one of the windows would sum to the integer 0
+        revenue = func.sum(case((current, Sale.total_price), else_=0.0))
+        units = func.sum(case((current, Sale.quantity), else_=0))
+        sales_count = func.count(case((current, Sale.id)))
+        previous_revenue = func.sum(case((~current, Sale.total_price), else_=0.0))
+    else:
+        revenue = func.sum(Sale.total_price)
+        units = func.sum(Sale.quantity)
+        sales_count = func.count(Sale.id)
+        previous_revenue = null()
+
+    groups = (
+        select(
+            *group_columns,
+            type_coerce(revenue, Float).label("revenue"),
+            type_coerce(units, Integer).label("units"),
+            sales_count.label("sales_count"),
+            type_coerce(previous_revenue, Float).label("previous_revenue"),
+        )
+        .select_from(Sale)
+        .join(Product, Product.id == Sale.product_id)
+        .where(*filters)
+        .group_by(*group_columns)
+    )
+    if by_category:
+        groups = groups.join(Category, Category.id == Product.category_id)
+    groups = groups.subquery()
+
+    # the groups that only sold on the previous window are left out of the ranking
+    ranked = (
+        select(
+            *(groups.c[column.name] for column in group_columns),
+            groups.c.revenue,
+            groups.c.units,
+            groups.c.sales_count,
+            func.rank().over(order_by=groups.c.revenue.desc()).label("rank"),
+            (groups.c.revenue / _nonzero(func.sum(groups.c.revenue).over())).label("share"),
+            groups.c.previous_revenue,
+            ((groups.c.revenue - groups.c.previous_revenue) / _nonzero(groups.c.previous_revenue)).label("growth"),
+        )
+        .where(groups.c.sales_count > 0)
+        .subquery()
+    )
+
+    columns = list(ranked.c)
+    statement = select(*columns).order_by(ranked.c.rank, columns[0]).limit(limit)
+    return statement, columns
+
+
+async def _breakdown(session: ReadSessionDep, group_columns: list, start_date: date | None, end_date: date | None, limit: int, format: ListFormat, by_category: bool = False):
+    if start_date and end_date and start_date > end_date:
+        raise HTTPException(status_code=400, detail="start_date Must Not be After end_date")
+
+    statement, columns = _breakdown_query(group_columns, start_date, end_date, limit, by_category)
+    rows = (await session.exec(statement)).all()
+    return list_response({"items": rows, "next_cursor": None}, columns, format)
+
+BreakdownLimit = Annotated[int, Query(ge=1, le=MAX_BREAKDOWN_LIMIT)]
+BREAKDOWN_DEPENDENCIES = [Depends(conditional_get("category", "product", "sale"))]
+
+@router.get("/breakdown/categories", dependencies=BREAKDOWN_DEPENDENCIES, responses=LIST_RESPONSES)
+async def get_breakdown_by_category(session: ReadSessionDep, start_date: date | None = None, end_date: date | None = None, limit: BreakdownLimit = 10, format: ListFormat = "json"):
+    return await _breakdown(session, [Category.id.label("category_id"), Category.name.label("category_name")], start_date, end_date, limit, format, by_category=True)
+
+@router.get("/breakdown/brands", dependencies=BREAKDOWN_DEPENDENCIES, responses=LIST_RESPONSES)
+async def get_breakdown_by_brand(session: ReadSessionDep, start_date: date | None = None, end_date: date | None = None, limit: BreakdownLimit = 10, format: ListFormat = "json"):
+    return await _breakdown(session, [Product.brand], start_date, end_date, limit, format)
+
+# the top N products of the window, by revenue
+@router.get("/breakdown/products", dependencies=BREAKDOWN_DEPENDENCIES, responses=LIST_RESPONSES)
+async def get_breakdown_by_product(session: ReadSessionDep, start_date: date | None = None, end_date: date | None = None, limit: BreakdownLimit = 10, format: ListFormat = "json"):
+    return await _breakdown(session, [Product.id.label("product_id"), Product.name.label("product_name"), Product.brand, Product.category_id], start_date, end_date, limit, format)
@@ -0,0 +1,42 @@
+import asyncio
+from fastapi import APIRouter, Request
+from fastapi.responses import JSONResponse
+from sqlalchemy import text
+from app.config.database import async_engine, replicas
+
+# https://kubernetes.io/docs/tasks/configure-pod-container/configure-liveness-readiness-startup-probes/
+
+router = APIRouter(prefix="/health", tags=["health"])
+
+# seconds the readiness probe waits for the database
+READY_DB_TIMEOUT = 2
+
+# the process is up and the event loop answers, it says nothing about the database (a worker must not be restarted
+# because the database is down)
+@router.get("/live")
+async def live():
+    return {"status": "alive"}
+
+# 503 while the worker starts (schema verification and pool warm up, see the lifespan on app/main.py) or when the
+# database does not answer, the load balancer only sends traffic to workers that answer 200 here
+@router.get("/ready")
+async def ready(request: Request):
+    if not getattr(request.app.state, "ready", False):
+        return JSONResponse(status_code=503, content={"status": "starting"})
+
+    async def ping():
+        async with async_engine.connect() as conn:
+            await conn.execute(text("SELECT 1"))
+
+    try:
+        await asyncio.wait_for(ping(), timeout=READY_DB_TIMEOUT)
+    except Exception as e:
+        return JSONResponse(status_code=503, content={"status": "database unavailable", "error": str(e) or type(e).__name__})
+
+    # an unhealthy replica does not make the worker unready, its reads go to the other replicas (or to the primary)
+    return {
+        "status": "ready",
+        "startup_seconds": round(request.app.state.startup_seconds, 3),
+        "pool": async_engine.pool.status(),
+        "replicas": replicas.status(),
+    }
\ No newline at end of file
@@ -0,0 +1,49 @@
+from typing import Annotated, List
+from uuid import UUID
+from fastapi import APIRouter, HTTPException, Query
+from fastapi.responses import FileResponse
+from sqlmodel import select
+from app.config.database import AsyncSessionDep
+from app.middleware.instrumentation import TimedRoute
+from app.models.import_job import ImportJob
+from app.services.import_jobs import cancel_import
+from app.services.import_validation import reject_report_path
+
+# https://fastapi.tiangolo.com/advanced/custom-response/#fileresponse
+
+router = APIRouter(prefix="/imports", tags=["imports"], route_class=TimedRoute)
+
+# the reject report of an import (the 'reject_report' url on the import response): a csv with the row number on the file,
+# the reasons and the original values of every rejected row. reports are kept for IMPORT_REJECTS_TTL seconds
+@router.get("/rejects/{report_id}")
+async def download_reject_report(report_id: UUID):
+    path = reject_report_path(report_id)
+    if path is None:
+        raise HTTPException(status_code=404, detail="Reject Report Not Found")
+    return FileResponse(path, media_type="text/csv", filename=f"rejects-{report_id.hex}.csv")
+
+
+# the latest import jobs, newest first. 'state' filters by queued, running, succeeded, failed or cancelled
+@router.get("/", response_model=List[ImportJob])
+async def read_import_jobs(session: AsyncSessionDep, table_name: str | None = None, state: str | None = None, limit: Annotated[int, Query(ge=1, le=100)] = 20):
+    query = select(ImportJob)
+    if table_name:
+        query = query.where(ImportJob.table_name == table_name)
+    if state:
+        query = query.where(ImportJob.state == state)
+    return (await session.exec(query.order_by(ImportJob.created_at.desc()).limit(limit))).all()
+
+# state and progress of an import job, updated by the worker after every committed batch (rows read, added, rejected and
+# rows per second). when it is finished, 'reject_report' has the url of the rejected rows, if any
+@router.get("/{job_id}", response_model=ImportJob)
+async def read_import_job(job_id: str, session: AsyncSessionDep):
+    job = await session.get(ImportJob, job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Import Job Not Found")
+    return job
+
+# a queued job is cancelled right away, a running one stops after the batch it is loading (the batches already committed
+# are kept). cancelling a finished job does nothing
+@router.post("/{job_id}/cancel", response_model=ImportJob)
+async def cancel_import_job(job_id: str, session: AsyncSessionDep):
+    return await cancel_import(session, job_id)
\ No newline at end of file
@@ -1,25 +1,42 @@
-from fastapi import APIRouter, HTTPException, UploadFile, File
-import pandas as pd
-import io
+from fastapi import APIRouter, Depends, HTTPException, UploadFile, File, Query, Request
 from sqlmodel import select
-from sqlalchemy.exc import IntegrityError
-from sqlalchemy import text
-from typing import List
-from app.config.database import SessionDep
-from app.models.product import Product
+from typing import Annotated
+from app.config.database import AsyncSessionDep, ReadSessionDep, read_engine
+from app.middleware.instrumentation import TimedRoute
+from app.services.cache import product_cache, sale_cache
+from app.services.bulk_delete import delete_products
+from app.services.product_search import ranked_search, search_page_query, search_terms
+from app.services.table_versions import bump_table_versions, conditional_get
+from app.services.includes import PRODUCT_INCLUDES, include_tables, load_related, parse_includes
+from app.models.product import Product, ProductSearchResult, ProductWithCategory
+from app.models.page import Page
+from app.services.pagination import DEFAULT_PAGE_SIZE, decode_cursor, paginate
+from app.services.list_formats import LIST_RESPONSES, MAX_COLUMNAR_PAGE_SIZE, ListFormat, check_page_size, json_page_response, list_response
+from app.services.export import ExportFormat, export_response
+from app.models.import_job import ImportJob
+from app.services.bulk_load import LoadMode
+from app.services.import_jobs import submit_import
 
 
 # https://fastapi.tiangolo.com/tutorial/bigger-applications/#another-module-with-apirouter
 
-router = APIRouter(prefix="/products", tags=["products"])
+router = APIRouter(prefix="/products", tags=["products"], route_class=TimedRoute)
 
-# SessionDep must be passed to all routes function, it is a abreviation of the session object on database.py and it is used to comunicate with the db
+# AsyncSessionDep must be passed to the routes that write, it is a abreviation of the async session on database.py and it is
+# used to comunicate with the db (every call to the db must be awaited). the imports run on worker processes with the sync
+# engine (see app/services/import_jobs.py)
+# ReadSessionDep is for the routes that only read, it uses a read replica when there is one (see app/services/replicas.py)
 # response_model is the same as a 'schema' for the response on the db, it ensures the responses are exactly an Product object
 
-@router.get("/", response_model=List[Product])
-async def read_products(session: SessionDep, category_id: int | None = None, brand: str | None  = None, min_price: float | None  = None, max_price: float | None  = None):
-    query = select(Product)
+def _decode_products_cursor(cursor: str) -> int:
+    try:
+        (cursor_id,) = decode_cursor(cursor)
+        return int(cursor_id)
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid Cursor")
 
+# filters shared by the list and the export endpoints
+def _filter_products(query, category_id: int | None, brand: str | None, min_price: float | None, max_price: float | None):
     if category_id:
         query = query.where(Product.category_id == category_id)
     if brand:
@@ -29,26 +46,90 @@ async def read_products(session: SessionDep, category_id: int | None = None, bra
         query = query.where(Product.price >= min_price)
     if max_price is not None:
         query = query.where(Product.price <= max_price)
+
+    return query
+
+# the list selects the columns instead of the Product entity, the rows are serialized as they come (see app/services/list_formats.py).
+# while no product changes, a request with the ETag of the previous response gets a 304 without querying the products.
+# 'include=category' nests the category into each product, with a single query for the whole page (see app/services/includes.py)
+@router.get("/", response_model=Page[ProductWithCategory], responses=LIST_RESPONSES, dependencies=[Depends(conditional_get("product", include_tables=include_tables(Product, PRODUCT_INCLUDES)))])
+async def read_products(session: ReadSessionDep, category_id: int | None = None, brand: str | None  = None, min_price: float | None  = None, max_price: float | None  = None, limit: Annotated[int, Query(ge=1, le=MAX_COLUMNAR_PAGE_SIZE)] = DEFAULT_PAGE_SIZE, cursor: str | None = None, format: ListFormat = "json", include: str | None = None):
+    check_page_size(limit, format)
+    includes = parse_includes(include, PRODUCT_INCLUDES, format)
+    columns = list(Product.__table__.c)
+    query = _filter_products(select(*columns), category_id, brand, min_price, max_price)
+
+    # products are paginated by id, the cursor is the id of the last product of the previous page
+    if cursor:
+        query = query.where(Product.id > _decode_products_cursor(cursor))
+
+    query = query.order_by(Product.id)
     
-    return session.exec(query).all()
+    page = await paginate(session, query, limit, lambda product: [product.id])
+    if not includes:
+        return list_response(page, columns, format)
+
+    items = [row._asdict() for row in page["items"]]
+    await load_related(session, Product, items, includes)
+    return json_page_response(items, page["next_cursor"])
+
+def _decode_search_cursor(cursor: str):
+    # search results are sorted by (score desc, id), so that is what the cursor holds
+    try:
+        score, cursor_id = decode_cursor(cursor)
+        return float(score), int(cursor_id)
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid Cursor")
+
+# full text search over name, brand and description, ranked by relevance and backed by an index kept by the database (see
+# app/services/product_search.py). accepts the filters and formats of the list. must be declared before '/{product_id}'
+@router.get("/search", response_model=Page[ProductSearchResult], responses=LIST_RESPONSES, dependencies=[Depends(conditional_get("product"))])
+async def search_products(session: ReadSessionDep, q: Annotated[str, Query(min_length=1, max_length=200)], category_id: int | None = None, brand: str | None = None, min_price: float | None = None, max_price: float | None = None, limit: Annotated[int, Query(ge=1, le=MAX_COLUMNAR_PAGE_SIZE)] = DEFAULT_PAGE_SIZE, cursor: str | None = None, format: ListFormat = "json"):
+    check_page_size(limit, format)
+    ranked = ranked_search(session.bind.dialect.name, search_terms(q))
+    ranked = _filter_products(ranked, category_id, brand, min_price, max_price)
+
+    query, columns = search_page_query(ranked, _decode_search_cursor(cursor) if cursor else None)
+
+    page = await paginate(session, query, limit, lambda product: [product.score, product.id])
+    return list_response(page, columns, format)
+
+# must be declared before '/{product_id}', otherwise 'export' would be matched as a product id
+@router.get("/export")
+async def export_products(request: Request, category_id: int | None = None, brand: str | None = None, min_price: float | None = None, max_price: float | None = None, format: ExportFormat = "ndjson"):
+    # streams every product that matches the filters, the csv output can be sent back to /products/import_csv
+    columns = ['id', 'name', 'description', 'price', 'brand', 'category_id']
+    query = select(*[Product.__table__.c[name] for name in columns])
+    query = _filter_products(query, category_id, brand, min_price, max_price).order_by(Product.id)
+    return export_response(query, columns, format, "products", read_engine(request))
 
 @router.get("/{product_id}", response_model=Product)
-def read_product(product_id: int, session: SessionDep):
-    product = session.get(Product, product_id)
+async def read_product(product_id: int, session: AsyncSessionDep):
+    # hot ids are answered from the in process cache, without a database round trip (see app/services/cache.py)
+    cached = product_cache.get(product_id)
+    if cached is not None:
+        return cached
+
+    generation = product_cache.generation
+    product = await session.get(Product, product_id)
     if not product:
         raise HTTPException(status_code=404, detail="Product Not Found")
+
+    product_cache.set(product_id, product.model_dump(), generation)
     return product
 
 @router.post("/", response_model=Product)
-async def create_product(product: Product, session: SessionDep):
+async def create_product(product: Product, session: AsyncSessionDep):
     session.add(product)
-    session.commit()
-    session.refresh(product)
+    # the new version of the table is saved with the product, the ETags of the product lists change with it
+    await session.run_sync(bump_table_versions, "product")
+    await session.commit()
+    await session.refresh(product)
     return product
 
 @router.put("/{product_id}", response_model=Product)
-async def update_product(product_id: int, product_data: Product, session: SessionDep):
-    product = session.get(Product, product_id)
+async def update_product(product_id: int, product_data: Product, session: AsyncSessionDep):
+    product = await session.get(Product, product_id)
     if not product:
         raise HTTPException(status_code=404, detail="Product Not Found")
     
@@ -56,82 +137,53 @@ async def update_product(product_id: int, product_data: Product, session: Sessio
     product.sqlmodel_update(input_data)
     
     session.add(product)
-    session.commit()
-    session.refresh(product)
+    await session.run_sync(bump_table_versions, "product")
+    await session.commit()
+    await session.refresh(product)
+    product_cache.invalidate(product_id)
     return product
 
+# bulk delete of every product that matches the filters (the same of the list), with all their sales. at least one filter
+# is required, so a request without parameters does not wipe the table
+@router.delete("/")
+async def delete_products_bulk(session: AsyncSessionDep, category_id: int | None = None, brand: str | None = None, min_price: float | None = None, max_price: float | None = None):
+    condition = _filter_products(select(Product.id), category_id, brand, min_price, max_price).whereclause
+    if condition is None:
+        raise HTTPException(status_code=400, detail="At Least One Filter is Required")
+
+    # run in batches of set based deletes, nothing is loaded into the session (see app/services/bulk_delete.py)
+    result = await session.run_sync(delete_products, condition)
+
+    product_cache.clear()
+    sale_cache.clear()
+
+    return {"message": f"{result['deleted']} Products Deleted", **result}
+
 @router.delete("/{product_id}")
-async def delete_product(product_id: int, session: SessionDep):
-    product = session.get(Product, product_id)
-    if not product:
+async def delete_product(product_id: int, session: AsyncSessionDep):
+    # checked first, so an unknown id does not run the cascade (and its deletes of the sales) at all
+    if not await session.get(Product, product_id):
         raise HTTPException(status_code=404, detail="Product Not Found")
 
-    try:
-        session.delete(product)
-        session.commit()
-    except IntegrityError:
-        session.rollback()
-        raise HTTPException(
-            status_code=400, 
-            detail="Não é possível deletar este produto pois ele está relacionado à uma ou mais vendas."
-        )
-
-    return {"message": "Product Deleted"}
-
-@router.post("/import_csv")
-async def import_products_csv(session: SessionDep, file: UploadFile):
-    # if it is not a .csv file, raise Error
-    if not file.filename.endswith('.csv'):
-        raise HTTPException(status_code=400, detail="File Must be a CSV")
-
-    contents = await file.read()
-    
-    try:
-        df = pd.read_csv(io.BytesIO(contents))
-        df = df[['id', 'name', 'description', 'price', 'brand', 'category_id']].dropna()
-
-    except Exception as e:
-        raise HTTPException(status_code=400, detail=f"Error Reading CSV: {str(e)}")
-
-    # getting all ids on the csv and turning into array
-    csv_ids = df['id'].tolist()
-    # searching on the database all ids that already exists
-    statement = select(Product.id).where(Product.id.in_(csv_ids))
-    # turning the list of ids into a set is a good practice to reduce search time
-    existing_ids = session.exec(statement).all()
-    existing_ids_set = set(existing_ids)
-
-    count = 0
-    # store new products to be added
-    new_products = []
-    
-    # turning into a dict
-    records = df.to_dict(orient="records")
-
-    for row in records:
-        if row['id'] not in existing_ids_set:
-            product = Product(
-                id=row['id'],
-                name=row['name'],
-                description=row['description'],
-                price=float(row['price']), 
-                brand=row['brand'],
-                category_id=int(row['category_id'])
-            )
-            new_products.append(product)
-            count += 1
-
-    # save all categories at once
-    if new_products:
-        session.add_all(new_products)
-        session.commit()
-
-        try:
-            # Resets the 'product' table sequence
-            statement = text("SELECT setval('product_id_seq', (SELECT MAX(id) FROM product));")
-            session.exec(statement)
-            session.commit()
-        except Exception as e:
-            print(f"Warning: Could not reset sequence: {e}")
-
-    return {"message": f"Successfully added {count} new products."}
\ No newline at end of file
+    # the sales of the product are deleted with it and taken out of the daily rollup
+    result = await session.run_sync(delete_products, Product.id == product_id)
+    if not result["deleted"]:
+        raise HTTPException(status_code=404, detail="Product Not Found")
+
+    product_cache.invalidate(product_id)
+    sale_cache.clear()
+
+    return {"message": "Product Deleted", **result}
+
+# the upload is saved to disk and answered right away with a queued import job (202), a worker process parses, validates
+# and loads it in batches (see app/services/import_jobs.py). the progress is read on GET /api/imports/{job_id}.
+# mode 'insert' keeps the products that already exist, mode 'upsert' overwrites them with the file values
+@router.post("/import_csv", status_code=202, response_model=ImportJob)
+async def import_products_csv(session: AsyncSessionDep, file: UploadFile, mode: LoadMode = "insert"):
+    return await submit_import(session, "product", "csv", file, mode)
+
+# same as import_csv for typed columnar files (.parquet, or arrow .arrow / .feather), read one row group at a time.
+# the columns already have their types, so nothing is parsed row by row
+@router.post("/import_parquet", status_code=202, response_model=ImportJob)
+async def import_products_parquet(session: AsyncSessionDep, file: UploadFile, mode: LoadMode = "insert"):
+    return await submit_import(session, "product", "parquet", file, mode)
\ No newline at end of file
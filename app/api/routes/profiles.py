@@ -0,0 +1,29 @@
+from typing import Annotated
+from fastapi import APIRouter, Depends, Header, HTTPException
+from fastapi.responses import PlainTextResponse
+from app.services.profiler import PROFILING_TOKEN, profiler, token_matches
+
+# https://github.com/brendangregg/FlameGraph#2-fold-stacks
+
+router = APIRouter(prefix="/admin/profiles", tags=["admin"])
+
+
+def require_profiling_token(x_profile_token: Annotated[str | None, Header()] = None):
+    if not PROFILING_TOKEN:
+        raise HTTPException(status_code=404, detail="Profiling is Not Enabled")
+    if not token_matches(x_profile_token):
+        raise HTTPException(status_code=403, detail="Invalid Profiling Token")
+
+
+# the last profiles of this worker (the requested ones and the slow ones), newest first
+@router.get("/", dependencies=[Depends(require_profiling_token)])
+async def read_profiles():
+    return profiler.list()
+
+# the samples of a profile in the folded format, 'flamegraph.pl profile.folded > profile.svg' or open it on speedscope
+@router.get("/{profile_id}", dependencies=[Depends(require_profiling_token)], response_class=PlainTextResponse)
+async def read_profile(profile_id: int):
+    profile = profiler.get(profile_id)
+    if not profile:
+        raise HTTPException(status_code=404, detail="Profile Not Found")
+    return PlainTextResponse(profile.folded(), headers={"Content-Disposition": f'attachment; filename="profile-{profile.id}.folded"'})
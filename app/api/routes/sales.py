@@ -1,24 +1,46 @@
-from fastapi import APIRouter, HTTPException, UploadFile, File
-import pandas as pd
-import io
-from datetime import datetime, date
+from fastapi import APIRouter, Depends, HTTPException, UploadFile, File, Query, Request
+from datetime import date, timedelta
 from sqlmodel import select
-from sqlalchemy import text
-from typing import List
-from app.config.database import SessionDep
-from app.models.sale import Sale
+from sqlalchemy import tuple_
+from typing import Annotated
+from app.config.database import AsyncSessionDep, ReadSessionDep, read_engine
+from app.middleware.instrumentation import TimedRoute
+from app.services.cache import sale_cache
+from app.services.bulk_delete import delete_sales
+from app.services.partitions import lock_sale_ids
+from app.models.sale import Sale, SaleCreate, SaleUpdate, SaleWithProduct
+from app.models.page import Page
+from app.services.pagination import DEFAULT_PAGE_SIZE, decode_cursor, paginate
+from app.services.list_formats import LIST_RESPONSES, MAX_COLUMNAR_PAGE_SIZE, ListFormat, check_page_size, json_page_response, list_response
+from app.services.export import ExportFormat, export_response
+from app.services.sales_rollup import apply_sales_deltas, sale_deltas, merge_deltas
+from app.services.sale_batcher import sale_batcher
+from app.services.table_versions import bump_table_versions, conditional_get
+from app.services.includes import SALE_INCLUDES, include_tables, load_related, parse_includes
+from app.models.import_job import ImportJob
+from app.services.bulk_load import LoadMode
+from app.services.import_jobs import submit_import
 
 # https://fastapi.tiangolo.com/tutorial/bigger-applications/#another-module-with-apirouter
 
-router = APIRouter(prefix="/sales", tags=["sales"])
+router = APIRouter(prefix="/sales", tags=["sales"], route_class=TimedRoute)
 
-# SessionDep must be passed to all routes function, it is a abreviation of the session object on database.py and it is used to comunicate with the db
+# AsyncSessionDep must be passed to the routes that write, it is a abreviation of the async session on database.py and it is
+# used to comunicate with the db (every call to the db must be awaited). the imports run on worker processes with the sync
+# engine (see app/services/import_jobs.py)
+# ReadSessionDep is for the routes that only read, it uses a read replica when there is one (see app/services/replicas.py)
 # response_model is the same as a 'schema' for the response on the db, it ensures the responses are exactly an Sale object
 
-@router.get("/", response_model=List[Sale])
-async def read_sales(session: SessionDep, product_id: int | None = None, start_date: date | None = None, end_date: date | None  = None):
-    query = select(Sale)
+def _decode_sales_cursor(cursor: str):
+    # sales are sorted by (date, id), so that is what the cursor holds
+    try:
+        cursor_date, cursor_id = decode_cursor(cursor)
+        return date.fromisoformat(cursor_date), int(cursor_id)
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid Cursor")
 
+# filters shared by the list and the export endpoints
+def _filter_sales(query, product_id: int | None, start_date: date | None, end_date: date | None):
     if product_id:
         query = query.where(Sale.product_id == product_id)
     
@@ -27,104 +49,148 @@ async def read_sales(session: SessionDep, product_id: int | None = None, start_d
     if end_date:
         query = query.where(Sale.date <= end_date)
 
-    query = query.order_by(Sale.date.desc())
-
-    return session.exec(query).all()
-
-@router.get("/{sale_id}", response_model=Sale)
-def read_sale(sale_id: int, session: SessionDep):
-    sale = session.get(Sale, sale_id)
-    if not sale:
-        raise HTTPException(status_code=404, detail="Sale Not Found")
+    return query
+
+# the list selects the columns instead of the Sale entity, the rows are serialized as they come (see app/services/list_formats.py).
+# while no sale changes, a request with the ETag of the previous response gets a 304 without querying the sales.
+# 'include=product,product.category' nests the product and its category into each sale, with one query per level for the
+# whole page (see app/services/includes.py)
+@router.get("/", response_model=Page[SaleWithProduct], responses=LIST_RESPONSES, dependencies=[Depends(conditional_get("sale", include_tables=include_tables(Sale, SALE_INCLUDES)))])
+async def read_sales(session: ReadSessionDep, product_id: int | None = None, start_date: date | None = None, end_date: date | None  = None, limit: Annotated[int, Query(ge=1, le=MAX_COLUMNAR_PAGE_SIZE)] = DEFAULT_PAGE_SIZE, cursor: str | None = None, format: ListFormat = "json", include: str | None = None):
+    check_page_size(limit, format)
+    includes = parse_includes(include, SALE_INCLUDES, format)
+    columns = list(Sale.__table__.c)
+    query = _filter_sales(select(*columns), product_id, start_date, end_date)
+
+    # the id is added to the sort so the order is unique (many sales share the same date) and can be resumed by the cursor
+    if cursor:
+        query = query.where(tuple_(Sale.date, Sale.id) < _decode_sales_cursor(cursor))
+
+    query = query.order_by(Sale.date.desc(), Sale.id.desc())
+
+    page = await paginate(session, query, limit, lambda sale: [sale.date.isoformat(), sale.id])
+    if not includes:
+        return list_response(page, columns, format)
+
+    items = [row._asdict() for row in page["items"]]
+    await load_related(session, Sale, items, includes)
+    return json_page_response(items, page["next_cursor"])
+
+# must be declared before '/{sale_id}', otherwise 'export' would be matched as a sale id
+@router.get("/export")
+async def export_sales(request: Request, product_id: int | None = None, start_date: date | None = None, end_date: date | None = None, format: ExportFormat = "ndjson"):
+    # streams every sale that matches the filters, the csv output can be sent back to /sales/import_csv
+    columns = ['id', 'product_id', 'quantity', 'total_price', 'date']
+    query = select(*[Sale.__table__.c[name] for name in columns])
+    query = _filter_sales(query, product_id, start_date, end_date).order_by(Sale.id)
+    return export_response(query, columns, format, "sales", read_engine(request))
+
+# exclude_unset leaves 'product' out of the response when it was not included
+@router.get("/{sale_id}", response_model=SaleWithProduct, response_model_exclude_unset=True)
+async def read_sale(sale_id: int, session: AsyncSessionDep, include: str | None = None):
+    includes = parse_includes(include, SALE_INCLUDES)
+
+    # hot ids are answered from the in process cache, without a database round trip (see app/services/cache.py)
+    sale = sale_cache.get(sale_id)
+    if sale is None:
+        generation = sale_cache.generation
+        found = await session.get(Sale, sale_id)
+        if not found:
+            raise HTTPException(status_code=404, detail="Sale Not Found")
+
+        sale = found.model_dump()
+        sale_cache.set(sale_id, sale, generation)
+
+    if includes:
+        # a copy, the cached dict is shared with other requests
+        sale = dict(sale)
+        await load_related(session, Sale, [sale], includes)
     return sale
 
 @router.post("/", response_model=Sale)
-async def create_sale(sale: Sale, session: SessionDep):
+async def create_sale(sale_create: SaleCreate, session: AsyncSessionDep):
+    # the body is validated by SaleCreate, so the date is already a date (the async drivers, unlike psycopg2, do not convert
+    # strings)
+    sale = Sale.model_validate(sale_create)
+
+    # with SALE_BATCHING the sale is saved together with the others that arrive in the same few milliseconds, with a single
+    # INSERT and commit for all of them (see app/services/sale_batcher.py)
+    if sale_batcher:
+        return await sale_batcher.submit(sale)
+
+    # the imports of sales wait for this transaction before checking their ids (see lock_sale_ids)
+    connection = await session.connection()
+    await connection.run_sync(lock_sale_ids, True)
+
     session.add(sale)
-    session.commit()
-    session.refresh(sale)
+    # the daily rollup is updated in the same transaction as the sale. the rollup helpers use a sync session, run_sync
+    # runs them on the async session connection without blocking the event loop
+    await session.run_sync(apply_sales_deltas, sale_deltas([sale]))
+    # the sale (and rollup) table versions too, so the ETags of the sales list and the dashboard change with the sale
+    await session.run_sync(bump_table_versions, "sale")
+    await session.commit()
+    await session.refresh(sale)
     return sale
 
 @router.put("/{sale_id}", response_model=Sale)
-async def update_sale(sale_id: int, sale_data: Sale, session: SessionDep):
-    sale = session.get(Sale, sale_id)
+async def update_sale(sale_id: int, sale_data: SaleUpdate, session: AsyncSessionDep):
+    sale = await session.get(Sale, sale_id)
     if not sale:
         raise HTTPException(status_code=404, detail="Sale Not Found")
     
+    # the old values are removed from the rollup and the new ones added, the date may have changed too
+    old_deltas = sale_deltas([sale], sign=-1)
+
+    # validated by SaleUpdate, only the fields sent by the client are updated
     input_data = sale_data.model_dump(exclude_unset=True)
     sale.sqlmodel_update(input_data)
     
     session.add(sale)
-    session.commit()
-    session.refresh(sale)
+    await session.run_sync(apply_sales_deltas, merge_deltas(old_deltas, sale_deltas([sale])))
+    await session.run_sync(bump_table_versions, "sale")
+    await session.commit()
+    await session.refresh(sale)
+    sale_cache.invalidate(sale_id)
     return sale
 
+# bulk delete of every sale that matches the filters (the same of the list), like 'DELETE /sales/?end_date=2022-12-31' to
+# prune old sales. at least one filter is required, so a request without parameters does not wipe the table
+@router.delete("/")
+async def delete_sales_bulk(session: AsyncSessionDep, product_id: int | None = None, start_date: date | None = None, end_date: date | None = None):
+    condition = _filter_sales(select(Sale.id), product_id, start_date, end_date).whereclause
+    if condition is None:
+        raise HTTPException(status_code=400, detail="At Least One Filter is Required")
+
+    # with only an end date, the whole months before it are dropped as partitions on postgres instead of deleted row by row
+    drop_before = end_date + timedelta(days=1) if end_date and not product_id and not start_date else None
+
+    # run in batches of set based deletes, the rollup is reduced by the rows each batch deleted (see app/services/bulk_delete.py)
+    result = await session.run_sync(delete_sales, condition, drop_before)
+    sale_cache.clear()
+
+    return {"message": f"{result['deleted']} Sales Deleted", **result}
+
 @router.delete("/{sale_id}")
-async def delete_sale(sale_id: int, session: SessionDep):
-    sale = session.get(Sale, sale_id)
+async def delete_sale(sale_id: int, session: AsyncSessionDep):
+    sale = await session.get(Sale, sale_id)
     if not sale:
         raise HTTPException(status_code=404, detail="Sale Not Found")
-    session.delete(sale)
-    session.commit()
+    await session.delete(sale)
+    await session.run_sync(apply_sales_deltas, sale_deltas([sale], sign=-1))
+    await session.run_sync(bump_table_versions, "sale")
+    await session.commit()
+    sale_cache.invalidate(sale_id)
     return {"message": "Sale Deleted"}
 
-@router.post("/import_csv")
-async def import_sales_csv(session: SessionDep, file: UploadFile):
-    # if it is not a .csv file, raise Error
-    if not file.filename.endswith('.csv'):
-        raise HTTPException(status_code=400, detail="File Must be a CSV")
-
-    contents = await file.read()
-
-    try:
-        df = pd.read_csv(io.BytesIO(contents))
-        df = df[['id', 'product_id', 'quantity', 'total_price', 'date']].dropna()
-
-    except Exception as e:
-        raise HTTPException(status_code=400, detail=f"Error Reading CSV: {str(e)}")
-
-    # getting all ids on the csv and turning into array
-    csv_ids = df['id'].tolist()
-    # searching on the database all ids that already exists
-    statement = select(Sale.id).where(Sale.id.in_(csv_ids))
-    existing_ids = session.exec(statement).all()
-    # turning the list of ids into a set is a good practice to reduce search time
-    existing_ids_set = set(existing_ids)
-
-    count = 0
-    # store new categories to be added
-    new_sales = []
-
-    # turning into a dict
-    records = df.to_dict(orient="records")
-
-    for row in records:
-        if row['id'] not in existing_ids_set:
-            try:
-                sale_date = datetime.strptime(str(row['date']), '%Y-%m-%d').date()
-            except ValueError:
-                continue 
-
-            sale = Sale(
-                id=row['id'],
-                product_id=int(row['product_id']),
-                quantity=int(row['quantity']),
-                total_price=float(row['total_price']),
-                date=sale_date
-            )
-            new_sales.append(sale)
-            count += 1
-
-    # save all categories at once
-    if new_sales:
-        session.add_all(new_sales)
-        session.commit()
-
-        try:
-            statement = text("SELECT setval('sale_id_seq', (SELECT MAX(id) FROM sale));")
-            session.exec(statement)
-            session.commit()
-        except Exception as e:
-            print(f"Warning: Could not reset sequence: {e}")
-
-    return {"message": f"Successfully added {count} new sales."}
\ No newline at end of file
+# the upload is saved to disk and answered right away with a queued import job (202), a worker process parses, validates
+# and loads it in batches (see app/services/import_jobs.py). the progress is read on GET /api/imports/{job_id}.
+# mode 'insert' keeps the sales that already exist, mode 'upsert' overwrites them with the file values
+@router.post("/import_csv", status_code=202, response_model=ImportJob)
+async def import_sales_csv(session: AsyncSessionDep, file: UploadFile, mode: LoadMode = "insert"):
+    return await submit_import(session, "sale", "csv", file, mode)
+
+# same as import_csv for typed columnar files (.parquet, or arrow .arrow / .feather), read one row group at a time.
+# the columns already have their types, so nothing is parsed row by row
+@router.post("/import_parquet", status_code=202, response_model=ImportJob)
+async def import_sales_parquet(session: AsyncSessionDep, file: UploadFile, mode: LoadMode = "insert"):
+    return await submit_import(session, "sale", "parquet", file, mode)
\ No newline at end of file
@@ -0,0 +1,99 @@
+""" maintenance commands that must run outside of a request, use them with: 'python -m app.cli <command>'
+
+    python -m app.cli rebuild-rollup                          (recomputes the whole daily sales rollup)
+    python -m app.cli rebuild-rollup --start 2024-01-01       (recomputes only the given window)
+    python -m app.cli migrate                                 (applies the schema again: missing tables, indexes, search index and cascades)
+    python -m app.cli partition-sales                         (postgres: converts an existing 'sale' table to monthly partitions)
+    python -m app.cli ensure-partitions --months-ahead 6      (postgres: creates the next monthly partitions, run it from cron)
+    python -m app.cli drop-sales-before --before 2022-01-01   (deletes the old sales, dropping whole partitions when possible) """
+import argparse
+from datetime import date
+from sqlmodel import Session
+from app.config.database import engine, create_db_and_tables
+# every model must be imported so sqlalchemy can resolve the relationships between them
+from app.models.category import Category
+from app.models.product import Product
+from app.models.sale import Sale
+from app.models.sales_rollup import SalesDailyRollup
+from app.models.import_job import ImportJob
+from app.services.sales_rollup import rebuild_rollup
+from app.services.partitions import SALE_PARTITIONS_AHEAD, ensure_future_partitions, migrate_sale_to_partitioned
+from app.services.schema import SCHEMA_VERSION
+from app.services.bulk_delete import delete_sales
+
+
+def rebuild_rollup_command(args):
+    # the rollup table may not exist yet on databases created before it was added
+    SalesDailyRollup.__table__.create(engine, checkfirst=True)
+
+    with Session(engine) as session:
+        days = rebuild_rollup(session, args.start, args.end)
+
+    print(f"Rollup rebuilt: {days} days.")
+
+
+def migrate_command(args):
+    # applies the whole schema again even when the database is already on the current version (see app/services/schema.py).
+    # new indexes lock their table while they are built, run it outside of peak hours
+    create_db_and_tables(force=True)
+
+    print(f"Tables and indexes are up to date (schema version {SCHEMA_VERSION}).")
+
+
+def partition_sales_command(args):
+    # the whole table is copied inside one transaction, writes to 'sale' wait until it is done
+    with engine.begin() as conn:
+        if conn.dialect.name != "postgresql":
+            print("Partitioning is only available on postgres, nothing to do.")
+            return
+        moved = migrate_sale_to_partitioned(conn)
+
+    print(f"Sale table partitioned: {moved} rows moved.")
+
+
+def ensure_partitions_command(args):
+    with engine.begin() as conn:
+        created = ensure_future_partitions(conn, args.months_ahead)
+
+    print(f"Partitions created: {', '.join(created) if created else 'none'}.")
+
+
+def drop_sales_before_command(args):
+    # same as 'DELETE /api/sales/?end_date=', the whole months are dropped as partitions and what is left (a partial month,
+    # the default partition or a table that is not partitioned) is deleted in batches
+    with Session(engine) as session:
+        result = delete_sales(session, Sale.date < args.before, drop_before=args.before)
+
+    dropped = result["partitions_dropped"]
+    print(f"Partitions dropped: {', '.join(dropped) if dropped else 'none'}. Rows deleted: {result['deleted']}.")
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="python -m app.cli")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    rebuild = commands.add_parser("rebuild-rollup", help="recompute the daily sales rollup from the sale table")
+    rebuild.add_argument("--start", type=date.fromisoformat, default=None)
+    rebuild.add_argument("--end", type=date.fromisoformat, default=None)
+    rebuild.set_defaults(handler=rebuild_rollup_command)
+
+    migrate = commands.add_parser("migrate", help="create the missing tables and indexes")
+    migrate.set_defaults(handler=migrate_command)
+
+    partition = commands.add_parser("partition-sales", help="convert the sale table to monthly partitions (postgres)")
+    partition.set_defaults(handler=partition_sales_command)
+
+    ensure = commands.add_parser("ensure-partitions", help="create the next monthly sale partitions (postgres)")
+    ensure.add_argument("--months-ahead", type=int, default=SALE_PARTITIONS_AHEAD)
+    ensure.set_defaults(handler=ensure_partitions_command)
+
+    drop = commands.add_parser("drop-sales-before", help="delete the sales older than a date")
+    drop.add_argument("--before", type=date.fromisoformat, required=True)
+    drop.set_defaults(handler=drop_sales_before_command)
+
+    args = parser.parse_args()
+    args.handler(args)
+
+
+if __name__ == "__main__":
+    main()
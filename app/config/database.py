@@ -1,28 +1,152 @@
-from sqlmodel import SQLModel, create_engine, Session
+import asyncio
+from sqlmodel import create_engine
+from sqlalchemy import event, text
+from sqlmodel.ext.asyncio.session import AsyncSession
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import InterfaceError, OperationalError
+from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine, async_sessionmaker
 import os
 from dotenv import load_dotenv
-from fastapi import Depends
+from fastapi import Depends, Request
 from typing import Annotated
+from app.services.metrics import READ_ROUTING, instrumented_pool_class, pool_collector
+from app.services.replicas import ReplicaSet, reads_from_primary
+from app.services.schema import verify_schema
 
 # https://fastapi.tiangolo.com/tutorial/sql-databases/#create-an-engine
+# https://docs.sqlalchemy.org/en/20/orm/extensions/asyncio.html
+# https://docs.sqlalchemy.org/en/20/core/pooling.html#setting-pool-recycle
+# https://docs.sqlalchemy.org/en/20/dialects/sqlite.html#foreign-key-support
 
 load_dotenv()
 
 database_url = os.getenv("DATABASE_URL")
 
+# comma separated urls of read replicas of DATABASE_URL, the read-only routes are spread over them (see
+# app/services/replicas.py). without it every query goes to DATABASE_URL
+DATABASE_REPLICA_URLS = [url.strip() for url in os.getenv("DATABASE_REPLICA_URLS", "").split(",") if url.strip()]
+
+# connection pool settings, shared by both engines. a worker can hold at most DB_POOL_SIZE + DB_MAX_OVERFLOW connections,
+# a request waits DB_POOL_TIMEOUT seconds for a free connection before failing
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+DB_CONNECT_TIMEOUT = int(os.getenv("DB_CONNECT_TIMEOUT", "10"))
+# connections of the async pool opened on boot, before the worker reports itself as ready
+DB_POOL_WARM = int(os.getenv("DB_POOL_WARM", str(DB_POOL_SIZE)))
+
+# logs every sql statement, useful while developing but too expensive to leave on (GET /metrics has the query timings)
+DB_ECHO = os.getenv("DB_ECHO", "false").lower() in ("1", "true", "yes")
+
+# the async drivers used for each database, the DATABASE_URL can keep using the sync driver name (postgresql://...)
+ASYNC_DRIVERS = {"postgresql": "postgresql+asyncpg", "sqlite": "sqlite+aiosqlite"}
+
+
+def _async_url(url: str):
+    url = make_url(url)
+    return url.set(drivername=ASYNC_DRIVERS.get(url.get_backend_name(), url.drivername))
+
+
+def _engine_options(url: str, connect_timeout_arg: str, engine_label: str, is_async: bool) -> dict:
+    # sqlite has no server to connect to, its pools do not accept these settings
+    if make_url(url).get_backend_name() == "sqlite":
+        return {"echo": DB_ECHO}
+
+    return {
+        "echo": DB_ECHO,
+        # same pool sqlalchemy would use, but measuring how long requests wait for a connection
+        "poolclass": instrumented_pool_class(engine_label, is_async),
+        "pool_size": DB_POOL_SIZE,
+        "max_overflow": DB_MAX_OVERFLOW,
+        "pool_timeout": DB_POOL_TIMEOUT,
+        "pool_recycle": DB_POOL_RECYCLE,
+        # checks the connection before handing it to a request, so connections dropped by the server are replaced
+        "pool_pre_ping": True,
+        "connect_args": {connect_timeout_arg: DB_CONNECT_TIMEOUT},
+    }
+
+
 # a SQLModel engine (underneath it's actually a SQLAlchemy engine) is what holds the connections to the database.
-engine = create_engine(database_url, echo=True)
+# this sync engine is only used where a sync driver is truly needed: creating the tables, the csv importers (that use
+# pandas and psycopg2 'COPY') and the maintenance commands on app/cli.py
+engine = create_engine(database_url, **_engine_options(database_url, "connect_timeout", "sync", is_async=False))
+
+# the async engine is used by the route handlers, while a query is waiting for the database the event loop keeps serving
+# other requests (a sync query inside an 'async def' route blocks the whole worker until it finishes)
+async_engine = create_async_engine(_async_url(database_url), **_engine_options(database_url, "timeout", "async", is_async=True))
+
+
+def _enable_sqlite_foreign_keys(dbapi_connection, connection_record):
+    # sqlite ignores the foreign keys (and their 'ON DELETE CASCADE') unless it is turned on for every connection
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA foreign_keys=ON")
+    cursor.close()
 
 
-# this creates the database and starts all models from SQLModel 
-# (we must import the models inside main.py (or here) for python to register them)
-def create_db_and_tables():
-    SQLModel.metadata.create_all(engine)
+if make_url(database_url).get_backend_name() == "sqlite":
+    event.listen(engine, "connect", _enable_sqlite_foreign_keys)
+    event.listen(async_engine.sync_engine, "connect", _enable_sqlite_foreign_keys)
 
-""" a Session is what stores the objects in memory and keeps track of any changes needed in the data, then it uses the engine 
-to communicate with the database. we will create a FastAPI dependency with yield that will provide a new Session for each request. This is what ensures that we use a single session per request. """
-def get_session():
-    with Session(engine) as session:
+# one async engine (and pool) per replica, with the same pool settings as the primary
+replicas = ReplicaSet([
+    create_async_engine(_async_url(url), **_engine_options(url, "timeout", f"replica{number}", is_async=True))
+    for number, url in enumerate(DATABASE_REPLICA_URLS, start=1)
+])
+
+# the pool size of every engine is reported on GET /metrics
+pool_collector.register("sync", engine)
+pool_collector.register("async", async_engine.sync_engine)
+for replica in replicas.replicas:
+    pool_collector.register(replica.name, replica.engine.sync_engine)
+
+# expire_on_commit=False keeps the objects loaded after a commit, an async session cannot lazy load them again
+async_session_maker = async_sessionmaker(async_engine, class_=AsyncSession, expire_on_commit=False)
+
+
+# this creates the database and starts all models from SQLModel
+# (we must import the models inside main.py (or here) for python to register them). the schema is only applied when the
+# database is not on the current version yet, by a single worker (see app/services/schema.py)
+def create_db_and_tables(force: bool = False) -> bool:
+    return verify_schema(engine, force)
+
+
+async def warm_pool(connections: int = DB_POOL_WARM):
+    # opens the connections at the same time, so they are all different ones, and gives them back to the pool. the first
+    # requests then do not pay for the connection setup (tcp, tls, authentication)
+    async def ping():
+        async with async_engine.connect() as conn:
+            await conn.execute(text("SELECT 1"))
+
+    await asyncio.gather(*(ping() for _ in range(connections)))
+
+""" a Session is what stores the objects in memory and keeps track of any changes needed in the data, then it uses the engine
+to communicate with the database. we will create a FastAPI dependency with yield that will provide a new Session for each request. This is what ensures that we use a single session per request.
+every database call must be awaited ('await session.exec(...)', 'await session.commit()') """
+async def get_async_session():
+    async with async_session_maker() as session:
         yield session
 
-SessionDep = Annotated[Session, Depends(get_session)]
\ No newline at end of file
+AsyncSessionDep = Annotated[AsyncSession, Depends(get_async_session)]
+
+
+def read_engine(request: Request) -> AsyncEngine:
+    """ the engine a read-only request should use: the next healthy replica, or the primary when there is none or the
+    request asked for it """
+    replica = replicas.choose() if replicas and not reads_from_primary(request) else None
+    READ_ROUTING.labels("replica" if replica else "primary").inc()
+    return replica or async_engine
+
+# for the routes that only read (lists, search, dashboard), never write with it: on a replica the write fails
+async def get_read_session(request: Request):
+    bind = read_engine(request)
+    async with async_session_maker(bind=bind) as session:
+        try:
+            yield session
+        except (OperationalError, InterfaceError) as e:
+            # the replica went away in the middle of the request, the next reads go to the other ones
+            if bind is not async_engine:
+                replicas.mark_down(bind, e)
+            raise
+
+ReadSessionDep = Annotated[AsyncSession, Depends(get_read_session)]
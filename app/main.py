@@ -1,27 +1,98 @@
-from fastapi import FastAPI
+import time
+
+# taken before anything else is imported, so the startup time includes the imports (see STARTUP_BUDGET_SECONDS)
+IMPORT_STARTED = time.perf_counter()
+
+import os
+from fastapi import FastAPI, Response
 from contextlib import asynccontextmanager
-from app.config.database import create_db_and_tables
+from fastapi.concurrency import run_in_threadpool
+from prometheus_client import generate_latest, CONTENT_TYPE_LATEST
+from app.config.database import create_db_and_tables, engine, async_engine, database_url, replicas, warm_pool
 from app.api.main import api_router
+from app.api.routes.health import router as health_router
+from app.api.routes.profiles import router as profiles_router
+from app.middleware.instrumentation import InstrumentationMiddleware, instrument_engine
+from app.middleware.read_routing import ReadYourWritesMiddleware
+from app.middleware.etag import ETagMiddleware
+from app.middleware.profiling import ProfilingMiddleware
+from app.services.cache_sync import create_cache_sync
+from app.services.import_jobs import shutdown_import_workers, start_import_workers
+from app.services.sale_batcher import sale_batcher
+from app.services.profiler import PROFILE_SLOW_MS, PROFILING_ENABLED
+from app.services.metrics import STARTUP_SECONDS
 
 # importing models for create_db_and_tables to work
 from app.models.category import Category
 from app.models.product import Product
 from app.models.sale import Sale
+from app.models.sales_rollup import SalesDailyRollup
+from app.models.import_job import ImportJob
+from app.models.table_version import TableVersion
 
 from fastapi.middleware.cors import CORSMiddleware
 
 # https://fastapi.tiangolo.com/advanced/events/#lifespan
 # https://fastapi.tiangolo.com/tutorial/cors/#use-corsmiddleware
 
+# seconds a worker may take from the import of this module until it is ready, a slower boot is logged as a warning (and
+# shows up on the 'app_startup_seconds' metric). cold starts of autoscaled workers must stay under it
+STARTUP_BUDGET_SECONDS = float(os.getenv("STARTUP_BUDGET_SECONDS", "5"))
+
 """ a context manager in Python is something that you can use in a with statement, the first part of the function, before the 
 yield, will be executed before the application starts. and the part after the yield will be executed after the application has finished. """
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    print("Creating database and tables...")
-    create_db_and_tables()
+    # until the end of the startup GET /health/ready answers 503, so no traffic is sent to this worker yet
+    app.state.ready = False
+    started = time.perf_counter()
+    STARTUP_SECONDS.labels("imports").set(started - IMPORT_STARTED)
+
+    # only reads the schema version when the database is up to date, a single worker applies a new schema (the others
+    # wait for it on a lock). the sync driver runs on a thread, so the event loop is not blocked
+    applied = await run_in_threadpool(create_db_and_tables)
+    print("Database schema applied." if applied else "Database schema is up to date.")
+    STARTUP_SECONDS.labels("schema").set(time.perf_counter() - started)
+
+    # cross worker invalidation of the entity caches, only when CACHE_INVALIDATION_CHANNEL is set
+    cache_sync = create_cache_sync(database_url)
+    if cache_sync:
+        await cache_sync.start()
+
+    warm_started = time.perf_counter()
+    await warm_pool()
+    STARTUP_SECONDS.labels("pool_warm").set(time.perf_counter() - warm_started)
+
+    # import jobs left queued or running by a dead api process are failed, the jobs of this one get a heartbeat
+    await start_import_workers()
+
+    # task that saves the queued sales of POST /sales/ in batches, only when SALE_BATCHING is on
+    if sale_batcher:
+        await sale_batcher.start()
+
+    # first health check of the read replicas (when DATABASE_REPLICA_URLS is set), then one every REPLICA_CHECK_INTERVAL
+    if replicas:
+        await replicas.start()
+
+    app.state.startup_seconds = time.perf_counter() - IMPORT_STARTED
+    STARTUP_SECONDS.labels("total").set(app.state.startup_seconds)
+    if app.state.startup_seconds > STARTUP_BUDGET_SECONDS:
+        print(f"WARNING: startup took {app.state.startup_seconds:.2f}s, over the budget of {STARTUP_BUDGET_SECONDS}s")
+    else:
+        print(f"Started in {app.state.startup_seconds:.2f}s.")
+    app.state.ready = True
+
     yield
+    app.state.ready = False
     # code here will be executed after the app is finished.
+    if sale_batcher:
+        await sale_batcher.stop()
     print("Shutting down database...")
+    if cache_sync:
+        await cache_sync.stop()
+    shutdown_import_workers()
+    await replicas.stop()
+    await async_engine.dispose()
 
 app = FastAPI(
     title="SmartMart Solutions API",
@@ -37,11 +108,43 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    # lets browsers read the timings of cross origin requests on the devtools, and the cursor of the arrow list responses
+    expose_headers=["Server-Timing", "X-Next-Cursor", "ETag", "X-Profile-Id"],
 )
 
+# counts the queries and measures the db, handler and serialization time of every request (see Server-Timing header)
+instrument_engine(engine)
+instrument_engine(async_engine.sync_engine)
+for replica in replicas.replicas:
+    instrument_engine(replica.engine.sync_engine)
+app.add_middleware(InstrumentationMiddleware)
+
+# ETag of the list and dashboard responses, built from the versions of the tables they read (see app/services/table_versions.py)
+app.add_middleware(ETagMiddleware)
+
+# after a write the reads of the client stay on the primary for a few seconds, so it does not read stale replicas
+if replicas:
+    app.add_middleware(ReadYourWritesMiddleware)
+
+# sampling profiler of the requests, only with PROFILING_TOKEN set (added last, so it is the outermost middleware and the
+# profile covers the others too)
+if PROFILING_ENABLED:
+    app.add_middleware(ProfilingMiddleware)
+elif PROFILE_SLOW_MS:
+    print("WARNING: PROFILE_SLOW_MS is ignored without PROFILING_TOKEN, the slow profiles could not be read")
+
 # register all routes from routes folder
 app.include_router(api_router, prefix="/api")
+# liveness and readiness probes, outside of /api like /metrics
+app.include_router(health_router)
+# profiles of the slow (and of the requested) requests, see app/services/profiler.py
+app.include_router(profiles_router)
 
 @app.get("/")
 def root():
-    return {"message": "Hello World!"}
\ No newline at end of file
+    return {"message": "Hello World!"}
+
+# prometheus scrape endpoint: latency per route, db time and queries per request, pool usage and import throughput
+@app.get("/metrics", include_in_schema=False)
+def metrics():
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
\ No newline at end of file
@@ -0,0 +1,24 @@
+# https://developer.mozilla.org/en-US/docs/Web/HTTP/Headers/ETag
+# https://developer.mozilla.org/en-US/docs/Web/HTTP/Headers/Cache-Control#no-cache
+
+
+class ETagMiddleware:
+    """ pure ASGI middleware that adds the ETag built by the 'conditional_get' dependency (app/services/table_versions.py)
+    to the 200 response of the route. 'no-cache' lets browsers keep the response, but they must send 'If-None-Match' on
+    every use, so a change is seen right away and an unchanged response costs a 304 """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] not in ("GET", "HEAD"):
+            return await self.app(scope, receive, send)
+
+        async def send_with_etag(message):
+            # request.state is stored on the scope, the dependency already ran when the response starts
+            etag = scope.get("state", {}).get("etag")
+            if message["type"] == "http.response.start" and etag and message["status"] == 200:
+                message["headers"] = list(message.get("headers", [])) + [(b"etag", etag.encode()), (b"cache-control", b"no-cache")]
+            await send(message)
+
+        await self.app(scope, receive, send_with_etag)
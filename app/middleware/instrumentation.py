@@ -0,0 +1,136 @@
+import functools
+import inspect
+import time
+from contextvars import ContextVar
+from dataclasses import dataclass
+from fastapi.routing import APIRoute
+from sqlalchemy import event
+from app.services.metrics import REQUEST_LATENCY, REQUEST_DB_TIME, REQUEST_DB_QUERIES
+
+# https://www.w3.org/TR/server-timing/
+# https://docs.sqlalchemy.org/en/20/core/events.html#sqlalchemy.events.ConnectionEvents.before_cursor_execute
+# https://asgi.readthedocs.io/en/latest/specs/www.html
+
+""" per request instrumentation, in three parts:
+
+    - sqlalchemy events count the queries and add up their time into the stats of the current request (a context var, so
+      it follows the request into awaited calls and into the thread pool)
+    - TimedRoute measures the time spent inside the route function
+    - InstrumentationMiddleware measures the whole request, writes the 'Server-Timing' header and feeds the /metrics
+      histograms. everything the handler did not spend is validation + serialization of the response """
+
+
+@dataclass
+class RequestStats:
+    db_queries: int = 0
+    db_seconds: float = 0
+    handler_seconds: float = 0
+
+
+request_stats: ContextVar[RequestStats | None] = ContextVar("request_stats", default=None)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info["query_start"].pop()
+    stats = request_stats.get()
+    # queries outside of a request (startup, cli) have no stats
+    if stats is not None:
+        stats.db_queries += 1
+        stats.db_seconds += elapsed
+
+
+def instrument_engine(engine):
+    """ registers the query timing hooks on a sync engine (for an async engine, pass 'async_engine.sync_engine') """
+    event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+
+
+def _timed(endpoint):
+    # the wrapper must be async for async routes and sync for sync ones, fastapi decides how to call it from that.
+    # functools.wraps keeps the signature, fastapi still reads the parameters of the original function
+    if getattr(endpoint, "_is_timed", False):
+        return endpoint
+
+    if inspect.iscoroutinefunction(endpoint):
+        @functools.wraps(endpoint)
+        async def timed_endpoint(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await endpoint(*args, **kwargs)
+            finally:
+                _add_handler_time(time.perf_counter() - start)
+    else:
+        @functools.wraps(endpoint)
+        def timed_endpoint(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return endpoint(*args, **kwargs)
+            finally:
+                _add_handler_time(time.perf_counter() - start)
+
+    timed_endpoint._is_timed = True
+    return timed_endpoint
+
+
+def _add_handler_time(seconds: float):
+    stats = request_stats.get()
+    if stats is not None:
+        stats.handler_seconds += seconds
+
+
+class TimedRoute(APIRoute):
+    """ route class that measures the route function, use it with 'APIRouter(route_class=TimedRoute)' """
+
+    def __init__(self, path, endpoint, **kwargs):
+        super().__init__(path, _timed(endpoint), **kwargs)
+
+
+def _server_timing(stats: RequestStats, total: float) -> str:
+    handler_ms = max(stats.handler_seconds - stats.db_seconds, 0) * 1000
+    serialize_ms = max(total - stats.handler_seconds, 0) * 1000
+    return ", ".join([
+        f'db;dur={stats.db_seconds * 1000:.2f};desc="{stats.db_queries} queries"',
+        f'handler;dur={handler_ms:.2f}',
+        f'serialize;dur={serialize_ms:.2f};desc="validation + serialization"',
+        f'total;dur={total * 1000:.2f}',
+    ])
+
+
+class InstrumentationMiddleware:
+    """ pure ASGI middleware (not BaseHTTPMiddleware), so streaming responses are not buffered. the header is added to the
+    'http.response.start' message, that is sent once the handler and the serialization are done """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        stats = RequestStats()
+        token = request_stats.set(stats)
+        start = time.perf_counter()
+        status = 500
+
+        async def send_with_timing(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                header = _server_timing(stats, time.perf_counter() - start)
+                message["headers"] = list(message.get("headers", [])) + [(b"server-timing", header.encode())]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            request_stats.reset(token)
+            # the route template (like '/sales/{sale_id}') is used as label, the raw path would create a series per id
+            route = getattr(scope.get("route"), "path", "unmatched")
+            method = scope["method"]
+            REQUEST_LATENCY.labels(method, route, status).observe(time.perf_counter() - start)
+            REQUEST_DB_TIME.labels(method, route).observe(stats.db_seconds)
+            REQUEST_DB_QUERIES.labels(method, route).observe(stats.db_queries)
@@ -0,0 +1,43 @@
+import sys
+from urllib.parse import parse_qs
+from app.services.profiler import PROFILE_HEADER, PROFILE_QUERY, PROFILE_SLOW_MS, Profile, profiler, token_matches
+
+# https://asgi.readthedocs.io/en/latest/specs/www.html#http-connection-scope
+
+
+class ProfilingMiddleware:
+    """ pure ASGI middleware that samples the requests asked with the profiling token (every request, when PROFILE_SLOW_MS
+    is set) while they run, see app/services/profiler.py. only added when profiling is enabled, so it costs nothing
+    otherwise """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        # the profiles are not profiled themselves
+        if scope["type"] != "http" or scope["path"].startswith("/admin/profiles"):
+            return await self.app(scope, receive, send)
+
+        headers = dict(scope["headers"])
+        token = headers.get(PROFILE_HEADER.encode(), b"").decode() or parse_qs(scope["query_string"].decode()).get(PROFILE_QUERY, [None])[0]
+        requested = token_matches(token)
+        if not requested and not PROFILE_SLOW_MS:
+            return await self.app(scope, receive, send)
+
+        profile = Profile(scope["method"], scope["path"], requested)
+        status = 500
+
+        async def send_with_profile_id(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                if requested:
+                    message["headers"] = list(message.get("headers", [])) + [(b"x-profile-id", str(profile.id).encode())]
+            await send(message)
+
+        # the frame of this call is where the stacks of the request start
+        profiler.start(profile, sys._getframe())
+        try:
+            await self.app(scope, receive, send_with_profile_id)
+        finally:
+            profiler.stop(profile, status)
@@ -0,0 +1,29 @@
+import time
+from app.services.replicas import READ_PRIMARY_COOKIE, REPLICA_STICKY_SECONDS
+
+# https://developer.mozilla.org/en-US/docs/Web/HTTP/Headers/Set-Cookie
+
+# the methods that change data, the routes for them always run on the primary
+WRITE_METHODS = {"POST", "PUT", "PATCH", "DELETE"}
+
+
+class ReadYourWritesMiddleware:
+    """ pure ASGI middleware that adds the 'read_primary_until' cookie to every successful write, so the next reads of the
+    same client go to the primary until the replicas had time to receive the write (see app/services/replicas.py). only
+    added when there are replicas """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] not in WRITE_METHODS:
+            return await self.app(scope, receive, send)
+
+        async def send_with_cookie(message):
+            if message["type"] == "http.response.start" and message["status"] < 400:
+                until = time.time() + REPLICA_STICKY_SECONDS
+                cookie = f"{READ_PRIMARY_COOKIE}={until:.3f}; Max-Age={int(REPLICA_STICKY_SECONDS) + 1}; Path=/; HttpOnly; SameSite=Lax"
+                message["headers"] = list(message.get("headers", [])) + [(b"set-cookie", cookie.encode())]
+            await send(message)
+
+        await self.app(scope, receive, send_with_cookie)
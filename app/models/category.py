@@ -16,7 +16,9 @@ class Category(SQLModel, table=True):
     id: int | None = Field(default=None, primary_key=True)
     name: str
     # we must set the relationship here, this does not create a table, it only works as a helper if you want to do category.products
-    products: List["Product"] = Relationship(back_populates="category", cascade_delete=True)
+    # passive_deletes leaves the children to the 'ON DELETE CASCADE' of the foreign key, so deleting a category does not load
+    # its products into the session (the deletes go through app/services/bulk_delete.py anyway)
+    products: List["Product"] = Relationship(back_populates="category", cascade_delete=True, passive_deletes=True)
     
 
 # class CategoryCreate(CategoryBase):
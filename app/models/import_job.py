@@ -0,0 +1,39 @@
+from sqlmodel import SQLModel, Field
+from sqlalchemy import JSON, Column
+from datetime import datetime, timezone
+from typing import List
+
+# https://fastapi.tiangolo.com/tutorial/sql-databases/#update-the-app-with-multiple-models
+
+# state and progress of a background import (see app/services/import_jobs.py). the job is stored on the database, so any
+# api worker can answer GET /api/imports/{job_id}, whichever worker received the upload
+class ImportJob(SQLModel, table=True):
+    __tablename__ = "import_job"
+
+    # uuid hex, not a serial: the id is sent to the client and must not be guessable
+    id: str = Field(primary_key=True)
+    table_name: str
+    file_name: str
+    file_format: str
+    mode: str
+    # queued -> running -> succeeded | failed | cancelled
+    state: str = Field(default="queued", index=True)
+
+    rows_read: int = 0
+    added: int = 0
+    rejected: int = 0
+    rows_per_second: float = 0
+    reject_report: str | None = None
+    # one entry per committed batch: {"batch", "rows", "added", "rejected"}
+    batches: List[dict] | None = Field(default=None, sa_column=Column(JSON))
+    error: str | None = None
+
+    # set by POST /api/imports/{job_id}/cancel, the worker stops after the batch it is loading
+    cancel_requested: bool = False
+
+    created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+    started_at: datetime | None = None
+    finished_at: datetime | None = None
+    # refreshed by the api process that runs the job while it is queued or running, a job whose process died stops being
+    # refreshed and is marked as failed (see fail_stale_jobs on app/services/import_jobs.py)
+    heartbeat_at: datetime | None = None
@@ -0,0 +1,11 @@
+from pydantic import BaseModel
+from typing import Generic, List, TypeVar
+
+# https://docs.pydantic.dev/latest/concepts/models/#generic-models
+
+T = TypeVar("T")
+
+# response of the list endpoints: one page of items plus the cursor to request the next one (None on the last page)
+class Page(BaseModel, Generic[T]):
+    items: List[T]
+    next_cursor: str | None = None
@@ -1,23 +1,54 @@
 from sqlmodel import SQLModel, Field, Relationship
+from sqlalchemy import Index
 from typing import List, TYPE_CHECKING
 
 # https://fastapi.tiangolo.com/tutorial/sql-databases/#update-the-app-with-multiple-models
 # https://github.com/fastapi/full-stack-fastapi-template/blob/master/backend/app/models.py
 
+from .category import Category
+
 if TYPE_CHECKING:
-    from .category import Category
     from .sale import Sale
 
 class Product(SQLModel, table=True):
+    # indexes for the filters of GET /products, a category filter with a price range is answered by a single index range
+    __table_args__ = (
+        Index("ix_product_category_id_price", "category_id", "price"),
+        Index("ix_product_brand", "brand"),
+    )
+
     id: int | None = Field(default=None, primary_key=True)
     name: str
     description: str
     price: float
     brand: str
     
-    # foreign key, every sale must have a category id
-    category_id: int = Field(foreign_key="category.id")
+    # foreign key, every sale must have a category id. the products are deleted by the database with their category
+    category_id: int = Field(foreign_key="category.id", ondelete="CASCADE")
     
     # we must set the relationship here, this does not create a table, it only works as a helper if you want to do product.sales
     category: "Category" = Relationship(back_populates="products")
-    sales: List["Sale"] = Relationship(back_populates="product")
\ No newline at end of file
+    sales: List["Sale"] = Relationship(back_populates="product", cascade_delete=True, passive_deletes=True)
+
+
+# a product found by GET /products/search, with the relevance of the match (the results are sorted by it, highest first)
+class ProductSearchResult(SQLModel):
+    id: int
+    name: str
+    description: str
+    price: float
+    brand: str
+    category_id: int
+    score: float
+
+
+# a product with its category, when requested with include=category (see app/services/includes.py). the category is
+# only present on the response when it was included
+class ProductWithCategory(SQLModel):
+    id: int
+    name: str
+    description: str
+    price: float
+    brand: str
+    category_id: int
+    category: Category | None = None
\ No newline at end of file
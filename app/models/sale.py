@@ -1,6 +1,10 @@
+from pydantic import field_validator
 from sqlmodel import SQLModel, Field, Relationship
+from sqlalchemy import Index
+import datetime
 from datetime import date
 from typing import TYPE_CHECKING
+from .product import ProductWithCategory
 
 # https://fastapi.tiangolo.com/tutorial/sql-databases/#update-the-app-with-multiple-models
 # https://github.com/fastapi/full-stack-fastapi-template/blob/master/backend/app/models.py
@@ -9,13 +13,59 @@ if TYPE_CHECKING:
     from .product import Product
 
 class Sale(SQLModel, table=True):
+    # indexes for the filters of GET /sales and the dashboard. '(date, id)' also serves the keyset pagination, that orders by
+    # (date desc, id desc). on postgres the table is partitioned by month on 'date' (see app/services/partitions.py)
+    __table_args__ = (
+        Index("ix_sale_product_id_date", "product_id", "date"),
+        Index("ix_sale_date_id", "date", "id"),
+    )
+
     id: int | None = Field(default=None, primary_key=True)
     quantity: int
     total_price: float
     date: date
     
-    # foreign key, every sale must have a product id
-    product_id: int = Field(foreign_key="product.id")
+    # foreign key, every sale must have a product id. the sales are deleted by the database with their product
+    product_id: int = Field(foreign_key="product.id", ondelete="CASCADE")
 
     # we must set the relationship here, this does not create a table, it only works as a helper if you want to do sale.product
-    product: "Product" = Relationship(back_populates="sales")
\ No newline at end of file
+    product: "Product" = Relationship(back_populates="sales")
+
+
+# body of POST /sales. table models are not validated when built from a request body (the date would still be a string),
+# this one is, so a bad sale gets a 422 and the sale is built with 'Sale.model_validate(sale_create)'. there is no id, an
+# id sent by the client is ignored and the database takes the next one of the sequence (on postgres the partitioned table
+# cannot enforce its uniqueness, see app/services/partitions.py)
+class SaleCreate(SQLModel):
+    quantity: int
+    total_price: float
+    date: date
+    product_id: int
+
+
+# body of PUT /sales/{id}, every field is optional and only the ones sent are updated. a field may be left out but not
+# sent as null, the columns are NOT NULL
+class SaleUpdate(SQLModel):
+    quantity: int | None = None
+    total_price: float | None = None
+    # 'datetime.date', a field called 'date' with a default would clash with the 'date' type
+    date: datetime.date | None = None
+    product_id: int | None = None
+
+    @field_validator("quantity", "total_price", "date", "product_id")
+    @classmethod
+    def not_null(cls, value):
+        if value is None:
+            raise ValueError("may be left out, but not null")
+        return value
+
+
+# a sale with its product (and the category of the product), when requested with include=product,product.category
+# (see app/services/includes.py). the related entities are only present on the response when they were included
+class SaleWithProduct(SQLModel):
+    id: int
+    quantity: int
+    total_price: float
+    date: date
+    product_id: int
+    product: ProductWithCategory | None = None
\ No newline at end of file
@@ -0,0 +1,15 @@
+from sqlmodel import SQLModel, Field
+import datetime
+
+# https://fastapi.tiangolo.com/tutorial/sql-databases/#update-the-app-with-multiple-models
+
+# one row per day holding the pre-aggregated totals of the 'sale' table. it is kept in sync by every write path on sales
+# (see app/services/sales_rollup.py) so the dashboard only reads O(days) rows instead of loading every sale.
+class SalesDailyRollup(SQLModel, table=True):
+    __tablename__ = "sales_daily_rollup"
+
+    # annotated as 'datetime.date' because a field called 'date' with a default would clash with the 'date' type
+    date: datetime.date = Field(primary_key=True)
+    total_revenue: float = 0
+    total_quantity: int = 0
+    sales_count: int = 0
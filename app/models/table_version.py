@@ -0,0 +1,12 @@
+from sqlmodel import SQLModel, Field
+
+# https://fastapi.tiangolo.com/tutorial/sql-databases/#update-the-app-with-multiple-models
+
+# one row per table holding a counter that every write path increments in the same transaction as the write (see
+# app/services/table_versions.py). the list and dashboard responses are tagged with the versions of the tables they read,
+# so a client polling them gets a '304 Not Modified' while nothing changed
+class TableVersion(SQLModel, table=True):
+    __tablename__ = "table_version"
+
+    table_name: str = Field(primary_key=True)
+    version: int = 0
@@ -0,0 +1,142 @@
+import os
+from datetime import date
+from typing import Callable
+from sqlalchemy import Table, and_, delete, func, select, true
+from sqlalchemy.sql import ColumnElement
+from sqlmodel import Session
+from app.models.category import Category
+from app.models.product import Product
+from app.models.sale import Sale
+from app.models.sales_rollup import SalesDailyRollup
+from app.services.partitions import drop_partitions_before, partition_range
+from app.services.sales_rollup import apply_sales_deltas, sale_deltas
+from app.services.table_versions import bump_table_versions
+
+# https://docs.sqlalchemy.org/en/20/orm/cascades.html#using-foreign-key-on-delete-cascade-with-orm-relationships
+# https://www.postgresql.org/docs/current/ddl-partitioning.html#DDL-PARTITIONING-OVERVIEW
+# https://docs.sqlalchemy.org/en/20/core/dml.html#sqlalchemy.sql.expression.Delete.returning
+
+""" set based deletes. nothing is loaded into the session: every step is a 'DELETE ... WHERE' over a range of ids, committed
+on its own so the row locks are released between batches (and other writers are not blocked by a big delete).
+
+the sales are deleted with 'DELETE ... RETURNING' and the daily rollup is reduced by the rows the DELETE returned, so a sale
+committed while the delete runs is either deleted and subtracted or kept, never deleted behind the rollup's back.
+
+the children go first: the sales of the deleted products (and of the products of the deleted categories) are removed in
+their own batches. each parent batch then locks its rows, which makes a sale being added to them wait (and then fail on
+its foreign key), and deletes their remaining sales the same way before the parent rows, so the 'ON DELETE CASCADE' of
+the foreign keys has nothing left that the rollup still counts """
+
+# rows deleted (and committed) at a time
+DELETE_BATCH_SIZE = int(os.getenv("DELETE_BATCH_SIZE", "10000"))
+
+# deletes the rows that match the condition in the caller transaction and returns how many were deleted. as 'before_delete'
+# it runs before each batch (with the condition of the batch) and removes its children
+DeleteRows = Callable[[Session, ColumnElement], int]
+
+
+def _batch_boundary(session: Session, table: Table, condition: ColumnElement, batch_size: int) -> int | None:
+    # id of the last row of the next batch, or None when what is left fits in a single batch
+    return session.connection().execute(
+        select(table.c.id).where(condition).order_by(table.c.id).offset(batch_size - 1).limit(1)
+    ).scalar()
+
+
+def _delete_in_batches(session: Session, table: Table, condition: ColumnElement, batch_size: int, delete_rows: DeleteRows | None = None, before_delete: DeleteRows | None = None, cascades_to: tuple = ()) -> dict:
+    deleted = 0
+    batches = 0
+
+    while True:
+        boundary = _batch_boundary(session, table, condition, batch_size)
+        batch = condition if boundary is None else and_(condition, table.c.id <= boundary)
+
+        children = before_delete(session, batch) if before_delete else 0
+        if delete_rows:
+            count = delete_rows(session, batch)
+        else:
+            count = session.connection().execute(delete(table).where(batch)).rowcount
+        deleted += count
+        # the tables reached by the 'ON DELETE CASCADE' may have lost rows too. a batch that deleted nothing keeps the
+        # versions (and so the ETags of the lists and the dashboard)
+        if count or children:
+            bump_table_versions(session, table.name, *cascades_to)
+        session.commit()
+        batches += 1
+
+        if boundary is None:
+            return {"deleted": deleted, "batches": batches}
+
+
+def _delete_sale_rows(session: Session, condition: ColumnElement) -> int:
+    # the returned rows have the attributes sale_deltas reads, they are taken out of the rollup in the same transaction
+    sale = Sale.__table__
+    deleted = session.connection().execute(
+        delete(sale).where(condition).returning(sale.c.date, sale.c.quantity, sale.c.total_price)
+    ).all()
+    apply_sales_deltas(session, sale_deltas(deleted, sign=-1))
+    return len(deleted)
+
+
+def _drop_sale_partitions(session: Session, before: date) -> dict:
+    # every sale of a dropped partition is gone, and so are their days on the rollup. the rollup also gives the number of
+    # rows removed, without counting the partitions
+    connection = session.connection()
+    dropped = drop_partitions_before(connection, before)
+    deleted = 0
+
+    for name in dropped:
+        start, end = partition_range(name)
+        days = and_(SalesDailyRollup.date >= start, SalesDailyRollup.date < end)
+        deleted += connection.execute(select(func.coalesce(func.sum(SalesDailyRollup.sales_count), 0)).where(days)).scalar()
+        connection.execute(delete(SalesDailyRollup).where(days))
+
+    if dropped:
+        bump_table_versions(session, "sale")
+    session.commit()
+    return {"deleted": deleted, "partitions_dropped": dropped}
+
+
+def delete_sales(session: Session, condition: ColumnElement | None = None, drop_before: date | None = None, batch_size: int = DELETE_BATCH_SIZE) -> dict:
+    """ deletes the sales that match 'condition' in batches. 'drop_before' is for deletes that only filter by an end date:
+    on postgres the monthly partitions that end before it are dropped whole first, then the rest is deleted row by row """
+    condition = condition if condition is not None else true()
+    partitions = _drop_sale_partitions(session, drop_before) if drop_before else {"deleted": 0, "partitions_dropped": []}
+
+    result = _delete_in_batches(session, Sale.__table__, condition, batch_size, delete_rows=_delete_sale_rows)
+    return {
+        "deleted": result["deleted"] + partitions["deleted"],
+        "batches": result["batches"],
+        "partitions_dropped": partitions["partitions_dropped"],
+    }
+
+
+def _delete_sales_of_products(session: Session, condition: ColumnElement) -> int:
+    # 'FOR UPDATE' is left out on sqlite, where the first write already locks the whole database
+    session.connection().execute(select(Product.id).where(condition).with_for_update())
+    return _delete_sale_rows(session, Sale.product_id.in_(select(Product.id).where(condition)))
+
+
+def delete_products(session: Session, condition: ColumnElement | None = None, batch_size: int = DELETE_BATCH_SIZE) -> dict:
+    """ deletes the products that match 'condition' and all their sales, in batches """
+    condition = condition if condition is not None else true()
+
+    sales = delete_sales(session, Sale.product_id.in_(select(Product.id).where(condition)), batch_size=batch_size)
+    result = _delete_in_batches(session, Product.__table__, condition, batch_size, before_delete=_delete_sales_of_products, cascades_to=("sale",))
+    return {"deleted": result["deleted"], "batches": result["batches"], "sales_deleted": sales["deleted"]}
+
+
+def _delete_sales_of_categories(session: Session, condition: ColumnElement) -> int:
+    # the categories are locked too, so no product is added to them meanwhile
+    session.connection().execute(select(Category.id).where(condition).with_for_update())
+    return _delete_sales_of_products(session, Product.category_id.in_(select(Category.id).where(condition)))
+
+
+def delete_categories(session: Session, condition: ColumnElement, batch_size: int = DELETE_BATCH_SIZE) -> dict:
+    """ deletes the categories that match 'condition' with their products and the sales of those products """
+    products = delete_products(session, Product.category_id.in_(select(Category.id).where(condition)), batch_size)
+    result = _delete_in_batches(session, Category.__table__, condition, batch_size, before_delete=_delete_sales_of_categories, cascades_to=("product", "sale"))
+    return {
+        "deleted": result["deleted"],
+        "products_deleted": products["deleted"],
+        "sales_deleted": products["sales_deleted"],
+    }
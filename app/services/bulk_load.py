@@ -0,0 +1,151 @@
+import io
+from typing import TYPE_CHECKING, Callable, List, Literal
+from sqlmodel import Session, select
+from sqlalchemy import Column, MetaData, Table, delete, exists, text, true
+from app.services.partitions import ensure_partitions_for_staging, is_partitioned, lock_sale_ids
+from app.services.upsert import upsert_insert
+
+# pandas is only used on the import workers, the api imports this module for LoadMode without loading it
+if TYPE_CHECKING:
+    import pandas as pd
+
+# https://www.postgresql.org/docs/current/sql-copy.html
+# https://www.postgresql.org/docs/current/sql-insert.html#SQL-ON-CONFLICT
+# https://docs.sqlalchemy.org/en/20/dialects/postgresql.html#insert-on-conflict-upsert
+
+""" bulk load engine used by the importers. each batch is loaded in three steps, all inside the caller transaction:
+
+    1. the rows are written to a temporary staging table, with 'COPY FROM STDIN' on postgres (the fastest way to send rows) or
+       with a plain executemany on sqlite, so the importers can be tested locally
+    2. the staging table is merged into the target with 'INSERT ... SELECT ... ON CONFLICT (id)', which skips (mode 'insert')
+       or overwrites (mode 'upsert') the rows that already exist. no id is ever sent as a bind parameter, so the batch size
+       is not limited by the driver parameter limits
+    3. the id sequence is moved past the imported ids, so the next rows created by the api do not collide with them
+
+partitioned tables (sale on postgres) have no unique constraint on the id alone, so 'ON CONFLICT (id)' cannot be used on
+them: 'insert' skips the existing ids with a NOT EXISTS and 'upsert' deletes the existing rows before inserting the batch
+(which also moves a row to another partition when its date changed). the check and the insert are only safe while no other
+writer of sales runs, so the whole batch holds the lock of lock_sale_ids (see app/services/partitions.py) """
+
+LoadMode = Literal["insert", "upsert"]
+
+# called after the rows are staged and before they are merged, used by the importers that must inspect the staged rows
+# (like sales, that update the daily rollup with them). receives the session, the staging table and the load mode
+BeforeMerge = Callable[[Session, Table, LoadMode], None]
+
+
+def _dialect(session: Session) -> str:
+    return session.get_bind().dialect.name
+
+
+def _create_staging_table(session: Session, target: Table, columns: List[str]) -> Table:
+    # the staging table only has the loaded columns, with the same types as the target and without any constraint.
+    # on postgres it is dropped by the database on commit, on sqlite it is dropped by bulk_load
+    staging = Table(
+        f"staging_{target.name}",
+        MetaData(),
+        *[Column(name, target.c[name].type) for name in columns],
+        prefixes=["TEMPORARY"],
+        postgresql_on_commit="DROP",
+    )
+    staging.drop(session.connection(), checkfirst=True)
+    staging.create(session.connection())
+    return staging
+
+
+# the NULL marker of the csv sent to COPY (a text value that is exactly '\N' is read as NULL too)
+COPY_NULL = "\\N"
+
+
+def _copy_into(session: Session, staging: Table, df: "pd.DataFrame"):
+    if _dialect(session) == "postgresql":
+        # the raw psycopg2 connection is used, COPY is not exposed by sqlalchemy. the batch is sent as csv, already bounded
+        # by the importer batch size. the missing values are written as '\N' and read back as NULL with the same marker: by
+        # default COPY reads an unquoted empty field as NULL, and to_csv writes an empty string unquoted, so an empty text
+        # value would fail on a NOT NULL column
+        buffer = io.StringIO()
+        df.to_csv(buffer, header=False, index=False, na_rep=COPY_NULL)
+        buffer.seek(0)
+
+        cursor = session.connection().connection.cursor()
+        cursor.copy_expert(f"COPY {staging.name} ({', '.join(df.columns)}) FROM STDIN WITH (FORMAT csv, NULL '{COPY_NULL}')", buffer)
+        cursor.close()
+    else:
+        session.connection().execute(staging.insert(), df.to_dict(orient="records"))
+
+
+def _merge(session: Session, target: Table, staging: Table, columns: List[str], key: str, mode: LoadMode) -> int:
+    # the 'WHERE true' is required by sqlite to parse an 'INSERT ... SELECT' followed by 'ON CONFLICT'
+    source = select(*[staging.c[name] for name in columns]).where(true())
+    statement = upsert_insert(session, target).from_select(columns, source)
+
+    if mode == "upsert":
+        statement = statement.on_conflict_do_update(
+            index_elements=[target.c[key]],
+            set_={name: statement.excluded[name] for name in columns if name != key},
+        )
+    else:
+        statement = statement.on_conflict_do_nothing(index_elements=[target.c[key]])
+
+    return session.connection().execute(statement).rowcount
+
+
+def _merge_partitioned(session: Session, target: Table, staging: Table, columns: List[str], key: str, mode: LoadMode) -> int:
+    connection = session.connection()
+    source = select(*[staging.c[name] for name in columns])
+
+    if mode == "upsert":
+        connection.execute(delete(target).where(target.c[key].in_(select(staging.c[key]))))
+    else:
+        source = source.where(~exists().where(target.c[key] == staging.c[key]))
+
+    return connection.execute(target.insert().from_select(columns, source)).rowcount
+
+
+def _fix_sequence(session: Session, target: Table, key: str):
+    # sqlite picks the next id from the highest id on the table, only postgres sequences must be moved
+    if _dialect(session) != "postgresql":
+        return
+
+    session.connection().execute(
+        text(f"SELECT setval(pg_get_serial_sequence(:table, :column), COALESCE(MAX({key}), 1)) FROM {target.name}"),
+        {"table": target.name, "column": key},
+    )
+
+
+def bulk_load(session: Session, target: Table, df: "pd.DataFrame", mode: LoadMode = "insert", key: str = "id", before_merge: BeforeMerge | None = None) -> int:
+    """ loads one batch (the DataFrame columns must be columns of 'target', already with the right types) and returns how
+    many rows were inserted or updated. nothing is committed here, the caller commits once per batch """
+    # a key repeated inside the batch would make the merge touch the same row twice, on 'upsert' the last one wins
+    df = df.drop_duplicates(subset=key, keep="last" if mode == "upsert" else "first")
+
+    if df.empty:
+        return 0
+
+    partitioned = is_partitioned(session.connection(), target.name)
+    if partitioned:
+        # the ids are not unique on the partitioned table, the NOT EXISTS / DELETE of the merge only keeps them unique when no
+        # other import or single insert of a sale runs between the check and the commit. taken before the rollup rows of
+        # before_merge are locked, like the single inserts do
+        lock_sale_ids(session.connection())
+
+    columns = list(df.columns)
+    staging = _create_staging_table(session, target, columns)
+
+    _copy_into(session, staging, df)
+
+    if before_merge:
+        before_merge(session, staging, mode)
+
+    if partitioned:
+        # the month partitions of the batch are created before the merge, otherwise the rows would land on the default one
+        ensure_partitions_for_staging(session.connection(), staging)
+        affected = _merge_partitioned(session, target, staging, columns, key, mode)
+    else:
+        affected = _merge(session, target, staging, columns, key, mode)
+    _fix_sequence(session, target, key)
+
+    if _dialect(session) != "postgresql":
+        staging.drop(session.connection())
+
+    return affected
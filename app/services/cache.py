@@ -0,0 +1,121 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable
+from app.services.metrics import CACHE_HITS, CACHE_MISSES, CACHE_EVICTIONS, CACHE_SIZE
+
+# https://docs.python.org/3/library/collections.html#ordereddict-examples-and-recipes
+
+""" in process read-through cache for the lookups by id (GET /products/{id}, /categories/{id}, /sales/{id}). a hit is
+answered from memory, without a database round trip and without taking a connection from the pool.
+
+    - bounded: at most ENTITY_CACHE_SIZE entries per entity, the least recently used one is evicted first
+    - TTL: entries expire after ENTITY_CACHE_TTL seconds, which also bounds how stale a worker can be when it misses an
+      invalidation made by another worker
+    - invalidated by every write path (update, delete and import endpoints) of the worker that made the write. other
+      workers are reached through the invalidation hook (see app/services/cache_sync.py for the postgres implementation)
+
+the cached value is the serialized entity (a dict), never the ORM object, that belongs to the session of one request """
+
+ENTITY_CACHE_SIZE = int(os.getenv("ENTITY_CACHE_SIZE", "10000"))
+ENTITY_CACHE_TTL = float(os.getenv("ENTITY_CACHE_TTL", "60"))
+
+# called with (cache name, key) after a local invalidation, key None means the whole cache was cleared
+InvalidationHook = Callable[[str, Hashable | None], None]
+_invalidation_hook: InvalidationHook | None = None
+
+
+def set_invalidation_hook(hook: InvalidationHook | None):
+    global _invalidation_hook
+    _invalidation_hook = hook
+
+
+class EntityCache:
+    def __init__(self, name: str, max_size: int = ENTITY_CACHE_SIZE, ttl: float = ENTITY_CACHE_TTL):
+        self.name = name
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries: OrderedDict[Hashable, tuple[float, Any]] = OrderedDict()
+        # incremented on every invalidation, a value loaded before an invalidation must not be stored after it
+        self.generation = 0
+        # the imports run on worker processes, but the callback that clears the cache when one ends runs on a thread of the
+        # process pool (see _on_job_done on app/services/import_jobs.py), not on the event loop
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_size > 0 and self.ttl > 0
+
+    def get(self, key: Hashable) -> Any | None:
+        if not self.enabled:
+            return None
+
+        with self._lock:
+            entry = self._entries.get(key)
+
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self._entries[key]
+                CACHE_MISSES.labels(self.name).inc()
+                return None
+
+            self._entries.move_to_end(key)
+
+        CACHE_HITS.labels(self.name).inc()
+        return entry[1]
+
+    def set(self, key: Hashable, value: Any, generation: int | None = None):
+        """ 'generation' is the value of self.generation read before loading the value from the database, if a write
+        invalidated the cache in the meantime the (possibly stale) value is not stored """
+        if not self.enabled:
+            return
+
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return
+
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                CACHE_EVICTIONS.labels(self.name).inc()
+
+            CACHE_SIZE.labels(self.name).set(len(self._entries))
+
+    def invalidate(self, key: Hashable, publish: bool = True):
+        with self._lock:
+            self._entries.pop(key, None)
+            self.generation += 1
+            CACHE_SIZE.labels(self.name).set(len(self._entries))
+
+        if publish and _invalidation_hook:
+            _invalidation_hook(self.name, key)
+
+    def clear(self, publish: bool = True):
+        with self._lock:
+            self._entries.clear()
+            self.generation += 1
+            CACHE_SIZE.labels(self.name).set(0)
+
+        if publish and _invalidation_hook:
+            _invalidation_hook(self.name, None)
+
+
+category_cache = EntityCache("category")
+product_cache = EntityCache("product")
+sale_cache = EntityCache("sale")
+
+caches: Dict[str, EntityCache] = {cache.name: cache for cache in (category_cache, product_cache, sale_cache)}
+
+
+def apply_remote_invalidation(name: str, key: Hashable | None):
+    """ applies an invalidation received from another worker, without publishing it again """
+    cache = caches.get(name)
+    if cache is None:
+        return
+    if key is None:
+        cache.clear(publish=False)
+    else:
+        cache.invalidate(key, publish=False)
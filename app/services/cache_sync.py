@@ -0,0 +1,69 @@
+import asyncio
+import json
+import os
+import asyncpg
+from sqlalchemy.engine import make_url
+from app.services.cache import apply_remote_invalidation, set_invalidation_hook
+
+# https://www.postgresql.org/docs/current/sql-notify.html
+# https://magicstack.github.io/asyncpg/current/api/index.html#asyncpg.connection.Connection.add_listener
+
+""" cross worker invalidation of the entity caches (app/services/cache.py) through postgres LISTEN/NOTIFY. every worker
+keeps one extra connection listening on CACHE_INVALIDATION_CHANNEL, an invalidation made by one worker is sent on the
+channel and applied by all the others. disabled when the variable is not set (or the database is not postgres), then the
+cache TTL is what bounds how long other workers can serve a stale entity """
+
+CACHE_INVALIDATION_CHANNEL = os.getenv("CACHE_INVALIDATION_CHANNEL")
+
+
+class PostgresCacheSync:
+    def __init__(self, database_url: str, channel: str):
+        # asyncpg expects a plain 'postgresql://' dsn, without the sqlalchemy driver name
+        self.dsn = make_url(database_url).set(drivername="postgresql").render_as_string(hide_password=False)
+        self.channel = channel
+        self.connection = None
+        self.queue: asyncio.Queue | None = None
+        self.sender: asyncio.Task | None = None
+        self.loop: asyncio.AbstractEventLoop | None = None
+
+    def _on_notification(self, connection, pid, channel, payload):
+        # notifications sent by this same connection (this worker) were already applied locally
+        if pid == connection.get_server_pid():
+            return
+        message = json.loads(payload)
+        apply_remote_invalidation(message["cache"], message["key"])
+
+    def publish(self, cache_name: str, key):
+        # may be called from the thread pool (importers), the message is handed to the event loop and sent by one task,
+        # an asyncpg connection cannot run two commands at the same time
+        payload = json.dumps({"cache": cache_name, "key": key})
+        self.loop.call_soon_threadsafe(self.queue.put_nowait, payload)
+
+    async def _send_notifications(self):
+        while True:
+            payload = await self.queue.get()
+            try:
+                await self.connection.execute("SELECT pg_notify($1, $2)", self.channel, payload)
+            except Exception as e:
+                print(f"Warning: Could not publish cache invalidation: {e}")
+
+    async def start(self):
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue()
+        self.connection = await asyncpg.connect(self.dsn)
+        await self.connection.add_listener(self.channel, self._on_notification)
+        self.sender = asyncio.create_task(self._send_notifications())
+        set_invalidation_hook(self.publish)
+
+    async def stop(self):
+        set_invalidation_hook(None)
+        if self.sender:
+            self.sender.cancel()
+        if self.connection:
+            await self.connection.close()
+
+
+def create_cache_sync(database_url: str) -> PostgresCacheSync | None:
+    if not CACHE_INVALIDATION_CHANNEL or make_url(database_url).get_backend_name() != "postgresql":
+        return None
+    return PostgresCacheSync(database_url, CACHE_INVALIDATION_CHANNEL)
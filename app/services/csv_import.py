@@ -0,0 +1,179 @@
+import os
+import time
+from typing import TYPE_CHECKING, BinaryIO, Callable, Iterator, List
+from fastapi import HTTPException
+from sqlmodel import Session
+from app.services.bulk_load import LoadMode
+from app.services.import_validation import BatchValidator, ImportSchema, RejectReport
+from app.services.table_versions import bump_table_versions
+
+# pandas takes a good part of the startup time and only the import workers use it, it is imported by the readers when a
+# file is read (the api process only needs check_file)
+if TYPE_CHECKING:
+    import pandas as pd
+
+# https://pandas.pydata.org/docs/user_guide/io.html#iterating-through-files-chunk-by-chunk
+# https://arrow.apache.org/docs/python/generated/pyarrow.parquet.ParquetFile.html#pyarrow.parquet.ParquetFile.iter_batches
+
+# number of csv rows parsed, inserted and committed at a time. the memory used by an import depends only on this value,
+# not on the size of the uploaded file
+IMPORT_BATCH_SIZE = int(os.getenv("IMPORT_BATCH_SIZE", "10000"))
+
+# receives the session, one validated batch and the load mode, loads the rows and returns how many were added (or updated)
+InsertBatch = Callable[[Session, "pd.DataFrame", LoadMode], int]
+
+# called after every committed batch with the progress so far (rows_read, added, rejected, rows_per_second, batches). it may raise
+# ImportCancelled to stop the import, the batches already committed are kept
+OnBatch = Callable[[dict], None]
+
+
+class ImportCancelled(Exception):
+    pass
+
+
+def read_csv_batches(file: BinaryIO, columns: List[str], batch_size: int = IMPORT_BATCH_SIZE):
+    """ yields the csv as DataFrames of at most 'batch_size' rows, indexed by the position of the row on the file (the
+    validation uses it on the reject report). the file is read one chunk at a time, it is never loaded whole in memory """
+    import pandas as pd
+
+    file.seek(0)
+
+    # the index of the chunks continues from one chunk to the next, so it already is the row position
+    for chunk in pd.read_csv(file, usecols=columns, chunksize=batch_size):
+        yield chunk[columns]
+
+
+def _import_pyarrow():
+    # pyarrow is only needed by the parquet / arrow imports, so it is imported when one of them is used
+    try:
+        import pyarrow
+        return pyarrow
+    except ImportError:
+        raise HTTPException(status_code=400, detail="Parquet and Arrow imports are not available, pyarrow is not installed")
+
+
+def _to_frames(record_batches, columns: List[str], batch_size: int) -> Iterator["pd.DataFrame"]:
+    # the columns keep the types of the file (a parquet date column becomes a datetime64 column, not text), so the validation
+    # has nothing to parse. date_as_object=False keeps the dates vectorized instead of one python object per row
+    import pandas as pd
+
+    position = 0
+    for record_batch in record_batches:
+        for offset in range(0, record_batch.num_rows, batch_size):
+            chunk = record_batch.slice(offset, batch_size).select(columns).to_pandas(date_as_object=False)
+            chunk.index = pd.RangeIndex(position, position + len(chunk))
+            position += len(chunk)
+            yield chunk
+
+
+def read_parquet_batches(file: BinaryIO, columns: List[str], batch_size: int = IMPORT_BATCH_SIZE):
+    """ yields a parquet file as DataFrames of at most 'batch_size' rows, reading only the needed columns, one row group
+    at a time """
+    _import_pyarrow()
+    import pyarrow.parquet as parquet
+
+    file.seek(0)
+    parquet_file = parquet.ParquetFile(file)
+    yield from _to_frames(parquet_file.iter_batches(batch_size=batch_size, columns=columns), columns, batch_size)
+
+
+def read_arrow_batches(file: BinaryIO, columns: List[str], batch_size: int = IMPORT_BATCH_SIZE):
+    """ yields an Arrow IPC file (.arrow / .feather v2) or stream (like the '?format=arrow' list responses) as DataFrames
+    of at most 'batch_size' rows """
+    pyarrow = _import_pyarrow()
+
+    file.seek(0)
+    try:
+        reader = pyarrow.ipc.open_file(file)
+        record_batches = (reader.get_batch(index) for index in range(reader.num_record_batches))
+    except pyarrow.ArrowInvalid:
+        # not the file format (it has a footer), try the stream format
+        file.seek(0)
+        record_batches = pyarrow.ipc.open_stream(file)
+
+    yield from _to_frames(record_batches, columns, batch_size)
+
+
+# the file readers by extension, for each endpoint format ('import_csv' and 'import_parquet')
+READERS = {
+    "csv": {".csv": read_csv_batches},
+    "parquet": {".parquet": read_parquet_batches, ".arrow": read_arrow_batches, ".feather": read_arrow_batches},
+}
+
+
+def check_file(file_name: str | None, file_format: str) -> str:
+    """ validates the extension of an upload before it is accepted, returns the extension """
+    extension = os.path.splitext(file_name or "")[1].lower()
+
+    if extension not in READERS[file_format]:
+        if file_format == "csv":
+            raise HTTPException(status_code=400, detail="File Must be a CSV")
+        raise HTTPException(status_code=400, detail="File Must be a Parquet or Arrow file (.parquet, .arrow, .feather)")
+
+    if file_format == "parquet":
+        # checked before the upload is accepted, so a missing pyarrow is not reported as a broken file
+        _import_pyarrow()
+
+    return extension
+
+
+def import_file_in_batches(session: Session, file: BinaryIO, file_name: str, file_format: str, schema: ImportSchema, table_name: str, insert_batch: InsertBatch, mode: LoadMode = "insert", on_batch: OnBatch | None = None):
+    """ validates every batch of the file (see app/services/import_validation.py), runs 'insert_batch' with the valid rows
+    and commits after each one (the id sequence is fixed by the bulk load inside the same transaction). invalid rows go to
+    the reject report and do not stop the import. a failure halfway keeps the batches that were already committed and the
+    error reports how far the import went """
+    extension = check_file(file_name, file_format)
+    frames = READERS[file_format][extension](file, schema.columns)
+    format_name = "CSV" if file_format == "csv" else extension[1:].title()
+
+    validator = BatchValidator(schema)
+    rejects = RejectReport(schema.columns)
+    batches = []
+    rows_read = 0
+    added = 0
+    start = time.perf_counter()
+
+    def progress() -> dict:
+        seconds = time.perf_counter() - start
+        return {
+            "rows_read": rows_read,
+            "added": added,
+            **rejects.summary(),
+            "seconds": round(seconds, 3),
+            "rows_per_second": round(rows_read / seconds) if seconds > 0 else 0,
+        }
+
+    try:
+        for number, df in enumerate(frames, start=1):
+            valid, rejected = validator.validate(session, df)
+            rejects.add(rejected)
+
+            batch_added = insert_batch(session, valid, mode) if not valid.empty else 0
+            if batch_added:
+                # committed with the batch, the ETags of the lists change as soon as its rows are visible
+                bump_table_versions(session, table_name)
+            session.commit()
+
+            rows_read += len(df)
+            added += batch_added
+            batches.append({"batch": number, "rows": len(df), "added": batch_added, "rejected": len(rejected)})
+
+            if on_batch:
+                # a copy of the batches, the job row must see a new list to store it again
+                on_batch({**progress(), "batches": list(batches)})
+
+    except ImportCancelled:
+        raise
+
+    except Exception as e:
+        session.rollback()
+        raise HTTPException(
+            status_code=400,
+            detail={
+                "message": f"Error Reading {format_name}: {str(e)}",
+                "batches_committed": len(batches),
+                **progress(),
+            },
+        )
+
+    return {"mode": mode, **progress(), "batches": batches}
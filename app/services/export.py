@@ -0,0 +1,54 @@
+import csv
+import io
+import json
+import os
+from typing import List, Literal
+from fastapi.responses import StreamingResponse
+from sqlalchemy.ext.asyncio import AsyncEngine
+from app.config.database import async_session_maker
+
+# https://docs.sqlalchemy.org/en/20/orm/queryguide/api.html#fetching-large-result-sets-with-yield-per
+# https://docs.sqlalchemy.org/en/20/orm/extensions/asyncio.html#sqlalchemy.ext.asyncio.AsyncSession.stream
+# https://fastapi.tiangolo.com/advanced/custom-response/#streamingresponse
+
+# rows fetched from the database (and written to the response) at a time
+EXPORT_BATCH_SIZE = int(os.getenv("EXPORT_BATCH_SIZE", "5000"))
+
+ExportFormat = Literal["ndjson", "csv"]
+
+MEDIA_TYPES = {"ndjson": "application/x-ndjson", "csv": "text/csv"}
+
+
+async def _stream_rows(statement, columns: List[str], format: ExportFormat, bind: AsyncEngine | None):
+    """ the query runs with 'stream' + 'yield_per', which opens a server side cursor on postgres, so only one batch of rows
+    is in memory at a time and the first bytes are sent before the whole table is read. the session is opened here (and
+    not received from the route) because it must stay open until the last row is sent """
+    async with async_session_maker(**({"bind": bind} if bind else {})) as session:
+        result = await session.stream(statement.execution_options(yield_per=EXPORT_BATCH_SIZE))
+
+        if format == "csv":
+            # same header and column order expected by the import_csv endpoints
+            buffer = io.StringIO()
+            writer = csv.writer(buffer, lineterminator="\n")
+            writer.writerow(columns)
+
+            async for rows in result.partitions():
+                writer.writerows(rows)
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+
+            yield buffer.getvalue()
+        else:
+            async for rows in result.partitions():
+                yield "".join(json.dumps(dict(zip(columns, row)), default=str) + "\n" for row in rows)
+
+
+def export_response(statement, columns: List[str], format: ExportFormat, name: str, bind: AsyncEngine | None = None) -> StreamingResponse:
+    """ 'statement' must select exactly the given columns (plain columns, no ORM objects are built while exporting).
+    'bind' is the engine to read from (a replica, see read_engine on app/config/database.py), the primary by default """
+    return StreamingResponse(
+        _stream_rows(statement, columns, format, bind),
+        media_type=MEDIA_TYPES[format],
+        headers={"Content-Disposition": f'attachment; filename="{name}.{format}"'},
+    )
@@ -0,0 +1,280 @@
+import asyncio
+import functools
+import multiprocessing
+import os
+import shutil
+import tempfile
+import threading
+import uuid
+from concurrent.futures import Future, ProcessPoolExecutor
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import Dict
+from fastapi import HTTPException, UploadFile
+from fastapi.concurrency import run_in_threadpool
+from sqlmodel import Session, func, select, update
+from sqlmodel.ext.asyncio.session import AsyncSession
+from app.config.database import engine
+from app.models.import_job import ImportJob
+from app.services.bulk_load import LoadMode
+from app.services.cache import caches
+from app.services.csv_import import ImportCancelled, check_file
+from app.services.metrics import observe_import
+
+# https://docs.python.org/3/library/concurrent.futures.html#processpoolexecutor
+# https://docs.python.org/3/library/multiprocessing.html#contexts-and-start-methods
+
+""" background imports. the import endpoints only save the upload to disk (IMPORT_JOBS_DIR), create an 'import_job' row and
+answer right away with the job. the file is parsed, validated and loaded by a pool of IMPORT_WORKERS worker processes, so
+the pandas work never holds the GIL of the api process and the other requests keep their latency during a big import.
+
+the worker updates the job row after every committed batch (rows read, added, rejected, throughput), that is what
+GET /api/imports/{job_id} returns. a cancellation (POST /api/imports/{job_id}/cancel) is seen by the worker after the batch
+it is loading, the batches already committed are kept.
+
+the api process that submitted a job refreshes its 'heartbeat_at' every IMPORT_HEARTBEAT_SECONDS while it is queued or
+running. when that process dies (crash, OOM kill) its jobs stop being refreshed, after IMPORT_JOB_STALE_SECONDS they are
+marked as failed (on the startup of any api worker and before every upload), so they no longer count as pending """
+
+IMPORT_WORKERS = int(os.getenv("IMPORT_WORKERS", "2"))
+# imports queued or running at the same time (on all api workers), more uploads are refused with 429
+IMPORT_MAX_PENDING = int(os.getenv("IMPORT_MAX_PENDING", "20"))
+# the stale timeout must be a few heartbeats long, so a slow database does not fail a job that is still running
+IMPORT_HEARTBEAT_SECONDS = float(os.getenv("IMPORT_HEARTBEAT_SECONDS", "30"))
+IMPORT_JOB_STALE_SECONDS = float(os.getenv("IMPORT_JOB_STALE_SECONDS", "180"))
+IMPORT_JOBS_DIR = Path(os.getenv("IMPORT_JOBS_DIR", os.path.join(tempfile.gettempdir(), "smartmart-import-jobs")))
+
+ACTIVE_STATES = ("queued", "running")
+
+_executor: ProcessPoolExecutor | None = None
+# jobs submitted by this api process that did not finish yet, so a queued job can be taken out of the pool when cancelled
+_futures: Dict[str, Future] = {}
+# the event loop adds and reads the futures, the done callbacks remove them from a thread of the pool
+_futures_lock = threading.Lock()
+_heartbeat: asyncio.Task | None = None
+
+
+def _now() -> datetime:
+    return datetime.now(timezone.utc)
+
+
+def _get_executor() -> ProcessPoolExecutor:
+    global _executor
+    if _executor is None:
+        # 'spawn' starts clean processes, a forked copy of the api would inherit its open connections and event loop
+        _executor = ProcessPoolExecutor(max_workers=IMPORT_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+    return _executor
+
+
+def _touch_jobs(job_ids: list):
+    with Session(engine) as session:
+        session.exec(
+            update(ImportJob)
+            .where(ImportJob.id.in_(job_ids), ImportJob.state.in_(ACTIVE_STATES))
+            .values(heartbeat_at=_now())
+        )
+        session.commit()
+
+
+async def _heartbeat_forever():
+    while True:
+        await asyncio.sleep(IMPORT_HEARTBEAT_SECONDS)
+        with _futures_lock:
+            job_ids = list(_futures)
+        if job_ids:
+            try:
+                await run_in_threadpool(_touch_jobs, job_ids)
+            except Exception as e:
+                # the next heartbeat tries again, the jobs only go stale after a few missed ones
+                print(f"Import jobs heartbeat failed: {e}")
+
+
+def fail_stale_jobs(session: Session) -> int:
+    """ marks as failed the queued and running jobs whose api process stopped refreshing them, returns how many """
+    now = _now()
+    stale = (
+        update(ImportJob)
+        .where(
+            ImportJob.state.in_(ACTIVE_STATES),
+            func.coalesce(ImportJob.heartbeat_at, ImportJob.created_at) < now - timedelta(seconds=IMPORT_JOB_STALE_SECONDS),
+        )
+        .values(state="failed", error="Import abandoned, the api process running it stopped", finished_at=now)
+    )
+    failed = session.exec(stale).rowcount
+    session.commit()
+    return failed
+
+
+async def start_import_workers():
+    """ fails the jobs left behind by a dead api process and starts the heartbeat of the jobs of this one """
+    global _heartbeat
+
+    def fail_on_startup() -> int:
+        with Session(engine) as session:
+            return fail_stale_jobs(session)
+
+    failed = await run_in_threadpool(fail_on_startup)
+    if failed:
+        print(f"{failed} stale import job(s) marked as failed.")
+    _heartbeat = asyncio.create_task(_heartbeat_forever())
+
+
+def shutdown_import_workers():
+    if _heartbeat is not None:
+        _heartbeat.cancel()
+    # the jobs that did not start yet are dropped and marked as failed by their done callback
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+
+
+def _spool(file: UploadFile, path: Path):
+    IMPORT_JOBS_DIR.mkdir(parents=True, exist_ok=True)
+    file.file.seek(0)
+    with open(path, "wb") as spooled:
+        shutil.copyfileobj(file.file, spooled, length=1024 * 1024)
+
+
+async def submit_import(session: AsyncSession, table_name: str, file_format: str, file: UploadFile, mode: LoadMode) -> ImportJob:
+    """ validates the upload, saves it to disk and queues the import, returns the queued job """
+    extension = check_file(file.filename, file_format)
+
+    # the jobs of a dead api process would count forever
+    await session.run_sync(fail_stale_jobs)
+    active = (await session.exec(select(func.count()).select_from(ImportJob).where(ImportJob.state.in_(ACTIVE_STATES)))).one()
+    if active >= IMPORT_MAX_PENDING:
+        raise HTTPException(status_code=429, detail="Too Many Imports in Progress")
+
+    job = ImportJob(id=uuid.uuid4().hex, table_name=table_name, file_name=file.filename, file_format=file_format, mode=mode, heartbeat_at=_now())
+    path = IMPORT_JOBS_DIR / f"{job.id}{extension}"
+
+    # copying a big upload is blocking file io, it runs on the thread pool
+    await run_in_threadpool(_spool, file, path)
+
+    session.add(job)
+    await session.commit()
+
+    future = _get_executor().submit(run_import_job, job.id, str(path))
+    with _futures_lock:
+        _futures[job.id] = future
+    future.add_done_callback(functools.partial(_on_job_done, job.id, table_name, path))
+    return job
+
+
+def _update_job(session: Session, job: ImportJob, **fields):
+    for name, value in fields.items():
+        setattr(job, name, value)
+    session.add(job)
+    session.commit()
+
+
+def _progress_fields(progress: dict) -> dict:
+    return {name: progress[name] for name in ("rows_read", "added", "rejected", "rows_per_second", "reject_report", "batches") if name in progress}
+
+
+def run_import_job(job_id: str, path: str) -> dict:
+    """ runs on a worker process: imports the spooled file and keeps the job row up to date. returns the final counters,
+    used by the api process for the /metrics import series """
+    # imported here, only the worker processes load pandas and the importers
+    from app.services.csv_import import import_file_in_batches
+    from app.services.importers import IMPORTERS
+
+    # two sessions: the job row is committed on its own, independently of the batches of the import
+    with Session(engine) as jobs_session, Session(engine) as session:
+        job = jobs_session.get(ImportJob, job_id)
+
+        # cancelled while it was queued
+        if job is None or job.state != "queued":
+            return {}
+
+        importer = IMPORTERS[job.table_name]
+        _update_job(jobs_session, job, state="running", started_at=_now())
+        progress = {}
+
+        def on_batch(batch_progress: dict):
+            progress.update(batch_progress)
+            # the commit expires the job, reading cancel_requested afterwards loads the value set by the api
+            _update_job(jobs_session, job, **_progress_fields(batch_progress))
+            if job.cancel_requested:
+                raise ImportCancelled()
+
+        state, error = "succeeded", None
+        try:
+            with open(path, "rb") as file:
+                progress.update(import_file_in_batches(
+                    session, file, job.file_name, job.file_format, importer.schema, importer.table_name, importer.insert_batch, job.mode, on_batch,
+                ))
+        except ImportCancelled:
+            state = "cancelled"
+        except HTTPException as e:
+            state = "failed"
+            detail = e.detail
+            if isinstance(detail, dict):
+                progress.update(detail)
+                error = detail["message"]
+            else:
+                error = str(detail)
+        except Exception as e:
+            state, error = "failed", str(e)
+
+        _update_job(jobs_session, job, state=state, error=error, finished_at=_now(), **_progress_fields(progress))
+
+    return {name: progress.get(name, 0) for name in ("rows_read", "added", "rejected", "seconds")}
+
+
+def _finish_job(job_id: str, error: str):
+    # for jobs that the worker could not finish itself (dropped from the pool or the worker process died)
+    with Session(engine) as session:
+        job = session.get(ImportJob, job_id)
+        if job is not None and job.state in ACTIVE_STATES:
+            _update_job(session, job, state="failed", error=error, finished_at=_now())
+
+
+def _on_job_done(job_id: str, table_name: str, path: Path, future: Future):
+    # runs on the api process, on a thread of the pool
+    with _futures_lock:
+        _futures.pop(job_id, None)
+    path.unlink(missing_ok=True)
+
+    # batches may have been committed even when the import failed or was cancelled halfway
+    caches[table_name].clear()
+
+    if future.cancelled():
+        _finish_job(job_id, "Import interrupted before it started")
+        return
+
+    error = future.exception()
+    if error is not None:
+        _finish_job(job_id, f"Import worker failed: {error}")
+        return
+
+    result = future.result()
+    if result:
+        # recorded here, the metrics of the worker processes are never scraped
+        observe_import(table_name, result["rows_read"], result["added"], result["rejected"], result["seconds"])
+
+
+async def cancel_import(session: AsyncSession, job_id: str) -> ImportJob:
+    job = await session.get(ImportJob, job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Import Job Not Found")
+
+    if job.state not in ACTIVE_STATES:
+        return job
+
+    # also set on queued jobs, in case the worker starts it right now
+    job.cancel_requested = True
+    queued = job.state == "queued"
+    if queued:
+        # not started yet: the worker skips it
+        job.state = "cancelled"
+        job.finished_at = _now()
+
+    session.add(job)
+    await session.commit()
+
+    # when it was submitted by this process it is also taken out of the pool
+    with _futures_lock:
+        future = _futures.get(job_id)
+    if queued and future is not None:
+        future.cancel()
+    return job
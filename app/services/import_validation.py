@@ -0,0 +1,187 @@
+import os
+import tempfile
+import time
+import uuid
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import TYPE_CHECKING, Dict, List, Literal, Tuple
+from sqlalchemy import Table, select
+from sqlmodel import Session
+
+# numpy and pandas are imported by the functions that use them (on the import workers), the api only needs the reject
+# report paths from this module and starts faster without them
+if TYPE_CHECKING:
+    import numpy as np
+    import pandas as pd
+
+# https://pandas.pydata.org/docs/reference/api/pandas.to_numeric.html
+# https://pandas.pydata.org/docs/reference/api/pandas.Series.isin.html
+
+""" validation stage of the importers, run on every batch before it is loaded. every check works on whole columns (no python
+loop over the rows), so it costs little next to the load itself:
+
+    - type coercion: ids and quantities must be integers, prices numbers and dates 'YYYY-MM-DD' (typed parquet / arrow
+      columns are used as they are)
+    - missing values and negative quantities / prices
+    - foreign keys: the ids of the parent table are fetched once per import and the batch column is matched against them,
+      so a dangling product_id or category_id is rejected here instead of failing the commit of the whole batch
+
+valid rows go on to the bulk load, invalid ones are written to a reject report (a csv with the row number, the reasons and
+the original values) that can be downloaded from GET /api/imports/rejects/{report_id} """
+
+ColumnType = Literal["int", "float", "str", "date"]
+
+# where the reject reports are written, and for how long they are kept (seconds)
+IMPORT_REJECTS_DIR = Path(os.getenv("IMPORT_REJECTS_DIR", os.path.join(tempfile.gettempdir(), "smartmart-import-rejects")))
+IMPORT_REJECTS_TTL = int(os.getenv("IMPORT_REJECTS_TTL", str(24 * 3600)))
+
+# rejected rows sent on the import response itself, the full list is on the report
+REJECTS_SAMPLE_SIZE = 20
+
+
+@dataclass
+class ImportSchema:
+    """ the columns of an import file with their types, and the checks run on them """
+    types: Dict[str, ColumnType]
+    non_negative: List[str] = field(default_factory=list)
+    # column -> parent table, the column must hold an id of that table
+    foreign_keys: Dict[str, Table] = field(default_factory=dict)
+
+    @property
+    def columns(self) -> List[str]:
+        return list(self.types)
+
+
+def _coerce(values: "pd.Series", column_type: ColumnType) -> Tuple["pd.Series", "pd.Series"]:
+    """ returns the converted column and a mask of the values that could not be converted """
+    import numpy as np
+    import pandas as pd
+
+    if column_type == "str":
+        return values.astype("str"), pd.Series(False, index=values.index)
+
+    if column_type == "date":
+        if not pd.api.types.is_datetime64_any_dtype(values):
+            values = pd.to_datetime(values.astype("str"), format="%Y-%m-%d", errors="coerce")
+        return values, values.isna()
+
+    numbers = pd.to_numeric(values, errors="coerce")
+    invalid = numbers.isna() | np.isinf(numbers)
+    if column_type == "int":
+        invalid |= numbers % 1 != 0
+    return numbers, invalid
+
+
+class BatchValidator:
+    """ validates the batches of one import, the parent ids are fetched on the first batch and reused by the others """
+
+    def __init__(self, schema: ImportSchema):
+        self.schema = schema
+        self.parent_ids: Dict[str, "np.ndarray"] = {}
+
+    def _load_parent_ids(self, session: Session):
+        import numpy as np
+
+        for column, parent in self.schema.foreign_keys.items():
+            if column not in self.parent_ids:
+                ids = session.connection().execute(select(parent.c.id)).scalars().all()
+                self.parent_ids[column] = np.fromiter(ids, dtype="int64", count=len(ids))
+
+    def validate(self, session: Session, df: "pd.DataFrame") -> Tuple["pd.DataFrame", "pd.DataFrame"]:
+        """ returns (valid rows with the final types, rejected rows). the rejected rows keep their original values and get
+        a 'reason' column, like 'quantity: negative; product_id: unknown product' """
+        import pandas as pd
+
+        self._load_parent_ids(session)
+
+        reasons = pd.Series("", index=df.index, dtype="str")
+        converted = {}
+        # values missing or not converted, the other checks skip them (they already have a reason)
+        unusable = {}
+
+        def reject(mask: "pd.Series", reason: str):
+            nonlocal reasons
+            reasons = reasons.mask(mask, reasons + reason + "; ")
+
+        for column, column_type in self.schema.types.items():
+            missing = df[column].isna()
+            values, invalid = _coerce(df[column], column_type)
+            reject(missing, f"{column}: missing")
+            reject(invalid & ~missing, f"{column}: invalid {column_type}")
+            converted[column] = values
+            unusable[column] = missing | invalid
+
+        for column in self.schema.non_negative:
+            reject(converted[column] < 0, f"{column}: negative")
+
+        for column, parent in self.schema.foreign_keys.items():
+            values = converted[column]
+            reject(~unusable[column] & ~values.isin(self.parent_ids[column]), f"{column}: unknown {parent.name}")
+
+        rejected = reasons != ""
+        valid = pd.DataFrame(converted)[~rejected]
+
+        # final types of the valid rows, the dates go to the database as python dates
+        for column, column_type in self.schema.types.items():
+            if column_type == "int":
+                valid[column] = valid[column].astype("int64")
+            elif column_type == "float":
+                valid[column] = valid[column].astype("float64")
+            elif column_type == "date":
+                valid[column] = valid[column].dt.date
+
+        rejected_rows = df[rejected].assign(reason=reasons[rejected].str.rstrip("; "))
+        return valid, rejected_rows
+
+
+class RejectReport:
+    """ csv file with the rejected rows of one import, written batch by batch so it never has to fit in memory. the 'row'
+    column is the position of the row on the file, starting at 1 (the csv header is not counted) """
+
+    def __init__(self, columns: List[str]):
+        self.columns = columns
+        self.report_id = uuid.uuid4().hex
+        self.path = IMPORT_REJECTS_DIR / f"{self.report_id}.csv"
+        self.count = 0
+        self.sample = []
+
+    def add(self, rejected: "pd.DataFrame"):
+        if rejected.empty:
+            return
+
+        rows = rejected.assign(row=rejected.index + 1)[["row", "reason", *self.columns]]
+
+        if self.count == 0:
+            IMPORT_REJECTS_DIR.mkdir(parents=True, exist_ok=True)
+            _remove_expired_reports()
+
+        rows.to_csv(self.path, mode="a", header=self.count == 0, index=False)
+        self.count += len(rows)
+
+        missing = REJECTS_SAMPLE_SIZE - len(self.sample)
+        if missing > 0:
+            self.sample.extend({"row": int(row), "reason": reason} for row, reason in zip(rows["row"][:missing], rows["reason"][:missing]))
+
+    def summary(self) -> dict:
+        return {
+            "rejected": self.count,
+            "rejects_sample": self.sample,
+            "reject_report": f"/api/imports/rejects/{self.report_id}" if self.count else None,
+        }
+
+
+def reject_report_path(report_id: uuid.UUID) -> Path | None:
+    # the id is parsed as an uuid by the route, so it can not point outside of the reports directory
+    path = IMPORT_REJECTS_DIR / f"{report_id.hex}.csv"
+    return path if path.exists() else None
+
+
+def _remove_expired_reports():
+    expired = time.time() - IMPORT_REJECTS_TTL
+    for path in IMPORT_REJECTS_DIR.glob("*.csv"):
+        try:
+            if path.stat().st_mtime < expired:
+                path.unlink()
+        except FileNotFoundError:
+            # removed by another worker at the same time
+            pass
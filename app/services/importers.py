@@ -0,0 +1,68 @@
+from dataclasses import dataclass
+import pandas as pd
+from sqlmodel import Session
+from app.models.category import Category
+from app.models.product import Product
+from app.models.sale import Sale
+from app.services.bulk_load import bulk_load, LoadMode
+from app.services.csv_import import InsertBatch
+from app.services.import_validation import ImportSchema
+from app.services.sales_rollup import apply_staged_sales
+
+""" what is needed to import each table: the columns of the file with their checks and how a validated batch is loaded.
+used by the background import workers (app/services/import_jobs.py), only they load this module """
+
+
+def _insert_categories_batch(session: Session, df: pd.DataFrame, mode: LoadMode) -> int:
+    # the batch goes through the bulk load engine (staging table + 'ON CONFLICT (id)'), so the ids that already exist are
+    # skipped (or updated) by the database instead of being searched one by one
+    return bulk_load(session, Category.__table__, df, mode)
+
+
+def _insert_products_batch(session: Session, df: pd.DataFrame, mode: LoadMode) -> int:
+    return bulk_load(session, Product.__table__, df, mode)
+
+
+def _insert_sales_batch(session: Session, df: pd.DataFrame, mode: LoadMode) -> int:
+    # the daily rollup is updated from the staged rows before they are merged, inside the same transaction
+    return bulk_load(session, Sale.__table__, df, mode, before_merge=apply_staged_sales)
+
+
+@dataclass
+class Importer:
+    table_name: str
+    schema: ImportSchema
+    insert_batch: InsertBatch
+
+
+IMPORTERS = {
+    importer.table_name: importer
+    for importer in (
+        Importer(
+            "category",
+            ImportSchema(types={'id': 'int', 'name': 'str'}),
+            _insert_categories_batch,
+        ),
+        # a product with a category that does not exist is rejected (and shows up on the reject report)
+        Importer(
+            "product",
+            ImportSchema(
+                types={'id': 'int', 'name': 'str', 'description': 'str', 'price': 'float', 'brand': 'str', 'category_id': 'int'},
+                non_negative=['price'],
+                foreign_keys={'category_id': Category.__table__},
+            ),
+            _insert_products_batch,
+        ),
+        # the dates are parsed for the whole batch at once, a sale with an invalid date, a negative value or a product that
+        # does not exist is rejected
+        Importer(
+            "sale",
+            ImportSchema(
+                types={'id': 'int', 'product_id': 'int', 'quantity': 'int', 'total_price': 'float', 'date': 'date'},
+                non_negative=['quantity', 'total_price'],
+                foreign_keys={'product_id': Product.__table__},
+            ),
+            _insert_sales_batch,
+        ),
+    )
+}
@@ -0,0 +1,86 @@
+from typing import Dict, List, Tuple
+from fastapi import HTTPException
+from sqlalchemy import inspect, select
+from sqlmodel import SQLModel
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+# https://docs.sqlalchemy.org/en/20/orm/queryguide/relationships.html#select-in-loading
+# https://jsonapi.org/format/#fetching-includes
+
+""" opt-in loading of the related entities of a response ('?include=product,product.category' on the sales), so a client
+does not request the product and the category of every row one by one (an N+1 over http).
+
+the related rows are loaded the way sqlalchemy 'selectinload' does it, one 'WHERE id IN (...)' query per level of the
+include for the whole page, so a page costs the same number of queries whatever its size. it runs over the plain dicts of
+the list (built from the selected columns, no ORM instance is created, see app/services/list_formats.py), and each
+related entity is nested under the name of its relationship on the model ('sale.product.category').
+
+only many-to-one relationships can be included (a sale has one product, a product has one category) """
+
+# the includes accepted by each endpoint, paths of relationship names of the models
+SALE_INCLUDES = ("product", "product.category")
+PRODUCT_INCLUDES = ("category",)
+
+
+def _relationship(model: type[SQLModel], name: str) -> Tuple[type[SQLModel], str]:
+    # the related model and the foreign key column that points to it, read from the relationship of the model
+    relationship = inspect(model).relationships[name]
+    (foreign_key,) = relationship.local_columns
+    return relationship.mapper.class_, foreign_key.name
+
+
+def include_tables(model: type[SQLModel], allowed: Tuple[str, ...]) -> Dict[str, str]:
+    """ the table read by each include, the ETag of a response depends on them too (see app/services/table_versions.py) """
+    tables = {}
+    for path in allowed:
+        current = model
+        for name in path.split("."):
+            current, _ = _relationship(current, name)
+        tables[path] = current.__tablename__
+    return tables
+
+
+def parse_includes(include: str | None, allowed: Tuple[str, ...], format: str = "json") -> List[str]:
+    """ validates '?include=', returns the paths to load, parents first ('product.category' also loads 'product') """
+    if not include:
+        return []
+
+    paths = {path.strip() for path in include.split(",") if path.strip()}
+    invalid = paths - set(allowed)
+    if invalid:
+        raise HTTPException(status_code=400, detail=f"Invalid Include: {', '.join(sorted(invalid))} (allowed: {', '.join(allowed)})")
+
+    if format != "json":
+        raise HTTPException(status_code=400, detail="Include is Only Available on the JSON Format")
+
+    for path in list(paths):
+        parts = path.split(".")
+        paths.update(".".join(parts[:depth]) for depth in range(1, len(parts)))
+
+    return sorted(paths, key=lambda path: path.count("."))
+
+
+async def load_related(session: AsyncSession, model: type[SQLModel], items: List[dict], paths: List[str]):
+    """ nests the related entities of 'paths' into the given dicts of 'model', in place, one query per path """
+    # the dicts of each path, the parents of the next level
+    loaded = {"": items}
+
+    for path in paths:
+        parent_path, _, name = path.rpartition(".")
+        parents = [parent for parent in loaded[parent_path] if parent is not None]
+
+        parent_model = model
+        for parent_name in filter(None, parent_path.split(".")):
+            parent_model, _ = _relationship(parent_model, parent_name)
+        related_model, foreign_key = _relationship(parent_model, name)
+
+        ids = {parent[foreign_key] for parent in parents if parent[foreign_key] is not None}
+        related = {}
+        if ids:
+            table = related_model.__table__
+            rows = (await session.exec(select(*table.c).where(table.c.id.in_(ids)))).all()
+            related = {row.id: row._asdict() for row in rows}
+
+        for parent in parents:
+            parent[name] = related.get(parent[foreign_key])
+        loaded[path] = list(related.values())
@@ -0,0 +1,99 @@
+import os
+from datetime import date
+from typing import List, Literal
+import orjson
+from fastapi import HTTPException, Response
+from sqlalchemy import Column
+from app.services.pagination import MAX_PAGE_SIZE
+
+# https://github.com/ijl/orjson
+# https://arrow.apache.org/docs/format/Columnar.html#ipc-streaming-format
+# https://arrow.apache.org/docs/python/ipc.html
+
+""" response formats of the list endpoints (GET /sales, /products and /categories), chosen with '?format=':
+
+    - json (default): the same body as the response_model (Page), but built straight from the query result tuples and
+      serialized with orjson. no ORM instance is created and no pydantic validation runs, that was most of the cpu time of
+      a big page
+    - columnar: json with one array per field ({"columns": {"id": [...], "date": [...]}, ...}), the field names are sent
+      once instead of once per row, so the payload is a lot smaller and charts can use the arrays as they are
+    - arrow: an Arrow IPC stream (binary, typed, read with pyarrow / arrow js / polars without any parsing). the cursor of
+      the next page goes on the 'X-Next-Cursor' header
+
+the columnar formats accept pages up to MAX_COLUMNAR_PAGE_SIZE rows, for the dashboards that read big windows of sales """
+
+ListFormat = Literal["json", "columnar", "arrow"]
+
+ARROW_MEDIA_TYPE = "application/vnd.apache.arrow.stream"
+
+MAX_COLUMNAR_PAGE_SIZE = int(os.getenv("MAX_COLUMNAR_PAGE_SIZE", "100000"))
+
+# documents the extra content types of the list endpoints on /docs
+LIST_RESPONSES = {200: {"content": {ARROW_MEDIA_TYPE: {}}, "description": "Page of items, in the requested format"}}
+
+
+def max_page_size(format: ListFormat) -> int:
+    return MAX_PAGE_SIZE if format == "json" else MAX_COLUMNAR_PAGE_SIZE
+
+
+def check_page_size(limit: int, format: ListFormat):
+    if limit > max_page_size(format):
+        raise HTTPException(
+            status_code=400,
+            detail=f"limit must be at most {max_page_size(format)} for format '{format}', use format 'columnar' or 'arrow' for bigger pages",
+        )
+
+
+def _arrow_type(column: Column):
+    import pyarrow as pa
+
+    python_type = column.type.python_type
+    if python_type is int:
+        return pa.int64()
+    if python_type is float:
+        return pa.float64()
+    if python_type is date:
+        return pa.date32()
+    return pa.string()
+
+
+def _arrow_response(columns: List[Column], values: List[tuple], next_cursor: str | None) -> Response:
+    # pyarrow is heavy and only needed by this format, so it is imported on the first arrow request
+    try:
+        import pyarrow as pa
+    except ImportError:
+        raise HTTPException(status_code=406, detail="Arrow format is not available, pyarrow is not installed")
+
+    table = pa.table({column.name: pa.array(column_values, type=_arrow_type(column)) for column, column_values in zip(columns, values)})
+
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+
+    headers = {"X-Next-Cursor": next_cursor} if next_cursor else {}
+    return Response(sink.getvalue().to_pybytes(), media_type=ARROW_MEDIA_TYPE, headers=headers)
+
+
+def json_page_response(items: List[dict], next_cursor: str | None) -> Response:
+    # same body as the Page response_model, for items that are already dicts (like the ones with their includes)
+    return Response(orjson.dumps({"items": items, "next_cursor": next_cursor}), media_type="application/json")
+
+
+def list_response(page: dict, columns: List[Column], format: ListFormat) -> Response:
+    """ builds the response of a page returned by 'paginate' for a query that selects 'columns' (not ORM entities) """
+    rows = page["items"]
+    next_cursor = page["next_cursor"]
+    # str(): the columns of a subquery are named with a str subclass, that orjson does not accept as a key
+    names = [str(column.name) for column in columns]
+
+    if format == "json":
+        return json_page_response([dict(zip(names, row)) for row in rows], next_cursor)
+
+    # rows -> columns, a single pass over the result
+    values = list(zip(*rows)) if rows else [() for _ in columns]
+
+    if format == "arrow":
+        return _arrow_response(columns, values, next_cursor)
+
+    content = {"columns": dict(zip(names, values)), "count": len(rows), "next_cursor": next_cursor}
+    return Response(orjson.dumps(content), media_type="application/json")
@@ -0,0 +1,127 @@
+import time
+from prometheus_client import Counter, Gauge, Histogram, REGISTRY
+from prometheus_client.core import GaugeMetricFamily
+from sqlalchemy.pool import QueuePool, AsyncAdaptedQueuePool
+
+# https://prometheus.github.io/client_python/
+# https://prometheus.io/docs/practices/histograms/
+
+""" every metric exposed on GET /metrics is declared here, so the names and labels stay in a single place. metrics are kept
+per process: with many workers, each worker must be scraped (or PROMETHEUS_MULTIPROC_DIR must be set, see the
+prometheus_client docs) """
+
+# latency buckets from 5ms to 30s, the api has both very fast lookups and long csv imports
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+REQUEST_LATENCY = Histogram(
+    "http_request_duration_seconds", "Time to answer a request, by route template",
+    ["method", "route", "status"], buckets=LATENCY_BUCKETS,
+)
+REQUEST_DB_TIME = Histogram(
+    "http_request_db_duration_seconds", "Time spent on database queries per request",
+    ["method", "route"], buckets=LATENCY_BUCKETS,
+)
+# a route that runs a number of queries that grows with the response size is an N+1
+REQUEST_DB_QUERIES = Histogram(
+    "http_request_db_queries", "Number of database queries per request",
+    ["method", "route"], buckets=(0, 1, 2, 3, 5, 10, 25, 50, 100, 250),
+)
+
+POOL_CHECKOUT_WAIT = Histogram(
+    "db_pool_checkout_wait_seconds", "Time waited for a free connection of the pool",
+    ["engine"], buckets=(0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 30),
+)
+
+IMPORT_ROWS = Counter("import_rows_total", "Rows added (or updated) by the import endpoints", ["table"])
+IMPORT_ROWS_REJECTED = Counter("import_rows_rejected_total", "Rows rejected by the import validation", ["table"])
+IMPORT_ROWS_PER_SECOND = Histogram(
+    "import_rows_per_second", "Rows read per second by each finished import",
+    ["table"], buckets=(100, 1000, 5000, 10000, 25000, 50000, 100000, 250000, 500000),
+)
+
+# micro batching of POST /sales/ (see app/services/sale_batcher.py)
+SALE_BATCH_ROWS = Histogram(
+    "sale_batch_rows", "Sales saved by each batched insert",
+    buckets=(1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500),
+)
+SALE_BATCH_WAIT = Histogram(
+    "sale_batch_wait_seconds", "Time the first sale of a batch waited for the batch to fill",
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1),
+)
+SALE_QUEUE_REJECTED = Counter("sale_queue_rejected_total", "Sales refused with a 503 because the batching queue was full")
+
+# profiles kept on the buffer of GET /admin/profiles (see app/services/profiler.py)
+PROFILES_CAPTURED = Counter("profiles_captured_total", "Request profiles kept on the buffer, requested or slower than PROFILE_SLOW_MS", ["reason"])
+
+# time from the first import of app.main until the worker is ready (schema verified and pool warmed), by phase
+STARTUP_SECONDS = Gauge("app_startup_seconds", "Time the worker took to start, by phase", ["phase"])
+
+# where the read-only routes ran their queries: 'replica' or 'primary' (no healthy replica, or the client asked for it)
+READ_ROUTING = Counter("db_read_routing_total", "Read-only requests by the database that answered them", ["target"])
+REPLICA_HEALTHY = Gauge("db_replica_healthy", "Whether the read replica passed its last health check", ["replica"])
+REPLICA_LAG = Gauge("db_replica_lag_seconds", "Replication lag of the read replica on its last health check", ["replica"])
+
+CACHE_HITS = Counter("entity_cache_hits_total", "Lookups answered by the entity cache", ["cache"])
+CACHE_MISSES = Counter("entity_cache_misses_total", "Lookups that went to the database", ["cache"])
+CACHE_EVICTIONS = Counter("entity_cache_evictions_total", "Entries evicted because the cache was full", ["cache"])
+CACHE_SIZE = Gauge("entity_cache_entries", "Entries currently in the entity cache", ["cache"])
+
+
+def observe_import(table: str, rows_read: int, added: int, rejected: int, seconds: float) -> float:
+    """ records a finished import and returns its throughput in rows read per second """
+    rows_per_second = rows_read / seconds if seconds > 0 else 0
+    IMPORT_ROWS.labels(table).inc(added)
+    IMPORT_ROWS_REJECTED.labels(table).inc(rejected)
+    IMPORT_ROWS_PER_SECOND.labels(table).observe(rows_per_second)
+    return rows_per_second
+
+
+class _TimedCheckout:
+    # measures how long '_do_get' (the method that waits on the pool queue for a free connection) takes
+    engine_label = "default"
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            POOL_CHECKOUT_WAIT.labels(self.engine_label).observe(time.perf_counter() - start)
+
+
+def instrumented_pool_class(engine_label: str, is_async: bool):
+    """ returns the pool class to pass as 'poolclass' to the engine. a class (and not a pool instance) is needed because the
+    engine creates a new pool every time it is disposed """
+    base = AsyncAdaptedQueuePool if is_async else QueuePool
+    return type(f"Instrumented{base.__name__}", (_TimedCheckout, base), {"engine_label": engine_label})
+
+
+class PoolCollector:
+    """ reads the pool state of the registered engines on every scrape, so nothing is updated on the request path """
+
+    def __init__(self):
+        self.engines = {}
+
+    def register(self, name: str, engine):
+        self.engines[name] = engine
+
+    def collect(self):
+        size = GaugeMetricFamily("db_pool_size", "Connections kept open by the pool", labels=["engine"])
+        checked_out = GaugeMetricFamily("db_pool_checked_out", "Connections currently in use", labels=["engine"])
+        overflow = GaugeMetricFamily("db_pool_overflow", "Connections open above the pool size", labels=["engine"])
+
+        for name, engine in self.engines.items():
+            pool = engine.pool
+            # only queue pools have a size, sqlite pools are skipped
+            if not isinstance(pool, QueuePool):
+                continue
+            size.add_metric([name], pool.size())
+            checked_out.add_metric([name], pool.checkedout())
+            overflow.add_metric([name], max(pool.overflow(), 0))
+
+        yield size
+        yield checked_out
+        yield overflow
+
+
+pool_collector = PoolCollector()
+REGISTRY.register(pool_collector)
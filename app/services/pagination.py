@@ -0,0 +1,40 @@
+import base64
+import json
+from typing import Any, Callable, List
+from fastapi import HTTPException
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+# https://use-the-index-luke.com/no-offset
+
+""" keyset (cursor) pagination: instead of 'OFFSET n', that makes the database read and throw away n rows, every page
+continues from the sort key of the last row of the previous page ('WHERE key > last_key ORDER BY key LIMIT n'). with an
+index on the sort key every page costs the same, however deep the client is. the cursor sent to the client is opaque,
+it is only the last sort key encoded as base64 json """
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+
+def encode_cursor(values: List[Any]) -> str:
+    raw = json.dumps(values, default=str, separators=(",", ":"))
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> List[Any]:
+    try:
+        padding = "=" * (-len(cursor) % 4)
+        values = json.loads(base64.urlsafe_b64decode(cursor + padding))
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid Cursor")
+
+    if not isinstance(values, list):
+        raise HTTPException(status_code=400, detail="Invalid Cursor")
+    return values
+
+
+async def paginate(session: AsyncSession, query, limit: int, cursor_of: Callable[[Any], List[Any]]):
+    """ runs a query that is already filtered by the cursor and sorted by the keyset, one extra row is fetched only to know
+    if there is a next page. 'cursor_of' returns the sort key of a row """
+    rows = (await session.exec(query.limit(limit + 1))).all()
+    next_cursor = encode_cursor(cursor_of(rows[limit - 1])) if len(rows) > limit else None
+    return {"items": rows[:limit], "next_cursor": next_cursor}
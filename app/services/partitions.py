@@ -0,0 +1,285 @@
+import os
+from datetime import date
+from typing import List, Tuple
+from sqlalchemy import inspect, text
+from sqlalchemy.engine import Connection
+from sqlmodel import SQLModel
+from app.models.sale import Sale
+
+# https://www.postgresql.org/docs/current/ddl-partitioning.html
+
+""" on postgres the 'sale' table is range partitioned by month on 'date' (one child table per month, like sale_y2024m05,
+plus a default partition for rows outside of every range). queries filtered by a date range only read the partitions of
+that range, and old data is removed by dropping whole partitions instead of deleting row by row.
+
+a partitioned table cannot have a unique constraint that does not include the partition key, so the primary key of the
+table is (id, date) and postgres does not stop two sales with the same id on different dates. the ORM still maps 'id'
+alone as the primary key, the app keeps it unique:
+
+    - POST /sales never takes the id from the client, it always comes from the sequence
+    - the imports (the only writes with ids chosen by the client) take the lock of lock_sale_ids for the whole merge, so
+      two imports never insert the same id, and the single inserts take it in shared mode, so an id the sequence handed
+      out is committed before an import checks it (and the sequence is moved past the imported ids before they release it)
+
+sqlite has no partitioning, there the table is created by create_all as usual and 'id' is its primary key """
+
+# future monthly partitions kept ready, created at startup and by 'python -m app.cli ensure-partitions'
+SALE_PARTITIONS_AHEAD = int(os.getenv("SALE_PARTITIONS_AHEAD", "3"))
+
+# tables that are partitioned on postgres and their partition key
+PARTITION_KEYS = {"sale": "date"}
+
+# any number works, it only has to be the same on every worker. the same lock serializes the partition ddl and the
+# imports of sales
+PARTITION_LOCK_ID = 4711
+
+SALE_COLUMNS = "id, quantity, total_price, date, product_id"
+
+SALE_PARTITIONED_DDL = """
+CREATE TABLE sale (
+    id INTEGER NOT NULL DEFAULT nextval('sale_id_seq'),
+    quantity INTEGER NOT NULL,
+    total_price FLOAT NOT NULL,
+    date DATE NOT NULL,
+    product_id INTEGER NOT NULL REFERENCES product (id) ON DELETE CASCADE,
+    PRIMARY KEY (id, date)
+) PARTITION BY RANGE (date)
+"""
+
+
+def is_postgres(conn: Connection) -> bool:
+    return conn.dialect.name == "postgresql"
+
+
+def is_partitioned(conn: Connection, table_name: str) -> bool:
+    if not is_postgres(conn):
+        return False
+    return conn.execute(
+        text("SELECT EXISTS (SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass(:table))"),
+        {"table": table_name},
+    ).scalar()
+
+
+def _month_start(day: date) -> date:
+    return day.replace(day=1)
+
+
+def _next_month(day: date) -> date:
+    return date(day.year + day.month // 12, day.month % 12 + 1, 1)
+
+
+def partition_name(month: date) -> str:
+    return f"sale_y{month.year}m{month.month:02d}"
+
+
+def partition_range(name: str) -> Tuple[date, date]:
+    # 'sale_y2024m05' -> (2024-05-01, 2024-06-01), the end is exclusive
+    month = date(int(name[6:10]), int(name[11:13]), 1)
+    return month, _next_month(month)
+
+
+def _months(start: date, end: date) -> List[date]:
+    months = []
+    month = _month_start(start)
+    while month <= end:
+        months.append(month)
+        month = _next_month(month)
+    return months
+
+
+def _existing_partitions(conn: Connection) -> set:
+    rows = conn.execute(text("SELECT inhrelid::regclass::text FROM pg_inherits WHERE inhparent = 'sale'::regclass"))
+    return {row[0] for row in rows}
+
+
+def _lock(conn: Connection):
+    # serializes the partition ddl between workers (and the cli), released when the transaction ends
+    conn.execute(text("SELECT pg_advisory_xact_lock(:id)"), {"id": PARTITION_LOCK_ID})
+
+
+def lock_sale_ids(conn: Connection, shared: bool = False):
+    """ taken before writing sales on postgres, until the end of the transaction: exclusive by the imports (ids chosen by
+    the client, checked against the table before the insert), shared by the inserts that take the id from the sequence.
+    it must be the first lock of the transaction, the imports and the inserts update the same rollup rows after it """
+    if not is_postgres(conn):
+        return
+    function = "pg_advisory_xact_lock_shared" if shared else "pg_advisory_xact_lock"
+    conn.execute(text(f"SELECT {function}(:id)"), {"id": PARTITION_LOCK_ID})
+
+
+def ensure_partitions(conn: Connection, start: date, end: date) -> List[str]:
+    """ creates the monthly partitions that cover [start, end] and do not exist yet, and returns their names. rows of those
+    months already sitting in the default partition are moved to the new partition (postgres refuses to attach a range
+    while the default partition has rows of it) """
+    if not is_partitioned(conn, "sale"):
+        return []
+
+    months = _months(start, end)
+    if all(partition_name(month) in _existing_partitions(conn) for month in months):
+        return []
+
+    # only taken when something is missing (the import batches call this too), then the list is read again because another
+    # worker may have created the partitions while we waited for the lock
+    _lock(conn)
+    existing = _existing_partitions(conn)
+    created = []
+
+    for month in months:
+        name = partition_name(month)
+        if name in existing:
+            continue
+
+        bounds = {"start": month, "end": _next_month(month)}
+        conn.execute(text(f"CREATE TABLE {name} (LIKE sale INCLUDING DEFAULTS INCLUDING CONSTRAINTS)"))
+        conn.execute(text(f"INSERT INTO {name} ({SALE_COLUMNS}) SELECT {SALE_COLUMNS} FROM sale_default WHERE date >= :start AND date < :end"), bounds)
+        conn.execute(text("DELETE FROM sale_default WHERE date >= :start AND date < :end"), bounds)
+        conn.execute(text(f"ALTER TABLE sale ATTACH PARTITION {name} FOR VALUES FROM ('{month}') TO ('{_next_month(month)}')"))
+        created.append(name)
+
+    return created
+
+
+def ensure_future_partitions(conn: Connection, months_ahead: int = SALE_PARTITIONS_AHEAD) -> List[str]:
+    today = date.today()
+    end = today
+    for _ in range(months_ahead):
+        end = _next_month(end)
+    return ensure_partitions(conn, today, end)
+
+
+def ensure_partitions_for_staging(conn: Connection, staging) -> List[str]:
+    """ used by the bulk load before merging a batch, so imported rows go to their month partition and not to the default """
+    first, last = conn.execute(text(f"SELECT MIN(date), MAX(date) FROM {staging.name}")).one()
+    if first is None:
+        return []
+    return ensure_partitions(conn, first, last)
+
+
+def create_indexes(conn: Connection):
+    # the indexes declared on the models (see __table_args__), created only when missing. on a partitioned table the index
+    # is created on every partition
+    from app.models.product import Product
+
+    for table in (Product.__table__, Sale.__table__):
+        for index in table.indexes:
+            index.create(conn, checkfirst=True)
+
+
+def add_missing_columns(conn: Connection) -> List[str]:
+    """ create_all does not change existing tables, the nullable columns added to the models later are added here. returns
+    the added columns """
+    added = []
+    inspector = inspect(conn)
+    for table in SQLModel.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        existing = {column["name"] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing or not column.nullable:
+                continue
+            column_type = column.type.compile(dialect=conn.dialect)
+            conn.execute(text(f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}'))
+            added.append(f"{table.name}.{column.name}")
+    return added
+
+
+def cascade_foreign_keys(conn: Connection) -> List[str]:
+    """ databases created before the foreign keys had 'ON DELETE CASCADE' keep the old constraints (create_all does not
+    change existing tables), this replaces them. returns the updated columns. sqlite cannot alter a constraint, there the old
+    tables keep working because app/services/bulk_delete.py removes the children explicitly """
+    if not is_postgres(conn):
+        return []
+
+    updated = []
+    for table in SQLModel.metadata.sorted_tables:
+        for foreign_key in table.foreign_keys:
+            if foreign_key.ondelete != "CASCADE":
+                continue
+
+            column, parent = foreign_key.parent.name, foreign_key.column.table.name
+            names = conn.execute(
+                text("""
+                    SELECT constraint_def.conname FROM pg_constraint constraint_def
+                    JOIN pg_attribute attribute ON attribute.attrelid = constraint_def.conrelid AND attribute.attnum = ANY (constraint_def.conkey)
+                    WHERE constraint_def.conrelid = to_regclass(:table) AND constraint_def.contype = 'f'
+                    AND constraint_def.confdeltype <> 'c' AND attribute.attname = :column
+                """),
+                {"table": table.name, "column": column},
+            ).scalars().all()
+
+            for name in names:
+                # the new constraint validates the existing rows, the table is locked while it runs
+                conn.execute(text(f"ALTER TABLE {table.name} DROP CONSTRAINT {name}"))
+                conn.execute(text(f"ALTER TABLE {table.name} ADD CONSTRAINT {name} FOREIGN KEY ({column}) REFERENCES {parent} (id) ON DELETE CASCADE"))
+                updated.append(f"{table.name}.{column}")
+
+    return updated
+
+
+def create_partitioned_sale_table(conn: Connection):
+    conn.execute(text("CREATE SEQUENCE IF NOT EXISTS sale_id_seq"))
+    conn.execute(text(SALE_PARTITIONED_DDL))
+    conn.execute(text("ALTER SEQUENCE sale_id_seq OWNED BY sale.id"))
+    conn.execute(text("CREATE TABLE sale_default PARTITION OF sale DEFAULT"))
+
+
+def create_sale_table(conn: Connection):
+    """ creates the partitioned 'sale' table when it does not exist yet (used instead of create_all for this table on
+    postgres). an existing table is left as it is, old databases are converted by 'python -m app.cli partition-sales' """
+    _lock(conn)
+    if conn.execute(text("SELECT to_regclass('sale')")).scalar() is not None:
+        return
+
+    create_partitioned_sale_table(conn)
+    for index in Sale.__table__.indexes:
+        index.create(conn)
+
+
+def migrate_sale_to_partitioned(conn: Connection) -> int:
+    """ converts an existing (not partitioned) 'sale' table, in a single transaction: the old table is renamed, the
+    partitioned one is created with partitions for every month that has data, the rows are copied and the old table is
+    dropped. the id sequence is kept, so new ids continue after the existing ones. returns the number of rows moved """
+    if not is_postgres(conn) or is_partitioned(conn, "sale"):
+        return 0
+
+    _lock(conn)
+
+    # the old names must be freed, constraint and index names are unique per schema
+    conn.execute(text("ALTER TABLE sale RENAME TO sale_unpartitioned"))
+    conn.execute(text("ALTER INDEX IF EXISTS sale_pkey RENAME TO sale_unpartitioned_pkey"))
+    for index in Sale.__table__.indexes:
+        conn.execute(text(f"DROP INDEX IF EXISTS {index.name}"))
+
+    create_partitioned_sale_table(conn)
+
+    first, last = conn.execute(text("SELECT MIN(date), MAX(date) FROM sale_unpartitioned")).one()
+    if first is not None:
+        ensure_partitions(conn, first, last)
+    ensure_future_partitions(conn)
+
+    moved = conn.execute(text(f"INSERT INTO sale ({SALE_COLUMNS}) SELECT {SALE_COLUMNS} FROM sale_unpartitioned")).rowcount
+    conn.execute(text("DROP TABLE sale_unpartitioned"))
+
+    for index in Sale.__table__.indexes:
+        index.create(conn)
+
+    return moved
+
+
+def drop_partitions_before(conn: Connection, before: date) -> List[str]:
+    """ drops the monthly partitions that end on or before 'before' (whole months only), which removes their rows without
+    scanning them. returns the dropped partition names, rows of a partial month must be deleted by the caller """
+    if not is_partitioned(conn, "sale"):
+        return []
+
+    _lock(conn)
+    dropped = []
+
+    for name in sorted(_existing_partitions(conn)):
+        if not name.startswith("sale_y"):
+            continue
+        if partition_range(name)[1] <= before:
+            conn.execute(text(f"DROP TABLE {name}"))
+            dropped.append(name)
+
+    return dropped
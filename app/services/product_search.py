@@ -0,0 +1,133 @@
+import os
+import re
+from typing import List
+from fastapi import HTTPException
+from sqlalchemy import Float, and_, column, func, literal_column, or_, select, table, text
+from sqlalchemy.engine import Connection
+from app.models.product import Product
+
+# https://www.postgresql.org/docs/current/textsearch-tables.html#TEXTSEARCH-TABLES-INDEX
+# https://www.postgresql.org/docs/current/textsearch-controls.html#TEXTSEARCH-RANKING
+# https://www.sqlite.org/fts5.html#external_content_tables
+
+""" full text search of GET /products/search over name, brand and description. every word of the search must match the
+start of a word of the product ('sam gal' finds 'Samsung Galaxy'), the results are ranked by relevance, a match on the
+name counts more than one on the brand, that counts more than one on the description.
+
+the index is kept by the database itself, so it is always consistent with the table, whatever writes to it (the routes,
+the bulk load of the imports, the cascades):
+
+    - postgres: a generated 'search_vector' tsvector column with a GIN index
+    - sqlite: an FTS5 table with the product as its external content, kept in sync by triggers """
+
+# any number works, it only has to be the same on every worker (and different from the partitions lock)
+SEARCH_LOCK_ID = 4712
+
+# words of the search that are used, the others are ignored
+MAX_SEARCH_TERMS = 8
+
+# matches that are returned (and paged through), at most. every match is scored and the most relevant ones are kept, so a
+# broad search ('phone' on a catalog of millions) still starts with its best results, a more specific search finds the rest
+SEARCH_MAX_CANDIDATES = int(os.getenv("SEARCH_MAX_CANDIDATES", "1000"))
+
+SEARCH_VECTOR_DDL = """
+ALTER TABLE product ADD COLUMN IF NOT EXISTS search_vector tsvector GENERATED ALWAYS AS (
+    setweight(to_tsvector('simple', coalesce(name, '')), 'A') ||
+    setweight(to_tsvector('simple', coalesce(brand, '')), 'B') ||
+    setweight(to_tsvector('simple', coalesce(description, '')), 'C')
+) STORED
+"""
+
+# 'prefix' keeps extra indexes of the first 2 and 3 letters of every word, so the prefix searches do not scan the terms
+SEARCH_FTS_DDL = """
+CREATE VIRTUAL TABLE IF NOT EXISTS product_search USING fts5(
+    name, brand, description, content='product', content_rowid='id', tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+)
+"""
+
+SEARCH_FTS_TRIGGERS = {
+    "product_search_insert": """
+        CREATE TRIGGER product_search_insert AFTER INSERT ON product BEGIN
+            INSERT INTO product_search (rowid, name, brand, description) VALUES (new.id, new.name, new.brand, new.description);
+        END
+    """,
+    "product_search_delete": """
+        CREATE TRIGGER product_search_delete AFTER DELETE ON product BEGIN
+            INSERT INTO product_search (product_search, rowid, name, brand, description) VALUES ('delete', old.id, old.name, old.brand, old.description);
+        END
+    """,
+    "product_search_update": """
+        CREATE TRIGGER product_search_update AFTER UPDATE ON product BEGIN
+            INSERT INTO product_search (product_search, rowid, name, brand, description) VALUES ('delete', old.id, old.name, old.brand, old.description);
+            INSERT INTO product_search (rowid, name, brand, description) VALUES (new.id, new.name, new.brand, new.description);
+        END
+    """,
+}
+
+product_search = table("product_search", column("rowid"))
+
+
+def create_search_index(conn: Connection):
+    """ creates the search index when it does not exist yet and fills it with the existing products. on postgres adding the
+    column rewrites the product table once, run 'python -m app.cli migrate' outside of peak hours on a big catalog """
+    if conn.dialect.name == "postgresql":
+        conn.execute(text("SELECT pg_advisory_xact_lock(:id)"), {"id": SEARCH_LOCK_ID})
+        conn.execute(text(SEARCH_VECTOR_DDL))
+        conn.execute(text("CREATE INDEX IF NOT EXISTS ix_product_search_vector ON product USING GIN (search_vector)"))
+        return
+
+    conn.execute(text(SEARCH_FTS_DDL))
+    existing = set(conn.execute(text("SELECT name FROM sqlite_master WHERE type = 'trigger' AND tbl_name = 'product'")).scalars())
+
+    # the triggers go away with the product table, in that case the index is stale and is rebuilt from the table
+    if not set(SEARCH_FTS_TRIGGERS) <= existing:
+        for name, ddl in SEARCH_FTS_TRIGGERS.items():
+            if name not in existing:
+                conn.execute(text(ddl))
+        conn.execute(text("INSERT INTO product_search (product_search) VALUES ('rebuild')"))
+
+
+def search_terms(q: str) -> List[str]:
+    # only the words are kept, so nothing typed by the user reaches the query syntax of the database
+    terms = re.findall(r"\w+", q.lower())[:MAX_SEARCH_TERMS]
+    if not terms:
+        raise HTTPException(status_code=400, detail="Search Must Have at Least One Word")
+    return terms
+
+
+def ranked_search(dialect: str, terms: List[str]):
+    """ select of the product columns plus its 'score' (higher is more relevant) for the products that match every term,
+    the filters of the list can be added to it with '.where' """
+    columns = list(Product.__table__.c)
+
+    if dialect == "postgresql":
+        query = func.to_tsquery("simple", " & ".join(f"{term}:*" for term in terms))
+        vector = literal_column("product.search_vector")
+        # weights of the D, C, B and A labels (description, brand and name)
+        score = func.ts_rank(literal_column("'{0.1, 0.2, 0.4, 1.0}'::float4[]"), vector, query, type_=Float)
+        return select(*columns, score.label("score")).where(vector.op("@@")(query))
+
+    match = " AND ".join(f'"{term}"*' for term in terms)
+    # bm25 is lower for better matches, it is negated to sort the same way as postgres. the weights follow the column order
+    # of the fts table: name, brand, description
+    score = -func.bm25(literal_column("product_search"), 10.0, 4.0, 1.0, type_=Float)
+    return (
+        select(*columns, score.label("score"))
+        .select_from(Product.__table__.join(product_search, product_search.c.rowid == Product.id))
+        .where(literal_column("product_search").op("MATCH")(match))
+    )
+
+
+def search_page_query(ranked, cursor: tuple | None):
+    """ sorts the ranked search by (score desc, id) and continues after the cursor. the inner query computes the score, so
+    it can be compared like a column, and keeps the SEARCH_MAX_CANDIDATES most relevant matches (the filters are applied
+    before). the candidates are sorted by the same key as the pages, so the cut never drops a better match than a kept one """
+    candidates = ranked.selected_columns
+    ranked = ranked.order_by(candidates.score.desc(), candidates.id).limit(SEARCH_MAX_CANDIDATES).subquery("ranked")
+    query = select(*ranked.c)
+
+    if cursor:
+        score, product_id = cursor
+        query = query.where(or_(ranked.c.score < score, and_(ranked.c.score == score, ranked.c.id > product_id)))
+
+    return query.order_by(ranked.c.score.desc(), ranked.c.id), list(ranked.c)
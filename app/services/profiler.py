@@ -0,0 +1,207 @@
+import asyncio
+import hmac
+import itertools
+import os
+import sys
+import threading
+import time
+from collections import Counter, deque
+from datetime import datetime, timezone
+from types import FrameType
+from typing import List
+from app.services.metrics import PROFILES_CAPTURED
+
+# https://www.brendangregg.com/flamegraphs.html
+# https://github.com/brendangregg/FlameGraph#2-fold-stacks
+# https://www.speedscope.app/
+# https://docs.python.org/3/library/sys.html#sys._current_frames
+
+""" on demand sampling profiler of the requests, so a slow '/dashboard/revenue' shows where its time goes (parsing, ORM
+objects, serialization or waiting on the database) instead of only the sql of 'echo=True':
+
+    - a request with the 'X-Profile-Token' header (or '?profile=') equal to PROFILING_TOKEN is profiled, its response gets
+      an 'X-Profile-Id' header and the profile is kept on the buffer
+    - with PROFILE_SLOW_MS set (it needs PROFILING_TOKEN too) every request is profiled, and the ones slower than it are
+      kept on the buffer
+    - the last PROFILE_BUFFER_SIZE profiles are listed on 'GET /admin/profiles' (see app/api/routes/profiles.py)
+
+while a request is profiled, a thread takes the stack of its task every PROFILE_INTERVAL_MS: the frames being run when
+the task is on the event loop, or the chain of awaits where it is suspended (so the time waiting on the database is on
+the profile too, under the await that waits for it). the sync code of 'session.run_sync' runs on a greenlet, its frames
+are followed from the 'greenlet_spawn' that started it. the profile is kept in the folded format ('frame;frame;frame
+count' per line) read by flamegraph.pl, speedscope and inferno, every sample is PROFILE_INTERVAL_MS of wall time.
+
+without PROFILING_TOKEN nothing of this runs, not even the middleware (PROFILE_SLOW_MS alone would sample every request
+for profiles that nobody can read, it is ignored with a warning). profiles are kept per worker """
+
+PROFILING_TOKEN = os.getenv("PROFILING_TOKEN") or None
+PROFILE_SLOW_MS = float(os.getenv("PROFILE_SLOW_MS", "0"))
+PROFILE_INTERVAL_MS = float(os.getenv("PROFILE_INTERVAL_MS", "5"))
+PROFILE_BUFFER_SIZE = int(os.getenv("PROFILE_BUFFER_SIZE", "20"))
+
+PROFILING_ENABLED = bool(PROFILING_TOKEN)
+
+PROFILE_HEADER = "x-profile-token"
+PROFILE_QUERY = "profile"
+
+
+def token_matches(token: str | None) -> bool:
+    return bool(PROFILING_TOKEN and token) and hmac.compare_digest(token.encode(), PROFILING_TOKEN.encode())
+
+
+def _short_path(path: str) -> str:
+    # the path inside site-packages for the libraries, relative to the working directory for the app
+    _, found, inside = path.rpartition("site-packages" + os.sep)
+    if found:
+        return inside
+    return os.path.relpath(path) if path.startswith(os.getcwd()) else path
+
+
+def _label(frame: FrameType) -> str:
+    # the line where the function starts (not the current line), so all the samples of a function add up on one frame
+    code = frame.f_code
+    name = getattr(code, "co_qualname", code.co_name)
+    return f"{name} ({_short_path(code.co_filename)}:{code.co_firstlineno})".replace(";", ",")
+
+
+def _thread_stack(frame: FrameType | None, root: FrameType) -> List[str]:
+    # the running frames, from the innermost up to the root (the middleware of the request)
+    stack = []
+    while frame is not None and frame is not root:
+        stack.append(_label(frame))
+        frame = frame.f_back
+    if frame is None:
+        # the frames of a greenlet end on the function it runs, the awaits that started it are not linked
+        stack.append("(greenlet)")
+    stack.append(_label(root))
+    stack.reverse()
+    return stack
+
+
+def _greenlet_stack(greenlet) -> List[str]:
+    frame = getattr(greenlet, "gr_frame", None)
+    stack = []
+    while frame is not None:
+        stack.append(_label(frame))
+        frame = frame.f_back
+    stack.reverse()
+    return stack
+
+
+def _await_stack(coro, root: FrameType) -> List[str]:
+    # the chain of awaits of a suspended task, from the coroutine of the task down to the one waiting. the frames outside of
+    # the middleware (the server and the other middlewares) are left out
+    stack = []
+    found = False
+    while coro is not None:
+        frame = getattr(coro, "cr_frame", None) or getattr(coro, "gi_frame", None)
+        if frame is None:
+            break
+        found = found or frame is root
+        if found:
+            stack.append(_label(frame))
+            if frame.f_code.co_name == "greenlet_spawn":
+                # the sync function of run_sync is suspended on this greenlet, waiting for the coroutine awaited below
+                stack.extend(_greenlet_stack(frame.f_locals.get("context")))
+        coro = getattr(coro, "cr_await", None) or getattr(coro, "gi_yieldfrom", None)
+    return stack
+
+
+class Profile:
+    _ids = itertools.count(1)
+
+    def __init__(self, method: str, path: str, requested: bool):
+        self.id = next(self._ids)
+        self.method = method
+        self.path = path
+        self.requested = requested
+        self.task = asyncio.current_task()
+        self.thread_id = threading.get_ident()
+        self.root: FrameType | None = None
+        self.samples: Counter = Counter()
+        self.status: int | None = None
+        self.started = time.perf_counter()
+        self.seconds: float | None = None
+        self.captured_at = datetime.now(timezone.utc)
+
+    def sample(self, frames: dict):
+        coro = self.task.get_coro()
+        if coro.cr_frame is None:
+            return
+        if coro.cr_running:
+            stack = _thread_stack(frames.get(self.thread_id), self.root)
+        else:
+            stack = _await_stack(coro, self.root)
+        if stack:
+            self.samples[";".join(stack)] += 1
+
+    def folded(self) -> str:
+        return "".join(f"{stack} {count}\n" for stack, count in self.samples.most_common())
+
+    def summary(self) -> dict:
+        return {
+            "id": self.id,
+            "method": self.method,
+            "path": self.path,
+            "status": self.status,
+            "reason": "requested" if self.requested else "slow",
+            "duration_ms": round(self.seconds * 1000, 3) if self.seconds is not None else None,
+            "samples": sum(self.samples.values()),
+            "interval_ms": PROFILE_INTERVAL_MS,
+            "captured_at": self.captured_at.isoformat(),
+        }
+
+
+class Profiler:
+    def __init__(self, interval_ms: float = PROFILE_INTERVAL_MS, buffer_size: int = PROFILE_BUFFER_SIZE):
+        self.interval = interval_ms / 1000
+        self.active = set()
+        self.profiles = deque(maxlen=buffer_size)
+        self.lock = threading.Lock()
+        self.sampler: threading.Thread | None = None
+
+    def start(self, profile: Profile, root: FrameType):
+        profile.root = root
+        with self.lock:
+            self.active.add(profile)
+            # the sampler only runs while there are requests to sample, it stops by itself after the last one
+            if self.sampler is None:
+                self.sampler = threading.Thread(target=self._sample_forever, name="request-profiler", daemon=True)
+                self.sampler.start()
+
+    def stop(self, profile: Profile, status: int):
+        profile.seconds = time.perf_counter() - profile.started
+        profile.status = status
+        with self.lock:
+            self.active.discard(profile)
+
+        reason = "requested" if profile.requested else "slow" if PROFILE_SLOW_MS and profile.seconds * 1000 > PROFILE_SLOW_MS else None
+        if reason:
+            self.profiles.append(profile)
+            PROFILES_CAPTURED.labels(reason).inc()
+
+    def _sample_forever(self):
+        while True:
+            time.sleep(self.interval)
+            with self.lock:
+                if not self.active:
+                    self.sampler = None
+                    return
+                active = list(self.active)
+
+            frames = sys._current_frames()
+            for profile in active:
+                try:
+                    profile.sample(frames)
+                except Exception:
+                    # a frame that finished while it was read, the next sample gets it right
+                    continue
+
+    def get(self, profile_id: int) -> Profile | None:
+        return next((profile for profile in self.profiles if profile.id == profile_id), None)
+
+    def list(self) -> List[dict]:
+        return [profile.summary() for profile in reversed(self.profiles)]
+
+
+profiler = Profiler()
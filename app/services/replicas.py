@@ -0,0 +1,143 @@
+import asyncio
+import itertools
+import os
+import time
+from typing import List
+from fastapi import Request
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncEngine
+from app.services.metrics import REPLICA_HEALTHY, REPLICA_LAG
+
+# https://docs.sqlalchemy.org/en/20/orm/persistence_techniques.html#session-partitioning
+# https://www.postgresql.org/docs/current/hot-standby.html
+# https://www.postgresql.org/docs/current/functions-admin.html#FUNCTIONS-RECOVERY-INFO-TABLE
+
+""" routing of the heavy reads (lists, search, exports and the dashboard) to the read replicas of DATABASE_REPLICA_URLS,
+so they do not compete with the imports and the writes on the primary:
+
+    - the reads are spread round robin over the replicas that passed the last health check. a replica that does not answer,
+      or that is more than REPLICA_MAX_LAG_SECONDS behind the primary, gets no reads until a later check passes
+    - with no healthy replica (or none configured) the reads go to the primary
+    - the 'X-Read-From: primary' header forces a request to the primary, and every successful write sets a cookie that
+      does the same for REPLICA_STICKY_SECONDS, so a client reads its own writes even while the replicas are behind
+
+everything that writes, and the lookups by id (their result is cached, a stale row from a replica would stay on the cache
+for its whole TTL), stays on the primary """
+
+# seconds between two health checks of the replicas, and how long a check waits for a replica to answer
+REPLICA_CHECK_INTERVAL = float(os.getenv("REPLICA_CHECK_INTERVAL", "5"))
+REPLICA_CHECK_TIMEOUT = float(os.getenv("REPLICA_CHECK_TIMEOUT", "2"))
+# a replica further behind the primary than this gets no reads
+REPLICA_MAX_LAG_SECONDS = float(os.getenv("REPLICA_MAX_LAG_SECONDS", "10"))
+# seconds the reads of a client stay on the primary after one of its writes
+REPLICA_STICKY_SECONDS = float(os.getenv("REPLICA_STICKY_SECONDS", "5"))
+
+READ_FROM_HEADER = "x-read-from"
+READ_PRIMARY_COOKIE = "read_primary_until"
+
+# 0 when the replica replayed everything it received (an idle primary sends nothing, so the time of the last replayed
+# transaction alone would grow forever), otherwise how old the last replayed transaction is
+REPLICA_LAG_QUERY = """
+SELECT CASE
+    WHEN NOT pg_is_in_recovery() OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+    ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+END
+"""
+
+
+class Replica:
+    def __init__(self, name: str, engine: AsyncEngine):
+        self.name = name
+        self.engine = engine
+        # None until the first check, no reads until one passes
+        self.healthy: bool | None = None
+        self.lag_seconds: float | None = None
+        self.error: str | None = None
+
+
+class ReplicaSet:
+    def __init__(self, engines: List[AsyncEngine]):
+        self.replicas = [Replica(f"replica{number}", engine) for number, engine in enumerate(engines, start=1)]
+        self._next = itertools.count()
+        self.checker: asyncio.Task | None = None
+
+    def __bool__(self) -> bool:
+        return bool(self.replicas)
+
+    def choose(self) -> AsyncEngine | None:
+        """ the engine of the next healthy replica, None when there is none """
+        healthy = [replica for replica in self.replicas if replica.healthy]
+        if not healthy:
+            return None
+        return healthy[next(self._next) % len(healthy)].engine
+
+    def mark_down(self, engine: AsyncEngine, error: Exception):
+        # a read that lost its connection takes the replica out right away, the next check brings it back
+        for replica in self.replicas:
+            if replica.engine is engine:
+                self._set_state(replica, False, None, error)
+
+    def _set_state(self, replica: Replica, healthy: bool, lag_seconds: float | None, error: Exception | None):
+        if replica.healthy is not healthy:
+            print(f"Read replica {replica.name} is {'healthy' if healthy else 'unavailable'}" + (f": {error}" if error else ""))
+        replica.healthy = healthy
+        replica.lag_seconds = lag_seconds
+        replica.error = (str(error) or type(error).__name__) if error else None
+        REPLICA_HEALTHY.labels(replica.name).set(int(healthy))
+        if lag_seconds is not None:
+            REPLICA_LAG.labels(replica.name).set(lag_seconds)
+
+    async def _check(self, replica: Replica):
+        async def measure() -> float:
+            async with replica.engine.connect() as conn:
+                if conn.dialect.name != "postgresql":
+                    # no replication to measure (like a copy of a sqlite file used to try the routing locally)
+                    await conn.execute(text("SELECT 1"))
+                    return 0.0
+                return float((await conn.execute(text(REPLICA_LAG_QUERY))).scalar())
+
+        try:
+            lag_seconds = await asyncio.wait_for(measure(), timeout=REPLICA_CHECK_TIMEOUT)
+        except Exception as e:
+            self._set_state(replica, False, None, e)
+            return
+
+        if lag_seconds > REPLICA_MAX_LAG_SECONDS:
+            self._set_state(replica, False, lag_seconds, Exception(f"{lag_seconds:.1f}s behind the primary"))
+        else:
+            self._set_state(replica, True, lag_seconds, None)
+
+    async def check(self):
+        await asyncio.gather(*(self._check(replica) for replica in self.replicas))
+
+    async def _check_forever(self):
+        while True:
+            await asyncio.sleep(REPLICA_CHECK_INTERVAL)
+            await self.check()
+
+    async def start(self):
+        # the first check runs before the worker is ready, so the first reads already go to the replicas
+        await self.check()
+        self.checker = asyncio.create_task(self._check_forever())
+
+    async def stop(self):
+        if self.checker:
+            self.checker.cancel()
+        for replica in self.replicas:
+            await replica.engine.dispose()
+
+    def status(self) -> list:
+        return [
+            {"name": replica.name, "healthy": bool(replica.healthy), "lag_seconds": replica.lag_seconds, "error": replica.error}
+            for replica in self.replicas
+        ]
+
+
+def reads_from_primary(request: Request) -> bool:
+    """ whether the request asked for the primary, with the header or with the cookie set after a write """
+    if request.headers.get(READ_FROM_HEADER, "").lower() == "primary":
+        return True
+    try:
+        return float(request.cookies.get(READ_PRIMARY_COOKIE, "0")) > time.time()
+    except ValueError:
+        return False
@@ -0,0 +1,156 @@
+import asyncio
+import os
+from typing import List
+from fastapi import HTTPException
+from sqlalchemy import insert
+from sqlmodel import Session
+from app.config.database import async_session_maker
+from app.models.sale import Sale
+from app.services.partitions import lock_sale_ids
+from app.services.metrics import SALE_BATCH_ROWS, SALE_BATCH_WAIT, SALE_QUEUE_REJECTED
+from app.services.sales_rollup import apply_sales_deltas, sale_deltas
+from app.services.table_versions import bump_table_versions
+
+# https://docs.sqlalchemy.org/en/20/core/connections.html#engine-insertmanyvalues
+# https://docs.sqlalchemy.org/en/20/core/dml.html#sqlalchemy.sql.expression.Insert.returning.params.sort_by_parameter_order
+# https://docs.python.org/3/library/asyncio-queue.html
+
+""" micro batching of POST /sales/ (off by default, SALE_BATCHING=true turns it on). every single sale used to be its own
+transaction (an fsync on commit) plus a SELECT to refresh it. with batching on, the sales are queued in memory and a
+single task saves them in groups:
+
+    - a group is saved when it has SALE_BATCH_SIZE sales, or SALE_BATCH_MAX_WAIT_MS after its first sale arrived
+    - the whole group is one multi row 'INSERT ... RETURNING' (the returned rows come back in the order of the sales) plus
+      one update of the daily rollup, in a single transaction
+    - every request waits for the commit of its group and is answered with its own returned row, so a sale is never
+      acknowledged before it is saved (it is a group commit, no sale is lost if the worker dies)
+    - the queue holds at most SALE_BATCH_MAX_PENDING sales, when it is full a request waits SALE_BATCH_QUEUE_TIMEOUT
+      seconds for room and then gets a 503, so a burst slows the clients down instead of growing the memory
+
+a sale that fails (like one with an unknown product) would fail its whole group, in that case the group is saved again
+one sale at a time, so only the bad ones get the error """
+
+SALE_BATCHING = os.getenv("SALE_BATCHING", "false").lower() in ("1", "true", "yes")
+SALE_BATCH_SIZE = int(os.getenv("SALE_BATCH_SIZE", "500"))
+SALE_BATCH_MAX_WAIT_MS = float(os.getenv("SALE_BATCH_MAX_WAIT_MS", "10"))
+SALE_BATCH_MAX_PENDING = int(os.getenv("SALE_BATCH_MAX_PENDING", "10000"))
+SALE_BATCH_QUEUE_TIMEOUT = float(os.getenv("SALE_BATCH_QUEUE_TIMEOUT", "1"))
+
+
+def insert_sales(session: Session, rows: List[dict]) -> List[dict]:
+    """ inserts the sales with one statement and updates the rollup and the table version in the caller transaction,
+    returns the saved rows in the order of 'rows'. the rows have no id, every id comes from the sequence """
+    sale = Sale.__table__
+    # the imports of sales wait for this transaction before checking their ids (see lock_sale_ids)
+    lock_sale_ids(session.connection(), shared=True)
+
+    statement = insert(sale).returning(*sale.c, sort_by_parameter_order=True)
+    saved = session.connection().execute(statement, rows).all()
+
+    # the returned rows have the attributes sale_deltas reads, no Sale instance is built for them
+    apply_sales_deltas(session, sale_deltas(saved))
+    bump_table_versions(session, "sale")
+    return [row._asdict() for row in saved]
+
+
+class SaleBatcher:
+    def __init__(self, batch_size: int = SALE_BATCH_SIZE, max_wait_ms: float = SALE_BATCH_MAX_WAIT_MS, max_pending: int = SALE_BATCH_MAX_PENDING):
+        self.batch_size = batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.max_pending = max_pending
+        self.queue: asyncio.Queue | None = None
+        self.flusher: asyncio.Task | None = None
+        self.closed = False
+
+    async def submit(self, sale: Sale) -> dict:
+        """ queues the sale and waits until its group is committed, returns the saved row """
+        if self.closed:
+            raise HTTPException(status_code=503, detail="Server is Shutting Down", headers={"Retry-After": "1"})
+
+        # never with an id, the database generates it: an id chosen by the client could repeat one of the table (on the
+        # partitioned table nothing would stop it) or of the same group, and fail the whole group
+        row = sale.model_dump(exclude={"id"})
+        future = asyncio.get_running_loop().create_future()
+
+        try:
+            await asyncio.wait_for(self.queue.put((row, future)), timeout=SALE_BATCH_QUEUE_TIMEOUT)
+        except asyncio.TimeoutError:
+            SALE_QUEUE_REJECTED.inc()
+            raise HTTPException(status_code=503, detail="Too Many Sales Pending", headers={"Retry-After": "1"})
+
+        return await future
+
+    async def _next_batch(self) -> list:
+        # waits for the first sale, then takes what is already queued and waits for more until the group is full or the
+        # first sale waited SALE_BATCH_MAX_WAIT_MS
+        loop = asyncio.get_running_loop()
+        batch = [await self.queue.get()]
+        started = loop.time()
+        deadline = started + self.max_wait
+
+        while len(batch) < self.batch_size:
+            if not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+                continue
+
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout=remaining))
+            except asyncio.TimeoutError:
+                break
+
+        SALE_BATCH_WAIT.observe(loop.time() - started)
+        return batch
+
+    async def _save(self, rows: List[dict]) -> List[dict]:
+        async with async_session_maker() as session:
+            saved = await session.run_sync(insert_sales, rows)
+            await session.commit()
+            return saved
+
+    async def _flush(self, batch: list):
+        try:
+            saved = await self._save([row for row, _ in batch])
+        except Exception as e:
+            if len(batch) > 1:
+                # one bad sale fails the whole statement, saving them one by one gives each its own result
+                for item in batch:
+                    await self._flush([item])
+                return
+            saved = [e]
+
+        SALE_BATCH_ROWS.observe(len(batch))
+        for (_, future), result in zip(batch, saved):
+            # the request may have been cancelled (client disconnected), its sale is saved anyway
+            if future.done():
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+    async def _flush_forever(self):
+        while True:
+            batch = await self._next_batch()
+            try:
+                await self._flush(batch)
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+
+    async def start(self):
+        self.queue = asyncio.Queue(maxsize=self.max_pending)
+        self.flusher = asyncio.create_task(self._flush_forever())
+
+    async def stop(self):
+        # the sales already accepted are saved before the worker exits
+        self.closed = True
+        if self.queue:
+            await self.queue.join()
+        if self.flusher:
+            self.flusher.cancel()
+
+
+sale_batcher = SaleBatcher() if SALE_BATCHING else None
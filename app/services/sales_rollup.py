@@ -0,0 +1,128 @@
+from collections import defaultdict
+from datetime import date
+from typing import Dict, Iterable, Tuple
+from sqlmodel import Session, select, func, delete
+from sqlalchemy import exists
+from app.models.sale import Sale
+from app.models.sales_rollup import SalesDailyRollup
+from app.services.table_versions import bump_table_versions
+from app.services.upsert import upsert_insert
+
+# a delta is what must be added to one day of the rollup: (revenue, quantity, number of sales)
+Delta = Tuple[float, int, int]
+Deltas = Dict[date, Delta]
+
+rollup_table = SalesDailyRollup.__table__
+
+
+def _as_date(value) -> date:
+    # table models are not validated when built from a request body, so the date may still be the raw 'YYYY-MM-DD' string
+    return value if isinstance(value, date) else date.fromisoformat(str(value))
+
+
+def sale_deltas(sales: Iterable[Sale], sign: int = 1) -> Deltas:
+    """ groups the given sales by day, sign=-1 is used when the sales are being removed (or replaced) """
+    deltas = defaultdict(lambda: (0.0, 0, 0))
+
+    for sale in sales:
+        day = _as_date(sale.date)
+        revenue, quantity, count = deltas[day]
+        deltas[day] = (revenue + sign * float(sale.total_price), quantity + sign * int(sale.quantity), count + sign)
+
+    return dict(deltas)
+
+
+def merge_deltas(*all_deltas: Deltas) -> Deltas:
+    merged = defaultdict(lambda: (0.0, 0, 0))
+
+    for deltas in all_deltas:
+        for day, (revenue, quantity, count) in deltas.items():
+            current = merged[day]
+            merged[day] = (current[0] + revenue, current[1] + quantity, current[2] + count)
+
+    return dict(merged)
+
+
+def apply_sales_deltas(session: Session, deltas: Deltas):
+    """ adds the deltas to the rollup inside the caller transaction, the caller is responsible for the commit so the sale and
+    its rollup are always saved (or rolled back) together. the increment runs on the database, so concurrent writers are safe """
+    rows = [
+        {"date": day, "total_revenue": revenue, "total_quantity": quantity, "sales_count": count}
+        for day, (revenue, quantity, count) in deltas.items()
+        if count or revenue or quantity
+    ]
+
+    if not rows:
+        return
+
+    statement = upsert_insert(session, rollup_table).values(rows)
+    statement = statement.on_conflict_do_update(
+        index_elements=[rollup_table.c.date],
+        set_={
+            "total_revenue": rollup_table.c.total_revenue + statement.excluded.total_revenue,
+            "total_quantity": rollup_table.c.total_quantity + statement.excluded.total_quantity,
+            "sales_count": rollup_table.c.sales_count + statement.excluded.sales_count,
+        },
+    )
+    session.exec(statement)
+
+    # days that lost all their sales are removed, so the rollup never holds more rows than days with sales
+    session.exec(
+        delete(SalesDailyRollup)
+        .where(SalesDailyRollup.date.in_([row["date"] for row in rows]))
+        .where(SalesDailyRollup.sales_count <= 0)
+    )
+
+
+def rebuild_rollup(session: Session, start_date: date | None = None, end_date: date | None = None) -> int:
+    """ recomputes the rollup from the 'sale' table (the whole history, or only the given window). used to backfill an
+    existing database and to discard any floating point drift accumulated by the incremental updates """
+    clear = delete(SalesDailyRollup)
+    source = select(
+        Sale.date,
+        func.sum(Sale.total_price),
+        func.sum(Sale.quantity),
+        func.count(Sale.id),
+    )
+
+    if start_date:
+        clear = clear.where(SalesDailyRollup.date >= start_date)
+        source = source.where(Sale.date >= start_date)
+    if end_date:
+        clear = clear.where(SalesDailyRollup.date <= end_date)
+        source = source.where(Sale.date <= end_date)
+
+    source = source.group_by(Sale.date)
+
+    session.exec(clear)
+    result = session.exec(
+        rollup_table.insert().from_select(["date", "total_revenue", "total_quantity", "sales_count"], source)
+    )
+    bump_table_versions(session, "sales_daily_rollup")
+    session.commit()
+    return result.rowcount
+
+
+def apply_staged_sales(session: Session, staging, mode: str):
+    """ used as the 'before_merge' step of the sales bulk load (app/services/bulk_load.py): computes what the staged batch will
+    change on each day with two GROUP BY queries and applies it to the rollup, before the batch is merged into 'sale' """
+    sale = Sale.__table__
+    added = select(staging.c.date, func.sum(staging.c.total_price), func.sum(staging.c.quantity), func.count())
+
+    if mode == "insert":
+        # rows whose id already exists are skipped by the merge, so they do not count
+        added = added.where(~exists().where(sale.c.id == staging.c.id))
+
+    deltas = {day: (revenue, quantity, count) for day, revenue, quantity, count in session.exec(added.group_by(staging.c.date))}
+
+    if mode == "upsert":
+        # rows that will be overwritten are removed from the days they are currently in
+        replaced = (
+            select(sale.c.date, func.sum(sale.c.total_price), func.sum(sale.c.quantity), func.count())
+            .join(staging, sale.c.id == staging.c.id)
+            .group_by(sale.c.date)
+        )
+        removed = {day: (-revenue, -quantity, -count) for day, revenue, quantity, count in session.exec(replaced)}
+        deltas = merge_deltas(deltas, removed)
+
+    apply_sales_deltas(session, deltas)
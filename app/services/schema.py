@@ -0,0 +1,96 @@
+from datetime import datetime, timezone
+from sqlalchemy import inspect, text
+from sqlalchemy.engine import Connection, Engine
+from sqlmodel import SQLModel
+from app.services.partitions import PARTITION_KEYS, add_missing_columns, cascade_foreign_keys, create_indexes, create_sale_table, ensure_future_partitions, is_postgres
+from app.services.product_search import create_search_index
+
+# https://www.postgresql.org/docs/current/explicit-locking.html#ADVISORY-LOCKS
+# https://www.sqlite.org/lockingv3.html
+
+""" one time schema setup. every worker used to run create_all (and the partition / search ddl) on boot, so N workers
+raced to run the same ddl against the same database and each boot paid for it. now the version of the schema applied to
+the database is kept on the 'schema_version' table:
+
+    - on boot a worker only reads that version, when it is the current one there is nothing else to do
+    - otherwise it takes a lock (an advisory lock on postgres, the write lock of the database on sqlite), reads the version
+      again (another worker may have applied it while we waited) and applies the schema, all in one transaction
+
+every step of the schema is idempotent (create if missing), so applying it to an existing database only adds what is new.
+bump SCHEMA_VERSION whenever the models, indexes or ddl change, the next boot applies it """
+
+SCHEMA_VERSION = 4
+
+# any number works, it only has to be the same on every worker (and different from the partitions and search locks)
+SCHEMA_LOCK_ID = 4713
+
+SCHEMA_VERSION_DDL = """
+CREATE TABLE IF NOT EXISTS schema_version (
+    id INTEGER PRIMARY KEY,
+    version INTEGER NOT NULL,
+    applied_at VARCHAR NOT NULL
+)
+"""
+
+
+def apply_schema(conn: Connection):
+    """ creates the missing tables, partitions, indexes and the search index, and updates the old foreign keys """
+    if not is_postgres(conn):
+        SQLModel.metadata.create_all(conn)
+    else:
+        # create_all cannot create partitioned tables, those are created by app/services/partitions.py
+        tables = [table for table in SQLModel.metadata.sorted_tables if table.name not in PARTITION_KEYS]
+        SQLModel.metadata.create_all(conn, tables=tables)
+        create_sale_table(conn)
+        ensure_future_partitions(conn)
+
+    # create_all skips the tables that already exist, so columns and indexes added to the models later are created one by one
+    add_missing_columns(conn)
+    create_indexes(conn)
+    cascade_foreign_keys(conn)
+    create_search_index(conn)
+
+
+def _current_version(conn: Connection) -> int | None:
+    if not inspect(conn).has_table("schema_version"):
+        return None
+    return conn.execute(text("SELECT version FROM schema_version WHERE id = 1")).scalar()
+
+
+def _lock(conn: Connection):
+    if is_postgres(conn):
+        conn.execute(text("SELECT pg_advisory_xact_lock(:id)"), {"id": SCHEMA_LOCK_ID})
+        conn.execute(text(SCHEMA_VERSION_DDL))
+        return
+
+    # sqlite has no advisory locks, the first write of a transaction takes the write lock of the whole database (even when
+    # no row changes) and the other workers wait for the commit
+    conn.execute(text(SCHEMA_VERSION_DDL))
+    conn.execute(text("UPDATE schema_version SET version = version WHERE id = 1"))
+
+
+def verify_schema(engine: Engine, force: bool = False) -> bool:
+    """ applies the schema when the database is not on SCHEMA_VERSION (or when 'force' is set, used by the migrate command),
+    returns whether it was applied """
+    if not force:
+        with engine.connect() as conn:
+            if _current_version(conn) == SCHEMA_VERSION:
+                # the only ddl that depends on the date, it does nothing (and takes no lock) when the partitions exist
+                if is_postgres(conn):
+                    ensure_future_partitions(conn)
+                    conn.commit()
+                return False
+
+    with engine.begin() as conn:
+        _lock(conn)
+        if not force and _current_version(conn) == SCHEMA_VERSION:
+            return False
+
+        apply_schema(conn)
+        conn.execute(text("DELETE FROM schema_version"))
+        conn.execute(
+            text("INSERT INTO schema_version (id, version, applied_at) VALUES (1, :version, :applied_at)"),
+            {"version": SCHEMA_VERSION, "applied_at": datetime.now(timezone.utc).isoformat()},
+        )
+
+    return True
@@ -0,0 +1,84 @@
+import hashlib
+import time
+from typing import Dict, Iterable
+from fastapi import HTTPException, Request
+from sqlmodel import Session, select
+from app.config.database import ReadSessionDep
+from app.models.table_version import TableVersion
+from app.services.upsert import upsert_insert
+
+# https://developer.mozilla.org/en-US/docs/Web/HTTP/Conditional_requests
+# https://www.rfc-editor.org/rfc/rfc9110#name-if-none-match
+
+""" change versions of the tables, for the conditional GETs of the lists and the dashboard:
+
+    - every write path (routes, imports, bulk deletes, cli) calls bump_table_versions with the tables it wrote, in the
+      same transaction as the write, so the new version is visible exactly when the new rows are
+    - a GET that supports it takes the 'conditional_get' dependency with the tables it reads. the dependency reads their
+      versions (a single lookup by primary key) and builds the ETag from them plus the path and the query string. when it
+      matches the 'If-None-Match' of the request the 304 is sent before the route runs any query
+
+the ETag is added to the 200 responses by app/middleware/etag.py """
+
+# tables that change whenever another one does: the daily rollup follows every write on the sales
+DERIVED_TABLES = {"sale": ["sales_daily_rollup"]}
+
+
+def bump_table_versions(session: Session, *table_names: str):
+    """ increments the version of the given tables inside the caller transaction, the caller commits it with the write """
+    tables = set(table_names)
+    for table_name in table_names:
+        tables.update(DERIVED_TABLES.get(table_name, []))
+
+    # the first version of a table is the current time in milliseconds and not 1, so a database created again (and its
+    # counters started again) does not repeat the versions, and the ETags, that clients still hold from the old one
+    first_version = int(time.time() * 1000)
+    statement = upsert_insert(session, TableVersion.__table__).values([{"table_name": name, "version": first_version} for name in sorted(tables)])
+    statement = statement.on_conflict_do_update(
+        index_elements=[TableVersion.table_name],
+        set_={"version": TableVersion.version + 1},
+    )
+    session.exec(statement)
+
+
+def read_table_versions(session: Session, table_names: Iterable[str]) -> Dict[str, int]:
+    # a table that was never written has no row yet, its version is 0
+    versions = dict(session.exec(select(TableVersion.table_name, TableVersion.version).where(TableVersion.table_name.in_(table_names))).all())
+    return {name: versions.get(name, 0) for name in table_names}
+
+
+def make_etag(request: Request, versions: Dict[str, int]) -> str:
+    # the query string is sorted, so '?a=1&b=2' and '?b=2&a=1' share the same ETag
+    query = sorted(request.query_params.multi_items())
+    raw = repr((request.url.path, query, sorted(versions.items())))
+    return '"' + hashlib.blake2b(raw.encode(), digest_size=16).hexdigest() + '"'
+
+
+def _matches(if_none_match: str, etag: str) -> bool:
+    if if_none_match.strip() == "*":
+        return True
+    # weak tags ('W/"..."', added by proxies that compress the response) match their strong version
+    return etag in (tag.strip().removeprefix("W/") for tag in if_none_match.split(","))
+
+
+def conditional_get(*table_names: str, include_tables: Dict[str, str] | None = None):
+    """ dependency for the GET routes whose response only depends on the given tables and on the query parameters, use it
+    as 'dependencies=[Depends(conditional_get("sale"))]' on a route that reads with ReadSessionDep (the versions are read
+    on the same session, so from the same replica as the response). 'include_tables' are the tables read by each value
+    of '?include=' (see app/services/includes.py) """
+    async def check(request: Request, session: ReadSessionDep):
+        tables = set(table_names)
+        for path in request.query_params.get("include", "").split(","):
+            # the include itself is validated by the route, the unknown ones fail there
+            tables.update([include_tables[path.strip()]] if include_tables and path.strip() in include_tables else [])
+
+        versions = await session.run_sync(read_table_versions, sorted(tables))
+        etag = make_etag(request, versions)
+
+        if_none_match = request.headers.get("if-none-match")
+        if if_none_match and _matches(if_none_match, etag):
+            raise HTTPException(status_code=304, headers={"ETag": etag, "Cache-Control": "no-cache"})
+
+        request.state.etag = etag
+
+    return check
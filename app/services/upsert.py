@@ -0,0 +1,15 @@
+from sqlalchemy import Table
+from sqlmodel import Session
+
+# https://docs.sqlalchemy.org/en/20/dialects/postgresql.html#insert-on-conflict-upsert
+# https://docs.sqlalchemy.org/en/20/dialects/sqlite.html#upsert-support
+
+
+def upsert_insert(session: Session, table: Table):
+    """ insert into 'table' for the dialect of the session, with 'on_conflict_do_update' / 'on_conflict_do_nothing'.
+    'INSERT ... ON CONFLICT' is not part of the generic sqlalchemy insert, each dialect ships its own version """
+    if session.get_bind().dialect.name == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert
+    return insert(table)
@@ -0,0 +1,90 @@
+""" compares two benchmark reports (see benchmarks/run.py) and flags the metrics that got worse:
+
+    python -m benchmarks.compare benchmarks/results/1m-sqlite-abc123.json benchmarks/results/1m-sqlite-def456.json
+
+exits with status 1 when any metric regressed more than --threshold percent, so it can be used on ci """
+import argparse
+import json
+import sys
+from pathlib import Path
+
+# (path on the report, True when a higher value is better)
+METRICS = [
+    *[(("imports", table, "rows_per_second"), True) for table in ("categories", "products", "sales")],
+    (("imports", "sales", "read_sales_during_import", "p99_ms"), False),
+    (("peak_rss_mb", "after_imports"), False),
+    (("peak_rss_mb", "final"), False),
+    (("startup_seconds",), False),
+    (("ingestion", "sales_per_second"), True),
+    (("ingestion", "p99_ms"), False),
+]
+
+
+def _metrics(report: dict) -> dict:
+    values = {}
+
+    for path, higher_is_better in METRICS:
+        value = report
+        for key in path:
+            value = value.get(key, {}) if isinstance(value, dict) else {}
+        if isinstance(value, (int, float)):
+            values[".".join(path)] = (value, higher_is_better)
+
+    for scenario, stats in report.get("latency", {}).items():
+        for stat in ("p50_ms", "p99_ms", "db_mean_ms"):
+            values[f"latency.{scenario}.{stat}"] = (stats[stat], False)
+
+    return values
+
+
+def compare(base: dict, new: dict, threshold: float) -> list[str]:
+    """ prints the comparison table and returns the names of the regressed metrics """
+    base_metrics, new_metrics = _metrics(base), _metrics(new)
+    regressions = []
+
+    print(f"{'metric':<60} {'base':>12} {'new':>12} {'change':>9}")
+
+    for name, (base_value, higher_is_better) in base_metrics.items():
+        if name not in new_metrics:
+            continue
+
+        new_value = new_metrics[name][0]
+        change = (new_value - base_value) / base_value * 100 if base_value else 0
+        worse = -change if higher_is_better else change
+        flag = ""
+
+        if worse > threshold:
+            flag = "  REGRESSION"
+            regressions.append(name)
+        elif -worse > threshold:
+            flag = "  improved"
+
+        print(f"{name:<60} {base_value:>12} {new_value:>12} {change:>+8.1f}%{flag}")
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.compare")
+    parser.add_argument("base", type=Path)
+    parser.add_argument("new", type=Path)
+    parser.add_argument("--threshold", type=float, default=10, help="percent change tolerated before flagging a metric")
+    args = parser.parse_args()
+
+    base = json.loads(args.base.read_text())
+    new = json.loads(args.new.read_text())
+
+    for key in ("scale", "database", "import_format", "concurrency"):
+        if base["meta"].get(key) != new["meta"].get(key):
+            print(f"Warning: the reports have a different {key} ({base['meta'].get(key)} x {new['meta'].get(key)})")
+
+    print(f"base: {base['meta']['commit']}  new: {new['meta']['commit']}\n")
+    regressions = compare(base, new, args.threshold)
+
+    if regressions:
+        print(f"\n{len(regressions)} metrics regressed more than {args.threshold}%.")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+""" synthetic data generator for the benchmarks, the csv (and parquet) files have the same columns as the import_csv (and
+import_parquet) endpoints expect.
+
+    python -m benchmarks.generate --scale 1m                  (writes benchmarks/data/1m/{categories,products,sales}.{csv,parquet})
+
+the same scale and seed always produce the same files, so two runs (or two commits) import exactly the same data """
+import argparse
+import json
+from datetime import date, timedelta
+from pathlib import Path
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+# number of rows of each table for every scale, products and categories grow slower than sales like in a real store
+SCALES = {
+    "10k": {"categories": 20, "products": 1_000, "sales": 10_000},
+    "1m": {"categories": 100, "products": 20_000, "sales": 1_000_000},
+    "10m": {"categories": 500, "products": 100_000, "sales": 10_000_000},
+}
+
+BRANDS = [f"Brand {letter}" for letter in "ABCDEFGHIJKLMNOPQRSTUVWXYZ"]
+
+# sales are spread over three years starting here
+START_DATE = date(2022, 1, 1)
+DAYS = 3 * 365
+
+# sales are written in chunks, so generating 10m rows does not need them all in memory
+CHUNK_SIZE = 1_000_000
+
+DEFAULT_DATA_DIR = Path(__file__).parent / "data"
+
+
+def _manifest(scale: str, seed: int) -> dict:
+    return {
+        "scale": scale,
+        "seed": seed,
+        "formats": ["csv", "parquet"],
+        **SCALES[scale],
+        "brands": BRANDS,
+        "start_date": START_DATE.isoformat(),
+        "end_date": (START_DATE + timedelta(days=DAYS - 1)).isoformat(),
+    }
+
+
+def generate(scale: str, data_dir: Path = DEFAULT_DATA_DIR, seed: int = 42) -> dict:
+    """ writes the csv files of a scale (skipped when they were already generated with the same seed) and returns the
+    manifest, that the runner uses to build requests that match the data """
+    out_dir = data_dir / scale
+    manifest_path = out_dir / "manifest.json"
+    manifest = _manifest(scale, seed)
+
+    if manifest_path.exists() and json.loads(manifest_path.read_text()) == manifest:
+        return manifest
+
+    out_dir.mkdir(parents=True, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    counts = SCALES[scale]
+
+    categories = pd.DataFrame({
+        "id": np.arange(1, counts["categories"] + 1),
+        "name": [f"Category {i}" for i in range(1, counts["categories"] + 1)],
+    })
+    categories.to_csv(out_dir / "categories.csv", index=False)
+    pq.write_table(pa.Table.from_pandas(categories, preserve_index=False), out_dir / "categories.parquet")
+
+    product_ids = np.arange(1, counts["products"] + 1)
+    prices = np.round(rng.uniform(1, 2000, counts["products"]), 2)
+    products = pd.DataFrame({
+        "id": product_ids,
+        "name": [f"Product {i}" for i in product_ids],
+        "description": "Synthetic product",
+        "price": prices,
+        "brand": rng.choice(BRANDS, counts["products"]),
+        "category_id": rng.integers(1, counts["categories"] + 1, counts["products"]),
+    })
+    products.to_csv(out_dir / "products.csv", index=False)
+    pq.write_table(pa.Table.from_pandas(products, preserve_index=False), out_dir / "products.parquet")
+
+    sales_path = out_dir / "sales.csv"
+    sales_parquet = None
+    first_id = 1
+
+    for start in range(0, counts["sales"], CHUNK_SIZE):
+        size = min(CHUNK_SIZE, counts["sales"] - start)
+        product_id = rng.integers(1, counts["products"] + 1, size)
+        quantity = rng.integers(1, 11, size)
+        sales = pd.DataFrame({
+            "id": np.arange(first_id, first_id + size),
+            "product_id": product_id,
+            "quantity": quantity,
+            "total_price": np.round(prices[product_id - 1] * quantity, 2),
+            "date": np.datetime64(START_DATE, "D") + rng.integers(0, DAYS, size),
+        })
+        sales.to_csv(sales_path, index=False, header=start == 0, mode="w" if start == 0 else "a", date_format="%Y-%m-%d")
+
+        # one row group per chunk, with a real date column (pandas would write a timestamp)
+        table = pa.Table.from_pandas(sales, preserve_index=False)
+        table = table.set_column(table.schema.get_field_index("date"), "date", table["date"].cast(pa.date32()))
+        if sales_parquet is None:
+            sales_parquet = pq.ParquetWriter(out_dir / "sales.parquet", table.schema)
+        sales_parquet.write_table(table)
+        first_id += size
+
+    sales_parquet.close()
+
+    manifest_path.write_text(json.dumps(manifest, indent=2))
+    return manifest
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.generate")
+    parser.add_argument("--scale", choices=SCALES, default="10k")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--data-dir", type=Path, default=DEFAULT_DATA_DIR)
+    args = parser.parse_args()
+
+    manifest = generate(args.scale, args.data_dir, args.seed)
+    print(f"Generated {manifest['sales']} sales, {manifest['products']} products and {manifest['categories']} categories on {args.data_dir / args.scale}.")
+
+
+if __name__ == "__main__":
+    main()
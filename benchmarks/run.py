@@ -0,0 +1,381 @@
+""" benchmark runner, drives the ASGI app of app/main.py in process (no server, no network) and writes a json report:
+
+    python -m benchmarks.run --scale 10k                                        (sqlite file on benchmarks/data)
+    python -m benchmarks.run --scale 1m --database-url postgresql://... --reset  (local postgres, its tables are dropped!)
+
+what is measured:
+
+    - import throughput (rows/sec) of the categories, products and sales csv files (or parquet, with --import-format), and
+      the latency of read_sales while the import job of the sales runs on the worker processes
+    - p50/p95/p99 latency of read_sales, read_products (with filters), /products/search, /dashboard/revenue and the
+      /dashboard/breakdown endpoints, plus the db time and number of queries of each request (read from the Server-Timing
+      header)
+    - throughput and latency of single sales sent to POST /sales/ by many clients at once (point of sale traffic)
+    - peak RSS of the process after the imports and at the end
+    - startup time of a fresh worker (imports, schema check and pool warm up) on the populated database
+
+compare two reports with 'python -m benchmarks.compare' """
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import time
+from datetime import date, datetime, timedelta, timezone
+from pathlib import Path
+import numpy as np
+from benchmarks.generate import DEFAULT_DATA_DIR, SCALES, generate
+
+RESULTS_DIR = Path(__file__).parent / "results"
+
+# the order matters, products need their categories and sales need their products
+IMPORTS = ["categories", "products", "sales"]
+
+# endpoint of each file format
+IMPORT_ENDPOINTS = {"csv": "import_csv", "parquet": "import_parquet"}
+
+
+def _git_commit() -> str:
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+        dirty = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], capture_output=True, text=True).stdout.strip()
+        return f"{commit}-dirty" if dirty else commit
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def _peak_rss_mb() -> float:
+    # ru_maxrss is in kilobytes on linux (and bytes on macos)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024 * 1024 if platform.system() == "Darwin" else 1024), 1)
+
+
+def _server_timing(header: str) -> tuple[float, int]:
+    # 'db;dur=1.23;desc="2 queries", handler;dur=...' -> (1.23, 2)
+    db = header.split(",")[0]
+    duration = float(db.split("dur=")[1].split(";")[0])
+    queries = int(db.split('desc="')[1].split(" ")[0])
+    return duration, queries
+
+
+# boots the app on a fresh interpreter, like a new worker, and prints the startup time it measured (see app/main.py)
+STARTUP_SCRIPT = """
+import asyncio
+from app.main import app
+
+async def main():
+    async with app.router.lifespan_context(app):
+        print("startup_seconds", app.state.startup_seconds)
+
+asyncio.run(main())
+"""
+
+
+def _measure_startup(runs: int = 3) -> float:
+    # median of a few boots, the first one may also pay for cold disk caches. the same interpreter (and virtualenv) as the
+    # suite, the one recorded on the results
+    timings = []
+    for _ in range(runs):
+        output = subprocess.run([sys.executable, "-c", STARTUP_SCRIPT], capture_output=True, text=True, check=True).stdout
+        timings.append(next(float(line.split()[1]) for line in output.splitlines() if line.startswith("startup_seconds ")))
+    return round(float(np.median(timings)), 3)
+
+
+def _scenarios(manifest: dict, count: int, seed: int) -> dict:
+    """ the requests of each scenario, drawn at random (but always the same for a seed) from the generated data """
+    rng = random.Random(seed)
+    first_day = date.fromisoformat(manifest["start_date"])
+    last_day = date.fromisoformat(manifest["end_date"])
+    days = (last_day - first_day).days
+
+    def window(length: int) -> dict:
+        start = first_day + timedelta(days=rng.randrange(days - length))
+        return {"start_date": start.isoformat(), "end_date": (start + timedelta(days=length)).isoformat()}
+
+    def price_range() -> dict:
+        low = rng.uniform(1, 1500)
+        return {"min_price": round(low, 2), "max_price": round(low + 500, 2)}
+
+    return {
+        "read_sales_by_date": [("/api/sales/", window(30)) for _ in range(count)],
+        "read_sales_by_product_and_date": [
+            ("/api/sales/", {"product_id": rng.randint(1, manifest["products"]), **window(180)}) for _ in range(count)
+        ],
+        # big windows, like the dashboards read them, on the json page limit and on the columnar formats
+        "read_sales_window_json": [("/api/sales/", {"limit": 1000, **window(30)}) for _ in range(count)],
+        "read_sales_window_columnar": [("/api/sales/", {"limit": 100_000, "format": "columnar", **window(30)}) for _ in range(count)],
+        "read_sales_window_arrow": [("/api/sales/", {"limit": 100_000, "format": "arrow", **window(30)}) for _ in range(count)],
+        # a sales table with the product and category names, one query per include level whatever the page size
+        "read_sales_with_product_and_category": [
+            ("/api/sales/", {"limit": 1000, "include": "product.category", **window(30)}) for _ in range(count)
+        ],
+        "read_products_by_category_and_price": [
+            ("/api/products/", {"category_id": rng.randint(1, manifest["categories"]), **price_range()}) for _ in range(count)
+        ],
+        "read_products_by_brand": [("/api/products/", {"brand": rng.choice(manifest["brands"])}) for _ in range(count)],
+        # the number is matched as a prefix ('Product 12' also finds 'Product 120', 'Product 1234', ...)
+        "search_products": [("/api/products/search", {"q": f"product {rng.randint(1, manifest['products'])}"}) for _ in range(count)],
+        "dashboard_revenue_by_month": [("/api/dashboard/revenue", {"granularity": "month"}) for _ in range(count)],
+        "dashboard_revenue_by_day": [("/api/dashboard/revenue", {"granularity": "day", **window(365)}) for _ in range(count)],
+        # aggregated on the database, one row per group leaves it (the growth needs both dates)
+        "dashboard_breakdown_by_category": [("/api/dashboard/breakdown/categories", {"limit": 50, **window(90)}) for _ in range(count)],
+        "dashboard_breakdown_by_brand": [("/api/dashboard/breakdown/brands", {"limit": 50, **window(90)}) for _ in range(count)],
+        "dashboard_breakdown_top_products": [("/api/dashboard/breakdown/products", {"limit": 10, **window(365)}) for _ in range(count)],
+    }
+
+
+def _polling_scenarios(count: int) -> dict:
+    """ a dashboard polling the same requests while nothing changes, every request sends the ETag of the last response """
+    return {
+        "dashboard_revenue_polling": [("/api/dashboard/revenue", {"granularity": "month"})] * count,
+        "read_sales_polling": [("/api/sales/", {"limit": 1000})] * count,
+    }
+
+
+def _latency_summary(timings: list) -> dict:
+    p50, p99 = np.percentile(timings, [50, 99]) if timings else (0, 0)
+    return {"requests": len(timings), "p50_ms": round(float(p50), 3), "p99_ms": round(float(p99), 3)}
+
+
+async def _run_imports(client, data_dir: Path, import_format: str) -> dict:
+    results = {}
+
+    for name in IMPORTS:
+        file_name = f"{name}.{import_format}"
+        start = time.perf_counter()
+        with open(data_dir / file_name, "rb") as file:
+            response = await client.post(f"/api/{name}/{IMPORT_ENDPOINTS[import_format]}", files={"file": (file_name, file)})
+        accepted_ms = (time.perf_counter() - start) * 1000
+
+        if response.status_code != 202:
+            raise RuntimeError(f"Import of {name} failed ({response.status_code}): {response.text}")
+
+        # the import runs on a worker process, the api keeps answering reads in the meantime. their latency is measured
+        # while the job is polled, that is what the worker pool is for
+        job = response.json()
+        read_timings = []
+        while job["state"] in ("queued", "running"):
+            read_start = time.perf_counter()
+            await client.get("/api/sales/", params={"limit": 50})
+            read_timings.append((time.perf_counter() - read_start) * 1000)
+
+            await asyncio.sleep(0.05)
+            job = (await client.get(f"/api/imports/{job['id']}")).json()
+        seconds = time.perf_counter() - start
+
+        if job["state"] != "succeeded":
+            raise RuntimeError(f"Import of {name} {job['state']}: {job['error']}")
+
+        results[name] = {
+            "rows": job["rows_read"],
+            "added": job["added"],
+            "seconds": round(seconds, 3),
+            # measured here, so the upload and the queue are included (the job reports its own number too)
+            "rows_per_second": round(job["rows_read"] / seconds),
+            "server_rows_per_second": job["rows_per_second"],
+            "accepted_ms": round(accepted_ms, 3),
+            "read_sales_during_import": _latency_summary(read_timings),
+        }
+        print(f"  {name}: {job['rows_read']} rows in {seconds:.2f}s, read_sales p99 {results[name]['read_sales_during_import']['p99_ms']}ms meanwhile")
+
+    return results
+
+
+async def _run_ingestion(client, manifest: dict, count: int, concurrency: int, seed: int) -> dict:
+    """ point of sale traffic: 'count' single sales sent with POST /sales/ by 'concurrency' clients at the same time. run
+    it with SALE_BATCHING=true to measure the micro batching (see app/services/sale_batcher.py) """
+    from app.services.sale_batcher import sale_batcher
+
+    rng = random.Random(seed)
+    sales = [
+        {"product_id": rng.randint(1, manifest["products"]), "quantity": rng.randint(1, 5), "total_price": round(rng.uniform(1, 500), 2), "date": manifest["end_date"]}
+        for _ in range(count)
+    ]
+    timings = []
+    failed = 0
+    pending = iter(sales)
+
+    async def terminal():
+        nonlocal failed
+        for sale in pending:
+            start = time.perf_counter()
+            # without batching sqlite fails some of the concurrent writes ('database is locked'), they are counted and
+            # not retried. the app errors reach the client as exceptions on the in process transport
+            try:
+                response = await client.post("/api/sales/", json=sale)
+                ok = response.status_code == 200
+            except Exception:
+                ok = False
+            timings.append((time.perf_counter() - start) * 1000)
+            failed += not ok
+
+    start = time.perf_counter()
+    await asyncio.gather(*[terminal() for _ in range(concurrency)])
+    seconds = time.perf_counter() - start
+
+    return {
+        "batching": sale_batcher is not None,
+        "sales": count,
+        "failed": failed,
+        "concurrency": concurrency,
+        "seconds": round(seconds, 3),
+        "sales_per_second": round((count - failed) / seconds),
+        **{key: value for key, value in _latency_summary(timings).items() if key != "requests"},
+    }
+
+
+async def _run_scenario(client, requests: list, warmup: int, concurrency: int, revalidate: bool = False) -> dict:
+    # with 'revalidate' the ETag of each response is sent back on the next request of the same path and parameters
+    etags = {}
+
+    async def get(path: str, params: dict):
+        key = (path, tuple(sorted(params.items())))
+        headers = {"If-None-Match": etags[key]} if revalidate and key in etags else {}
+        response = await client.get(path, params=params, headers=headers)
+        if "etag" in response.headers:
+            etags[key] = response.headers["etag"]
+        return response
+
+    for path, params in requests[:warmup]:
+        await get(path, params)
+
+    timings, db_timings, queries = [], [], []
+    pending = iter(requests)
+
+    async def worker():
+        for path, params in pending:
+            start = time.perf_counter()
+            response = await get(path, params)
+            timings.append((time.perf_counter() - start) * 1000)
+
+            if response.status_code not in (200, 304):
+                raise RuntimeError(f"GET {path} {params} failed ({response.status_code}): {response.text}")
+
+            db_ms, db_queries = _server_timing(response.headers["server-timing"])
+            db_timings.append(db_ms)
+            queries.append(db_queries)
+
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+
+    p50, p95, p99 = np.percentile(timings, [50, 95, 99])
+    return {
+        "requests": len(timings),
+        "mean_ms": round(float(np.mean(timings)), 3),
+        "p50_ms": round(float(p50), 3),
+        "p95_ms": round(float(p95), 3),
+        "p99_ms": round(float(p99), 3),
+        "max_ms": round(float(np.max(timings)), 3),
+        "db_mean_ms": round(float(np.mean(db_timings)), 3),
+        "queries_mean": round(float(np.mean(queries)), 2),
+    }
+
+
+async def _run(args, manifest: dict, data_dir: Path) -> dict:
+    # imported here, DATABASE_URL must be set before app.config.database is loaded
+    import httpx
+    from sqlalchemy import text
+    from sqlmodel import SQLModel
+    from app.main import app
+    from app.config.database import engine
+
+    if args.reset:
+        SQLModel.metadata.drop_all(engine)
+        # otherwise the next boot finds the schema version and does not create the tables again
+        with engine.begin() as conn:
+            conn.execute(text("DROP TABLE IF EXISTS schema_version"))
+
+    report = {}
+
+    # httpx does not run the lifespan events, the tables are created by entering the lifespan by hand
+    async with app.router.lifespan_context(app):
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://benchmark", timeout=None) as client:
+            print("Importing...")
+            report["imports"] = await _run_imports(client, data_dir, args.import_format)
+            report["peak_rss_mb"] = {"after_imports": _peak_rss_mb()}
+
+            report["latency"] = {}
+            for name, requests in _scenarios(manifest, args.requests + args.warmup, args.seed).items():
+                report["latency"][name] = await _run_scenario(client, requests, args.warmup, args.concurrency)
+                print(f"  {name}: p50 {report['latency'][name]['p50_ms']}ms, p99 {report['latency'][name]['p99_ms']}ms")
+
+            # nothing is written meanwhile, so after the first response every request is answered with a 304
+            for name, requests in _polling_scenarios(args.requests + args.warmup).items():
+                report["latency"][name] = await _run_scenario(client, requests, args.warmup, args.concurrency, revalidate=True)
+                print(f"  {name}: p50 {report['latency'][name]['p50_ms']}ms, p99 {report['latency'][name]['p99_ms']}ms")
+
+            # last, the sales it adds would change the results of the read scenarios
+            report["ingestion"] = await _run_ingestion(client, manifest, args.ingest_sales, args.ingest_concurrency, args.seed)
+            print(f"  ingestion: {report['ingestion']['sales_per_second']} sales/s, {report['ingestion']['failed']} failed, p99 {report['ingestion']['p99_ms']}ms (batching {'on' if report['ingestion']['batching'] else 'off'})")
+
+            report["peak_rss_mb"]["final"] = _peak_rss_mb()
+
+    # after the lifespan, so the new worker does not share the sqlite file with a running app
+    report["startup_seconds"] = _measure_startup()
+    print(f"  startup: {report['startup_seconds']}s")
+
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.run")
+    parser.add_argument("--scale", choices=SCALES, default="10k")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--data-dir", type=Path, default=DEFAULT_DATA_DIR)
+    parser.add_argument("--database-url", default=None, help="defaults to a new sqlite file on the data dir")
+    parser.add_argument("--reset", action="store_true", help="drop the tables of --database-url before importing")
+    parser.add_argument("--import-format", choices=IMPORT_ENDPOINTS, default="csv")
+    parser.add_argument("--requests", type=int, default=200, help="measured requests per scenario")
+    parser.add_argument("--warmup", type=int, default=10, help="requests per scenario sent before measuring")
+    parser.add_argument("--concurrency", type=int, default=1, help="requests in flight at the same time")
+    parser.add_argument("--ingest-sales", type=int, default=2000, help="single sales sent to POST /sales/ on the ingestion scenario")
+    parser.add_argument("--ingest-concurrency", type=int, default=20, help="clients sending sales at the same time")
+    parser.add_argument("--output", type=Path, default=None)
+    args = parser.parse_args()
+
+    print(f"Generating the {args.scale} dataset...")
+    manifest = generate(args.scale, args.data_dir, args.seed)
+
+    if args.database_url is None:
+        # a new sqlite file per run, so every run starts from an empty database
+        database_path = args.data_dir / f"benchmark-{args.scale}.db"
+        database_path.unlink(missing_ok=True)
+        args.database_url = f"sqlite:///{database_path.resolve()}"
+    elif not args.reset:
+        parser.error("the imports need an empty database, pass --reset to drop the tables of --database-url")
+
+    os.environ["DATABASE_URL"] = args.database_url
+
+    started = datetime.now(timezone.utc)
+    results = asyncio.run(_run(args, manifest, args.data_dir / args.scale))
+
+    commit = _git_commit()
+    dialect = args.database_url.split(":")[0].split("+")[0]
+    report = {
+        "meta": {
+            "commit": commit,
+            "started_at": started.isoformat(timespec="seconds"),
+            "scale": args.scale,
+            "seed": args.seed,
+            "database": dialect,
+            "import_format": args.import_format,
+            "requests": args.requests,
+            "concurrency": args.concurrency,
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+        },
+        **results,
+    }
+
+    output = args.output or RESULTS_DIR / f"{args.scale}-{dialect}-{args.import_format}-{commit}.json"
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps(report, indent=2))
+    print(f"Report written to {output}")
+
+
+if __name__ == "__main__":
+    main()